@@ -0,0 +1,148 @@
+''' Asynchronous, atomic checkpoint writing '''
+import os
+import copy
+import shutil
+import threading
+import queue
+import torch
+
+def optimizer_path(model_path):
+    ''' File of the optimizer state of a checkpoint saved with separate_optimizer '''
+    root, ext = os.path.splitext(model_path)
+    return root + '.optim' + ext
+
+def snapshot(obj):
+    ''' Copy of a (nested) state dict whose tensors are detached CPU copies, so that the
+    training can go on updating the parameters while the copy is written '''
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return copy.deepcopy(obj)
+
+def atomic_save(obj, path):
+    ''' torch.save to a temporary file next to path, renamed to path once it is on disk:
+    path is never left half written '''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def atomic_link(src, path):
+    ''' Make path a hard link to (or a copy of) the file src, atomically '''
+    tmp_path = path + '.tmp'
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError: # no hard links on this file system
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, path)
+
+def load_optimizer_state(checkpoint, model_path):
+    ''' The optimizer state of a checkpoint, stored in it or next to it '''
+    if checkpoint.get('optimizer') is not None:
+        return checkpoint['optimizer']
+    return torch.load(optimizer_path(model_path), weights_only=False)
+
+class CheckpointWriter(object):
+    ''' Write checkpoints in a background thread.
+
+    save() takes a snapshot of the checkpoint in memory and returns; the writer thread
+    saves it atomically and applies the retention policy: the keep_last most recent
+    checkpoints and the keep_best best scored ones (see set_score) are kept, the others
+    are removed (0 and 0: keep them all). With separate_optimizer, the optimizer state
+    goes to its own file (optimizer_path), which is removed with its checkpoint.
+    '''
+
+    def __init__(self, keep_last=0, keep_best=0, separate_optimizer=False):
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.separate_optimizer = separate_optimizer
+
+        self._saved = [] # paths of the saved checkpoints, oldest first
+        self._scores = {}
+        self._error = None
+        # at most one snapshot waits while another is written
+        self._queue = queue.Queue(maxsize=1)
+        self._worker = threading.Thread(target=self._write_loop)
+        self._worker.daemon = True
+        self._worker.start()
+
+    def save(self, checkpoint, path, link_path=None):
+        ''' Save checkpoint to path, then make link_path (e.g. the latest checkpoint) point to it '''
+        self._check()
+        self._queue.put(('save', snapshot(checkpoint), path, link_path))
+
+    def set_score(self, path, score):
+        ''' Score of the checkpoint path for keep_best, higher is better '''
+        self._check()
+        self._queue.put(('score', score, path, None))
+
+    def wait(self):
+        ''' Block until everything is written '''
+        self._queue.join()
+        self._check()
+
+    def close(self):
+        self.wait()
+        self._queue.put(None)
+        self._worker.join()
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            try:
+                action, value, path, link_path = item
+                if action == 'save':
+                    self._write(value, path, link_path)
+                else:
+                    self._scores[path] = value
+                self._apply_retention()
+            except Exception as e: # raised again by the next save() or wait()
+                self._error = e
+            self._queue.task_done()
+
+    def _write(self, checkpoint, path, link_path):
+        if self.separate_optimizer:
+            atomic_save(checkpoint.pop('optimizer'), optimizer_path(path))
+            checkpoint['optimizer'] = None
+        atomic_save(checkpoint, path)
+        if link_path and link_path != path:
+            if self.separate_optimizer:
+                atomic_link(optimizer_path(path), optimizer_path(link_path))
+            atomic_link(path, link_path)
+
+        if path in self._saved:
+            self._saved.remove(path)
+        self._saved.append(path)
+
+    def _apply_retention(self):
+        if not self.keep_last and not self.keep_best:
+            return
+        keep = set(self._saved[-self.keep_last:]) if self.keep_last else set()
+        if self.keep_best:
+            # not scored yet: kept until its score is known
+            keep.update(path for path in self._saved if path not in self._scores)
+            scored = sorted((path for path in self._saved if path in self._scores),
+                            key=lambda path: self._scores[path], reverse=True)
+            keep.update(scored[:self.keep_best])
+
+        for path in [path for path in self._saved if path not in keep]:
+            self._saved.remove(path)
+            self._scores.pop(path, None)
+            for filename in (path, optimizer_path(path)):
+                if os.path.exists(filename):
+                    os.remove(filename)
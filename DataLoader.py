@@ -1,9 +1,37 @@
 ''' Data Loader class for training iteration '''
-import random
+import time
+import threading
+import queue
+import itertools
 import numpy as np
 import torch
-from torch.autograd import Variable
 import NMTmodelRNN.Constants as Constants
+from Dataset import TokenArray
+
+def collate(tokens, starts, lengths):
+    ''' Pad sequences stored in a flat token array into a (batch_size, max_len) array.
+    Sequence i is tokens[starts[i]:starts[i] + lengths[i]]. '''
+
+    batch_size, max_len = len(lengths), int(lengths.max())
+    inst_data = np.full((batch_size, max_len), Constants.PAD, dtype=np.int64)
+
+    # (row, column) of every token of the batch
+    rows = np.repeat(np.arange(batch_size), lengths)
+    cols = np.arange(len(rows)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    inst_data[rows, cols] = tokens[np.repeat(starts, lengths) + cols]
+    return inst_data
+
+def inst_lengths(insts):
+    ''' Lengths of a list of instances or of a TokenArray '''
+    if isinstance(insts, TokenArray):
+        return insts.lengths
+    return np.array([len(inst) for inst in insts])
+
+def select(insts, idx):
+    ''' The instances idx of a list of instances or of a TokenArray '''
+    if isinstance(insts, TokenArray):
+        return insts.take(idx)
+    return [insts[i] for i in idx]
 
 class DataLoader(object):
     ''' For data iteration '''
@@ -13,23 +41,39 @@ class DataLoader(object):
             src_insts=None, tgt_insts=None, ctx_insts=None,
             cuda=True, batch_size=64, shuffle=True,
             is_train=True, sort_by_length=False,
-            maxibatch_size=20):
+            maxibatch_size=20, batch_tokens=0,
+            rank=0, world_size=1, seed=None):
 
         assert src_insts
-        assert len(src_insts) >= batch_size
+        assert len(src_insts) >= batch_size * world_size
 
         if tgt_insts:
             assert len(src_insts) == len(tgt_insts)
 
-        self.nb_examples = len(src_insts)
+        # with world_size > 1, every epoch the processes shuffle the data the same way
+        # (same seed), and process rank gets every world_size-th sentence of it
+        self._rank = rank
+        self._world_size = world_size
+        self._rng = np.random.RandomState(seed) if seed is not None else np.random
+
+        self.nb_examples = len(src_insts) // world_size
         self.cuda = cuda
-        self._n_batch = int(np.ceil(len(src_insts) / batch_size))
+        self._n_batch = int(np.ceil(self.nb_examples / batch_size))
 
         self._batch_size = batch_size
 
+        # the instances are never modified, they are shuffled and sorted through _order
         self._src_insts = src_insts
         self._tgt_insts = tgt_insts
         self._ctx_insts = ctx_insts
+        self._perm = np.arange(len(src_insts))
+        self._order = self._perm[rank::world_size][:self.nb_examples]
+
+        self._src_len = inst_lengths(src_insts)
+        if tgt_insts:
+            self._tgt_len = inst_lengths(tgt_insts)
+        else:
+            self._tgt_len = np.zeros_like(self._src_len)
 
         src_idx2word = {idx:word for word, idx in src_word2idx.items()}
         tgt_idx2word = {idx:word for word, idx in tgt_word2idx.items()}
@@ -53,6 +97,12 @@ class DataLoader(object):
 
         self._maxibatch_size = maxibatch_size
 
+        # with batch_tokens, the batches are planned for the whole epoch at once
+        self._batch_tokens = batch_tokens
+        self._batch_plan = None
+        if self._batch_tokens:
+            self.plan_batches()
+
 
     @property
     def n_insts(self):
@@ -91,23 +141,34 @@ class DataLoader(object):
 
     def shuffle(self):
         ''' Shuffle data for a brand new start '''
-        if self._tgt_insts:
-            if self._ctx_insts:
-                paired_insts = list(zip(self._src_insts, self._tgt_insts, self._ctx_insts))
-                random.shuffle(paired_insts)
-                self._src_insts, self._tgt_insts, self._ctx_insts = zip(*paired_insts)
-            else:
-                paired_insts = list(zip(self._src_insts, self._tgt_insts))
-                random.shuffle(paired_insts)
-                self._src_insts, self._tgt_insts = zip(*paired_insts)
-        else:
-            if self._ctx_insts:
-                paired_insts = list(zip(self._src_insts, self._ctx_insts))
-                random.shuffle(paired_insts)
-                self._src_insts, self._ctx_insts = zip(*paired_insts)
-            else:
-                random.shuffle(self._src_insts)
-
+        self._rng.shuffle(self._perm)
+        self._order = self._perm[self._rank::self._world_size][:self.nb_examples]
+
+    def plan_batches(self):
+        ''' Split the data into batches of at most batch_tokens padded source + target tokens.
+        Each window of maxibatch_size * batch_size sentences is sorted by source, then
+        target length, so that the sentences of a batch have similar lengths. '''
+
+        src_len, tgt_len = self._src_len, self._tgt_len
+
+        window = self._maxibatch_size * self._batch_size
+        batches = []
+        for start in range(0, len(self._order), window):
+            order = self._order[start:start+window]
+            order = order[np.lexsort((-tgt_len[order], -src_len[order]))]
+
+            batch, max_src, max_tgt = [], 0, 0
+            for idx in order:
+                new_src, new_tgt = max(max_src, src_len[idx]), max(max_tgt, tgt_len[idx])
+                if batch and (len(batch) + 1) * (new_src + new_tgt) > self._batch_tokens:
+                    batches.append(batch)
+                    batch, new_src, new_tgt = [], src_len[idx], tgt_len[idx]
+                batch.append(idx)
+                max_src, max_tgt = new_src, new_tgt
+            batches.append(batch)
+
+        self._batch_plan = batches
+        self._n_batch = len(batches)
 
     def __iter__(self):
         return self
@@ -122,25 +183,24 @@ class DataLoader(object):
         ''' Get the next batch '''
 
         def pad_to_longest(insts):
-            ''' Pad the instance to the max seq length in batch '''
+            ''' Pad the instance to the max seq length in batch, returns the
+            padded data (batch_size, max_len) and the lengths (batch_size) '''
 
-            max_len = max(len(inst) for inst in insts)
-
-            inst_data = np.array([
-                inst + [Constants.PAD] * (max_len - len(inst))
-                for inst in insts])
-
-            inst_position = np.array([
-                [pos_i+1 if w_i != Constants.PAD else 0 for pos_i, w_i in enumerate(inst)]
-                for inst in inst_data])
+            if isinstance(insts, TokenArray):
+                lengths = insts.lengths
+                inst_data = collate(insts.tokens, insts.starts, lengths)
+            else:
+                lengths = np.fromiter((len(inst) for inst in insts), dtype=np.int64, count=len(insts))
+                tokens = np.fromiter(itertools.chain.from_iterable(insts), dtype=np.int64, count=int(lengths.sum()))
+                inst_data = collate(tokens, np.cumsum(lengths) - lengths, lengths)
 
-            inst_data_tensor = Variable(torch.LongTensor(inst_data), volatile=(not self.is_train))
-            inst_position_tensor = Variable(torch.LongTensor(inst_position), volatile=(not self.is_train))
+            inst_data_tensor = torch.from_numpy(inst_data)
+            inst_length_tensor = torch.from_numpy(lengths)
 
             if self.cuda:
                 inst_data_tensor = inst_data_tensor.cuda()
-                inst_position_tensor = inst_position_tensor.cuda()
-            return inst_data_tensor, inst_position_tensor
+                inst_length_tensor = inst_length_tensor.cuda()
+            return inst_data_tensor, inst_length_tensor
 
         if self._iter_count < self._n_batch:
             
@@ -148,7 +208,10 @@ class DataLoader(object):
             self._iter_count += 1
 
 
-            if self._sort_by_length:
+            if self._batch_plan is not None:
+                batch = self._batch_plan[batch_idx]
+
+            elif self._sort_by_length:
 
                 #assert self._tgt_insts, 'Target must be provided to do sort_by_length'
 
@@ -157,65 +220,264 @@ class DataLoader(object):
                     start_idx = batch_idx * self._batch_size
                     end_idx = (batch_idx + self._maxibatch_size) * self._batch_size
 
-                    src_insts = self._src_insts[start_idx:end_idx]
-                    tgt_insts = self._tgt_insts[start_idx:end_idx]
+                    maxibatch = self._order[start_idx:end_idx]
+                    sidx = self._src_len[maxibatch].argsort()[::-1]
+                    self._maxibatch = maxibatch[sidx]
+
+                cur_start = (batch_idx % self._maxibatch_size) * self._batch_size
+                cur_end = ((batch_idx % self._maxibatch_size) + 1) * self._batch_size
+                batch = self._maxibatch[cur_start:cur_end]
 
-                    slen = np.array([len(s) for s in src_insts])
-                    sidx = slen.argsort()[::-1]
+            else:
+                start_idx = batch_idx * self._batch_size
+                end_idx = (batch_idx + 1) * self._batch_size
+                batch = self._order[start_idx:end_idx]
 
-                    self._sbuf = [src_insts[i] for i in sidx]
-                    self._tbuf = [tgt_insts[i] for i in sidx]
+            src_data, src_len = pad_to_longest(select(self._src_insts, batch))
 
-                    if self._ctx_insts:
-                        ctx_insts = self._ctx_insts[start_idx:end_idx]
-                        self._cbuf = [ctx_insts[i] for i in sidx]
+            batch_data = [(src_data, src_len)]
+            if self._tgt_insts:
+                batch_data.append(pad_to_longest(select(self._tgt_insts, batch)))
+            if self._ctx_insts:
+                batch_data.append(pad_to_longest(select(self._ctx_insts, batch)))
 
-                cur_start = (batch_idx % self._maxibatch_size) * self._batch_size
-                cur_end = ((batch_idx % self._maxibatch_size) + 1) * self._batch_size
+            if len(batch_data) == 1:
+                return src_data, src_len
+            return tuple(batch_data)
 
-                cur_src_insts = self._sbuf[cur_start:cur_end]
-                src_data, src_pos = pad_to_longest(cur_src_insts)
+        else:
 
-                cur_tgt_insts = self._tbuf[cur_start:cur_end]
-                tgt_data, tgt_pos = pad_to_longest(cur_tgt_insts)
+            if self._need_shuffle:
+                self.shuffle()
+                if self._batch_tokens:
+                    self.plan_batches()
+
+            self._iter_count = 0
+            raise StopIteration()
 
-                if self._ctx_insts:
-                    cur_ctx_insts = self._cbuf[cur_start:cur_end]
-                    ctx_data, ctx_pos = pad_to_longest(cur_ctx_insts)
 
-                    return (src_data, src_pos), (tgt_data, tgt_pos), (ctx_data, ctx_pos)
+class ShardedDataLoader(object):
+    ''' Iterate over a training set split into shards, with only one shard in use at a time.
 
-                else:
-                    return (src_data, src_pos), (tgt_data, tgt_pos)
+    Every epoch visits the shards in a random order. Each shard is read by a DataLoader,
+    which shuffles its sentences and sorts them by length within maxibatch windows.
+    The next shard is read ahead by the OS while the current one is used.
 
+    The shards with less than one batch per process are merged into one shard held in
+    memory; if that is still too small next to other shards, its sentences are left out.
+    '''
+
+    def __init__(
+            self, src_word2idx, tgt_word2idx, shards,
+            cuda=True, batch_size=64, shuffle=True,
+            is_train=True, sort_by_length=False,
+            maxibatch_size=20, batch_tokens=0,
+            rank=0, world_size=1, seed=None):
+
+        min_size = batch_size * world_size
+        # list of {'src': TokenArray, 'tgt': TokenArray}
+        self._shards = [shard for shard in shards if len(shard['src']) >= min_size]
+        small = [shard for shard in shards if 0 < len(shard['src']) < min_size]
+        if small:
+            merged = {side: [inst for shard in small for inst in shard[side]] for side in small[0]}
+            if len(merged['src']) >= min_size or not self._shards:
+                self._shards.append(merged)
             else:
-                start_idx = batch_idx * self._batch_size
-                end_idx = (batch_idx + 1) * self._batch_size
+                print('[Warning] {} sentences of undersized shards are not used.'.format(len(merged['src'])))
 
-                src_insts = self._src_insts[start_idx:end_idx]
-                src_data, src_pos = pad_to_longest(src_insts)
-
-                if self._ctx_insts:
-                    ctx_insts = self._ctx_insts[start_idx:end_idx]
-                    ctx_data, ctx_pos = pad_to_longest(ctx_insts)
-                
-                if not self._tgt_insts:
-                    if self._ctx_insts:
-                        return (src_data, src_pos), (ctx_data, ctx_pos)
-                    else:
-                        return src_data, src_pos
-                else:
-                    tgt_insts = self._tgt_insts[start_idx:end_idx]
-                    tgt_data, tgt_pos = pad_to_longest(tgt_insts)
-                    if self._ctx_insts:
-                        return (src_data, src_pos), (tgt_data, tgt_pos), (ctx_data, ctx_pos)
-                    else:
-                        return (src_data, src_pos), (tgt_data, tgt_pos)
+        self._src_word2idx = src_word2idx
+        self._tgt_word2idx = tgt_word2idx
+        self.cuda = cuda
+        self._need_shuffle = shuffle
+        self._loader_args = dict(
+            batch_size=batch_size, shuffle=shuffle, is_train=is_train,
+            sort_by_length=sort_by_length, maxibatch_size=maxibatch_size,
+            batch_tokens=batch_tokens, rank=rank, world_size=world_size)
+        # all the processes visit the shards in the same order
+        self._rng = np.random.RandomState(seed) if seed is not None else np.random
+
+        self.nb_examples = sum(len(shard['src']) // world_size for shard in self._shards)
+        # estimated until the shard is planned, for batch_tokens
+        self._n_batch = [int(np.ceil(len(shard['src']) // world_size / batch_size)) for shard in self._shards]
+
+    @property
+    def n_insts(self):
+        return self.nb_examples
+
+    @property
+    def src_vocab_size(self):
+        return len(self._src_word2idx)
 
+    @property
+    def tgt_vocab_size(self):
+        return len(self._tgt_word2idx)
+
+    @property
+    def src_word2idx(self):
+        return self._src_word2idx
+
+    @property
+    def tgt_word2idx(self):
+        return self._tgt_word2idx
+
+    def __len__(self):
+        return sum(self._n_batch)
+
+    def __iter__(self):
+        if self._need_shuffle:
+            order = self._rng.permutation(len(self._shards))
         else:
+            order = np.arange(len(self._shards))
+
+        for pos, shard_idx in enumerate(order):
+            if pos + 1 < len(order):
+                for insts in self._shards[order[pos + 1]].values():
+                    if isinstance(insts, TokenArray):
+                        insts.will_need()
+
+            shard = self._shards[shard_idx]
+            loader = DataLoader(
+                self._src_word2idx, self._tgt_word2idx,
+                src_insts=shard['src'], tgt_insts=shard.get('tgt'),
+                cuda=self.cuda, seed=self._rng.randint(2**31), **self._loader_args)
+            self._n_batch[shard_idx] = len(loader)
+
+            while True:
+                try:
+                    yield loader.next()
+                except StopIteration:
+                    break
+
+def map_tensors(fn, batch):
+    ''' Apply fn to every tensor of a (nested tuple) batch '''
+    if isinstance(batch, (tuple, list)):
+        return tuple(map_tensors(fn, x) for x in batch)
+    return fn(batch)
+
+class PrefetchSlot(object):
+    ''' Reusable host buffers for one batch, pinned if the batches go to the GPU '''
+
+    def __init__(self, pin_memory):
+        self.pin_memory = pin_memory
+        self.buffers = []
+        self.event = None # marks the end of the copies to the device
+
+    def fill(self, batch):
+        ''' Copy the tensors of batch into the buffers of the slot '''
+        if self.event is not None:
+            self.event.synchronize()
+            self.event = None
+        n_used = [0]
+
+        def copy(tensor):
+            k = n_used[0]
+            n_used[0] += 1
+            if k == len(self.buffers):
+                self.buffers.append(None)
+            buf = self.buffers[k]
+            if buf is None or buf.numel() < tensor.numel() or buf.dtype != tensor.dtype:
+                buf = torch.empty(max(tensor.numel(), 1), dtype=tensor.dtype)
+                if self.pin_memory:
+                    buf = buf.pin_memory()
+                self.buffers[k] = buf
+            out = buf[:tensor.numel()].view(tensor.size())
+            out.copy_(tensor)
+            return out
+
+        return map_tensors(copy, batch)
+
+class PrefetchLoader(object):
+    ''' Build the batches of a DataLoader in a background thread, up to n_prefetch
+    batches ahead of the training loop.
+
+    The batches are built on the CPU into n_prefetch + 1 reusable (pinned) slots, and
+    copied to the GPU asynchronously when they are dequeued. stats() tells how often the
+    training loop had to wait for a batch.
+    '''
+
+    def __init__(self, loader, n_prefetch=4, cuda=False):
+        self.loader = loader
+        self.loader.cuda = False
+        self.cuda = cuda
+        self.n_prefetch = n_prefetch
 
-            if self._need_shuffle:
-                self.shuffle()
+        self._slots = [PrefetchSlot(cuda) for _ in range(n_prefetch + 1)]
+        self._ready = None
+        self._held = None
+        self.reset_stats()
 
-            self._iter_count = 0
+    def __getattr__(self, name):
+        # nb_examples, the vocabularies, ... of the wrapped DataLoader
+        return getattr(self.loader, name)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def reset_stats(self):
+        self.n_batches = 0
+        self.n_stalls = 0
+        self.wait_time = 0.0
+        self.queue_depth = 0
+
+    def stats(self):
+        ''' Data loading statistics since the last reset_stats '''
+        n_batches = max(self.n_batches, 1)
+        return {'batches': self.n_batches,
+                'stalls': self.n_stalls,
+                'stall_pct': 100.0 * self.n_stalls / n_batches,
+                'wait_s': self.wait_time,
+                'mean_queue_depth': self.queue_depth / n_batches}
+
+    def _produce(self, free, ready):
+        try:
+            for batch in self.loader:
+                slot = free.get()
+                ready.put((slot, slot.fill(batch)))
+        except Exception as e: # raised again by the training loop
+            ready.put(e)
+        ready.put(None)
+
+    def __iter__(self):
+        free = queue.Queue()
+        for slot in self._slots:
+            free.put(slot)
+        self._free = free
+        self._ready = queue.Queue()
+        self._held = None
+
+        worker = threading.Thread(target=self._produce, args=(free, self._ready))
+        worker.daemon = True
+        worker.start()
+        return self
+
+    def __next__(self):
+        return self.next()
+
+    def next(self):
+        ''' Get the next prefetched batch '''
+        if self._held is not None:
+            # the previous batch is no longer used, its slot can be refilled
+            self._free.put(self._held)
+            self._held = None
+
+        depth = self._ready.qsize()
+        start = time.time()
+        item = self._ready.get()
+        if item is None:
             raise StopIteration()
+        if isinstance(item, Exception):
+            raise item
+
+        self.n_batches += 1
+        self.queue_depth += depth
+        if depth == 0:
+            self.n_stalls += 1
+            self.wait_time += time.time() - start
+
+        slot, batch = item
+        self._held = slot
+        if self.cuda:
+            batch = map_tensors(lambda t: t.cuda(non_blocking=True), batch)
+            slot.event = torch.cuda.Event()
+            slot.event.record()
+        return batch
@@ -0,0 +1,184 @@
+''' Binary, memory-mapped format of the preprocessed data '''
+import os
+import itertools
+import numpy as np
+import torch
+
+HEADER_NAME = 'header.pt'
+
+class TokenArray(object):
+    ''' Sequences of word indices stored as one flat token array, with the offset
+    of every sequence (sequence i is tokens[offsets[i]:offsets[i+1]]).
+
+    Both arrays can be np.memmap, in which case nothing is read before it is used.
+    take() returns a view on a subset of the sequences, without copying any token.
+    '''
+
+    def __init__(self, tokens, offsets, index=None):
+        self.tokens = tokens
+        self.offsets = offsets
+        self.index = index # selected sequences, None for all of them
+
+    @classmethod
+    def open(cls, prefix):
+        ''' Map the prefix.bin and prefix.idx files written by TokenArrayWriter '''
+        offsets = np.memmap(prefix + '.idx', dtype=np.int64, mode='r')
+        if offsets[-1] == 0: # np.memmap cannot map an empty file
+            tokens = np.zeros(0, dtype=np.int32)
+        else:
+            tokens = np.memmap(prefix + '.bin', dtype=np.int32, mode='r')
+        return cls(tokens, offsets)
+
+    def __len__(self):
+        if self.index is None:
+            return len(self.offsets) - 1
+        return len(self.index)
+
+    @property
+    def starts(self):
+        if self.index is None:
+            return np.asarray(self.offsets[:-1])
+        return np.asarray(self.offsets[self.index])
+
+    @property
+    def lengths(self):
+        if self.index is None:
+            return np.diff(self.offsets)
+        return np.asarray(self.offsets[self.index + 1] - self.offsets[self.index])
+
+    def take(self, idx):
+        ''' The sequences idx (an array of positions in this TokenArray) '''
+        idx = np.asarray(idx, dtype=np.int64)
+        if self.index is not None:
+            idx = self.index[idx]
+        return TokenArray(self.tokens, self.offsets, idx)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.take(np.arange(len(self))[i])
+        if self.index is not None:
+            i = self.index[i]
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]].tolist()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def will_need(self):
+        ''' Ask the OS to start reading the mapped files in the background '''
+        if not hasattr(os, 'posix_fadvise'):
+            return
+        for array in (self.tokens, self.offsets):
+            filename = getattr(array, 'filename', None)
+            if filename:
+                fd = os.open(filename, os.O_RDONLY)
+                try:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                finally:
+                    os.close(fd)
+
+class TokenArrayWriter(object):
+    ''' Append sequences of word indices to prefix.bin, and their end offsets to
+    prefix.idx: only the last offset is kept in memory '''
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.tokens = open(prefix + '.bin', 'wb')
+        self.offsets = open(prefix + '.idx', 'wb')
+        self.n_insts = 0
+        self.offset = 0
+        np.zeros(1, dtype=np.int64).tofile(self.offsets)
+
+    def extend(self, insts):
+        lengths = [len(inst) for inst in insts]
+        tokens = np.fromiter(itertools.chain.from_iterable(insts), dtype=np.int32, count=sum(lengths))
+        self.extend_flat(tokens, lengths)
+
+    def extend_flat(self, tokens, lengths):
+        ''' Append the sequences of the given lengths, concatenated in tokens '''
+        np.asarray(tokens, dtype=np.int32).tofile(self.tokens)
+        offsets = np.cumsum(lengths, dtype=np.int64) + self.offset
+        offsets.tofile(self.offsets)
+        if len(offsets):
+            self.offset = int(offsets[-1])
+        self.n_insts += len(offsets)
+
+    def close(self):
+        self.tokens.close()
+        self.offsets.close()
+        return self.n_insts
+
+def token_array_prefix(path, split, side, shard=None):
+    ''' Files of a split and side (and training shard) in a binary directory '''
+    if shard is None:
+        return os.path.join(path, '{}.{}'.format(split, side))
+    return os.path.join(path, '{}.{}.{}'.format(split, shard, side))
+
+def split_round_robin(tokens, lengths, n_shards, first=0):
+    ''' Split sequences concatenated in tokens between n_shards, sequence i going to
+    shard (first + i) % n_shards. Return the (tokens, lengths) of every shard. '''
+    lengths = np.asarray(lengths, dtype=np.int64)
+    shard = (first + np.arange(len(lengths))) % n_shards
+    token_shard = np.repeat(shard, lengths)
+    return [(tokens[token_shard == k], lengths[shard == k]) for k in range(n_shards)]
+
+def save_binary(data, path, n_shards=1):
+    ''' Save the output of preprocess.py to the directory path: the settings and vocabularies
+    in a small header, and every split and side as a TokenArray.
+
+    With n_shards > 1, the training set is split into n_shards TokenArrays, sentence i
+    going to shard i % n_shards, so that the shards differ by one sentence at most. '''
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    sides = sorted(data['train'].keys())
+    for side in sides:
+        writer = TokenArrayWriter(token_array_prefix(path, 'valid', side))
+        writer.extend(data['valid'][side])
+        writer.close()
+
+        insts = data['train'][side]
+        if n_shards > 1:
+            for shard in range(n_shards):
+                writer = TokenArrayWriter(token_array_prefix(path, 'train', side, shard))
+                writer.extend(insts[shard::n_shards])
+                writer.close()
+        else:
+            writer = TokenArrayWriter(token_array_prefix(path, 'train', side))
+            writer.extend(insts)
+            writer.close()
+
+    save_header(data, path, sides=sides, n_shards=n_shards)
+
+def save_header(data, path, sides=('src', 'tgt'), n_shards=1):
+    ''' Write the header of a binary directory, whose token arrays are already written '''
+    header = {key: value for key, value in data.items() if key not in ('train', 'valid')}
+    header['format'] = 'binary'
+    header['train'] = header['valid'] = list(sides)
+    if n_shards > 1:
+        header['train_shards'] = n_shards
+    torch.save(header, os.path.join(path, HEADER_NAME))
+
+def load_data(path):
+    ''' Load the output of preprocess.py, either a torch.save file or a binary directory.
+
+    In the binary format, data['train'] and data['valid'] map every side to a
+    memory-mapped TokenArray: they are read lazily and shared between processes.
+    A sharded training set is a list of such dicts, one per shard. '''
+
+    if not os.path.isdir(path):
+        return torch.load(path, weights_only=False)
+
+    data = torch.load(os.path.join(path, HEADER_NAME), weights_only=False)
+    data['valid'] = {side: TokenArray.open(token_array_prefix(path, 'valid', side))
+                     for side in data['valid']}
+    n_shards = data.get('train_shards')
+    if n_shards:
+        data['train'] = [{side: TokenArray.open(token_array_prefix(path, 'train', side, shard))
+                          for side in data['train']}
+                         for shard in range(n_shards)]
+    else:
+        data['train'] = {side: TokenArray.open(token_array_prefix(path, 'train', side))
+                         for side in data['train']}
+    return data
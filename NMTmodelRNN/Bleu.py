@@ -0,0 +1,170 @@
+''' Corpus BLEU, computed exactly as multi-bleu.perl does '''
+import os
+import re
+import gzip
+import math
+import functools
+from collections import Counter, namedtuple
+
+MAX_ORDER = 4
+
+# perl's split on whitespace, on ASCII whitespace only (the script does not decode utf-8)
+_TOKEN = re.compile(r'[^ \t\n\r\f\v]+')
+_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+_BPE = re.compile(r'(@@ )|(@@ ?$)')
+
+def merge_bpe(line):
+    ''' Undo the BPE segmentation of a line, like sed -r 's/(@@ )|(@@ ?$)//g' '''
+    return _BPE.sub('', line)
+
+def tokenize(line, lowercase=False):
+    if lowercase:
+        line = line.translate(_LOWER) # perl's lc without a locale: ASCII only
+    return _TOKEN.findall(line)
+
+def count_ngrams(words):
+    ''' Counts of the 1 to MAX_ORDER-grams of a sentence, keyed by word tuples '''
+    counts = Counter()
+    for n in range(1, MAX_ORDER + 1):
+        for start in range(len(words) - n + 1):
+            counts[tuple(words[start:start+n])] += 1
+    return counts
+
+def chop_lines(f):
+    ''' The lines of a binary file as multi-bleu.perl reads them: perl's chop removes the
+    last byte of every line, the newline or, on an unterminated last line, a real one.
+    Undecodable bytes are kept as surrogates, so that they compare like perl's bytes. '''
+    return [line[:-1].decode('utf-8', 'surrogateescape') for line in f]
+
+def read_lines(path):
+    open_ = gzip.open if path.endswith('.gz') else open
+    with open_(path, 'rb') as f:
+        return chop_lines(f)
+
+class BleuReference(object):
+    ''' The references of a corpus, with the length and the maximum n-gram counts
+    over the references of every sentence computed once '''
+
+    def __init__(self, references, lowercase=False):
+        ''' references[k][i] is the sentence i of the reference set k '''
+        self.lowercase = lowercase
+        n_sents = max(len(ref) for ref in references)
+        self.lengths = [[] for _ in range(n_sents)]
+        self.ngrams = [Counter() for _ in range(n_sents)]
+        for ref in references:
+            for i, line in enumerate(ref):
+                words = tokenize(line, lowercase)
+                self.lengths[i].append(len(words))
+                self.ngrams[i] |= count_ngrams(words) # maximum of the counts
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @classmethod
+    def from_files(cls, paths, lowercase=False):
+        references = [read_lines(path) for path in paths]
+        if not any(references): # multi-bleu.perl dies as well
+            raise IOError('empty reference files ' + ', '.join(paths))
+        return cls(references, lowercase)
+
+def reference_files(stem):
+    ''' The reference files of a stem, looked up like multi-bleu.perl does:
+    stem0, stem1, ... and/or stem itself, or stem.ref0, ... '''
+    if not os.path.exists(stem) and not os.path.exists(stem + '0') and os.path.exists(stem + '.ref0'):
+        stem += '.ref'
+    paths = []
+    while os.path.exists(stem + str(len(paths))):
+        paths.append(stem + str(len(paths)))
+    if os.path.exists(stem):
+        paths.append(stem)
+    if not paths:
+        raise IOError('could not find reference file ' + stem)
+    return paths
+
+@functools.lru_cache(maxsize=8)
+def load_reference(stem, extra_paths=(), lowercase=False):
+    ''' BleuReference of the files of stem (see reference_files) and of extra_paths,
+    cached across calls: the validation scores against the same references every time '''
+    paths = reference_files(stem) + [path for path in extra_paths if os.path.exists(path)]
+    return BleuReference.from_files(paths, lowercase)
+
+class BleuScore(namedtuple('BleuScore', 'bleu precisions brevity_penalty ratio hyp_len ref_len')):
+    ''' Corpus BLEU and its components; bleu and precisions are in [0, 1].
+    str() is the line printed by multi-bleu.perl. '''
+
+    def __str__(self):
+        if self.ref_len == 0:
+            return 'BLEU = 0, 0/0/0/0 (BP=0, ratio=0, hyp_len=0, ref_len=0)'
+        return 'BLEU = %.2f, %.1f/%.1f/%.1f/%.1f (BP=%.3f, ratio=%.3f, hyp_len=%d, ref_len=%d)' % (
+            (100 * self.bleu,) + tuple(100 * p for p in self.precisions) +
+            (self.brevity_penalty, self.ratio, self.hyp_len, self.ref_len))
+
+class BleuScorer(object):
+    ''' Accumulate the n-gram match statistics of the hypotheses as they are produced.
+
+    Hypothesis i is scored against the sentence i of the reference, in the order
+    of the add() calls unless index is given. '''
+
+    def __init__(self, reference, merge_bpe=False):
+        self.reference = reference
+        self.merge_bpe = merge_bpe
+        self.reset()
+
+    def reset(self):
+        self.n_sents = 0
+        self.hyp_len = 0
+        self.ref_len = 0
+        self.correct = [0] * (MAX_ORDER + 1)
+        self.total = [0] * (MAX_ORDER + 1)
+
+    def add(self, hyp, index=None):
+        ''' Add the statistics of the hypothesis hyp (a line of text) '''
+        if index is None:
+            index = self.n_sents
+        self.n_sents += 1
+        if self.merge_bpe:
+            hyp = merge_bpe(hyp)
+        words = tokenize(hyp, self.reference.lowercase)
+
+        if index < len(self.reference):
+            ref_lengths, ref_ngrams = self.reference.lengths[index], self.reference.ngrams[index]
+        else: # more hypotheses than references
+            ref_lengths, ref_ngrams = [], {}
+
+        # closest reference length, the shorter one on ties
+        closest_diff, closest_length = 9999, 9999
+        for length in ref_lengths:
+            diff = abs(len(words) - length)
+            if diff < closest_diff or (diff == closest_diff and length < closest_length):
+                closest_diff, closest_length = diff, length
+        self.hyp_len += len(words)
+        self.ref_len += closest_length
+
+        for ngram, count in count_ngrams(words).items():
+            n = len(ngram)
+            self.total[n] += count
+            self.correct[n] += min(count, ref_ngrams.get(ngram, 0))
+
+    def score(self):
+        ''' BleuScore of the hypotheses added so far '''
+        precisions = [self.correct[n] / self.total[n] if self.total[n] else 0.0
+                      for n in range(1, MAX_ORDER + 1)]
+        if self.ref_len == 0:
+            return BleuScore(0.0, [0.0] * MAX_ORDER, 0.0, 0.0, 0, 0)
+
+        brevity_penalty = 1.0
+        if self.hyp_len < self.ref_len:
+            # multi-bleu.perl dies with a division by zero on empty hypotheses
+            brevity_penalty = math.exp(1 - self.ref_len / self.hyp_len) if self.hyp_len else 0.0
+        log_precisions = [math.log(p) if p else -9999999999 for p in precisions]
+        bleu = brevity_penalty * math.exp((log_precisions[0] + log_precisions[1] +
+                                           log_precisions[2] + log_precisions[3]) / 4)
+        return BleuScore(bleu, precisions, brevity_penalty,
+                         self.hyp_len / self.ref_len, self.hyp_len, self.ref_len)
+
+def corpus_bleu(hyps, reference, merge_bpe=False):
+    ''' BleuScore of a list of hypothesis lines '''
+    scorer = BleuScorer(reference, merge_bpe)
+    for hyp in hyps:
+        scorer.add(hyp)
+    return scorer.score()
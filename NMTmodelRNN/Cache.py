@@ -0,0 +1,94 @@
+''' Sentence-level translation memory in front of the encoder and decoder '''
+import os
+import pickle
+import hashlib
+from collections import OrderedDict
+
+def checkpoint_id(path, chunk_size=1 << 20):
+    ''' Identity of a checkpoint: sha1 of the file content '''
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+class TranslationCache(object):
+    ''' LRU cache of the translations, keyed by the checkpoint identity,
+    the decoding settings and the source index sequence.
+
+    The memory bound is an estimate of the size of the cached sequences and
+    scores. The cache can be saved to and reloaded from a local pickle file.
+    '''
+
+    def __init__(self, model_id, max_bytes, path=None):
+        self.model_id = model_id
+        self.max_bytes = max_bytes
+        self.path = path
+
+        self.hits = 0
+        self.misses = 0
+        self._n_bytes = 0
+        self._entries = OrderedDict()
+
+        if path and os.path.isfile(path):
+            self.load(path)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @staticmethod
+    def _entry_size(key, value):
+        # 8 bytes per index or score, plus the dict/tuple/list overhead
+        _, _, src = key
+        all_hyp, all_scores = value
+        return 8 * (len(src) + sum(len(hyp) for hyp in all_hyp) + len(all_scores)) + 256
+
+    def key(self, src_idx, settings):
+        ''' Cache key of one source sentence; settings are the decoding options '''
+        return (self.model_id, settings, tuple(src_idx))
+
+    def get(self, key):
+        ''' (hypotheses, scores) of the sentence, or None '''
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if key in self._entries:
+            self._n_bytes -= self._entry_size(key, self._entries.pop(key))
+        self._entries[key] = value
+        self._n_bytes += self._entry_size(key, value)
+        while self._n_bytes > self.max_bytes and self._entries:
+            old_key, old_value = self._entries.popitem(last=False)
+            self._n_bytes -= self._entry_size(old_key, old_value)
+
+    def stats(self):
+        n_lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / n_lookups if n_lookups else 0.0,
+            'entries': len(self._entries),
+            'bytes': self._n_bytes}
+
+    def save(self, path=None):
+        ''' Write the entries, least recently used first, to path (atomic rename) '''
+        path = path or self.path
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(list(self._entries.items()), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        with open(path, 'rb') as f:
+            entries = pickle.load(f)
+        for key, value in entries:
+            self.put(key, value)
+        print('[Info] {} cached translations loaded from {}'.format(len(entries), path))
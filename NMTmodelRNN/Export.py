@@ -0,0 +1,164 @@
+''' TorchScript version of a trained NMTmodelRNN, for inference without this code base '''
+from typing import Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+import NMTmodelRNN.Constants as Constants
+
+class ScriptableNMT(nn.Module):
+    ''' Encoder, decoder step and greedy decoding of a NMTmodelRNN, written so that
+    torch.jit.script can compile them. It shares the modules of the eager model.
+
+    The decoder state is passed around as plain tensors:
+    h_in (batch_size, x_seq_len, d_ctx), ctx_h (batch_size, x_seq_len, d_ctx),
+    xmask (batch_size, x_seq_len) and s_tm1 (n_layers, batch_size, d_model).
+    '''
+    attn_type: torch.jit.Final[str]
+    attn_window: torch.jit.Final[int]
+
+    def __init__(self, model):
+        super(ScriptableNMT, self).__init__()
+        encoder, decoder = model.encoder, model.decoder
+
+        self.src_emb = encoder.emb
+        self.enc_rnn = encoder.rnn
+
+        self.tgt_emb = decoder.emb
+        self.dec_rnn = decoder.rnn
+        self.ctx_to_s0 = decoder.ctx_to_s0
+        self.y_to_ctx = decoder.y_to_ctx
+        self.s_to_ctx = decoder.s_to_ctx
+        # the attention types which do not use them still need the attributes to compile
+        self.h_to_ctx = getattr(decoder, 'h_to_ctx', nn.Identity())
+        self.ctx_to_score = getattr(decoder, 'ctx_to_score', nn.Identity())
+        self.s_to_pos = getattr(decoder, 's_to_pos', nn.Identity())
+        self.pos_to_p = getattr(decoder, 'pos_to_p', nn.Identity())
+        self.y_to_fin = decoder.y_to_fin
+        self.c_to_fin = decoder.c_to_fin
+        self.s_to_fin = decoder.s_to_fin
+        self.fin_to_voc = decoder.fin_to_voc
+
+        self.n_enc_layers = encoder.n_layers
+        self.n_layers = decoder.n_layers
+        self.d_model = decoder.d_model
+        self.d_ctx = decoder.d_ctx
+        self.n_max_seq = decoder.n_max_seq
+        self.attn_type = decoder.attn_type
+        self.attn_window = decoder.attn_window
+
+    @torch.jit.export
+    def encode(self, src_seq: torch.Tensor, src_len: torch.Tensor) -> torch.Tensor:
+        # src_seq : (batch_size, x_seq_len), in any length order
+        # src_len : (batch_size)
+        batch_size = src_seq.size(0)
+        h_0 = torch.zeros(self.n_enc_layers * 2, batch_size, self.d_model, device=src_seq.device)
+        x_in_emb = self.src_emb(src_seq)
+        packed = pack_padded_sequence(x_in_emb, src_len.cpu(), batch_first=True, enforce_sorted=False)
+        top_layer, _ = self.enc_rnn(packed, h_0)
+        out, _ = pad_packed_sequence(top_layer, batch_first=True)
+        return out.contiguous() # (batch_size, x_seq_len, d_ctx)
+
+    @torch.jit.export
+    def init_state(self, h_in: torch.Tensor, h_in_len: torch.Tensor) \
+            -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        batch_size, x_seq_len = h_in.size(0), h_in.size(1)
+        steps = torch.arange(x_seq_len, device=h_in.device)
+        xmask = steps[None, :] >= h_in_len[:, None]
+
+        s_0 = torch.sum(h_in, 1) / h_in_len.to(h_in.dtype)[:, None]
+        s_0 = self.ctx_to_s0(s_0)
+        s_0 = s_0.view(batch_size, self.n_layers, self.d_model).transpose(0, 1).contiguous()
+
+        ctx_h = h_in
+        if self.attn_type != 'dot':
+            ctx_h = self.h_to_ctx(h_in.view(batch_size * x_seq_len, self.d_ctx)).view(batch_size, x_seq_len, self.d_ctx)
+        return ctx_h, xmask, s_0
+
+    @torch.jit.export
+    def step(self, h_in: torch.Tensor, ctx_h: torch.Tensor, xmask: torch.Tensor,
+             s_tm1: torch.Tensor, y_t: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        # y_t : (batch_size), returns the logits (batch_size, vocab_size) and s_t
+        batch_size = h_in.size(0)
+        y_in_emb = self.tgt_emb(y_t)
+
+        ctx_s_t_ = s_tm1.transpose(0, 1).contiguous().view(batch_size, self.n_layers * self.d_model)
+        ctx_ys = self.y_to_ctx(y_in_emb) + self.s_to_ctx(ctx_s_t_)
+        if self.attn_window > 0:
+            c_t = self.attend_local(h_in, ctx_h, xmask, ctx_s_t_, ctx_ys)
+        else:
+            if self.attn_type == 'additive':
+                ctx = torch.tanh(ctx_ys[:, None, :] + ctx_h)
+                score = self.ctx_to_score(ctx).view(batch_size, -1)
+            else:
+                score = torch.bmm(ctx_ys[:, None, :], ctx_h.transpose(1, 2)).view(batch_size, -1)
+            score = score.masked_fill(xmask, -float('inf'))
+            score = F.softmax(score, dim=1)
+            c_t = torch.bmm(score[:, None, :], h_in).view(batch_size, self.d_ctx)
+
+        out, s_t = self.dec_rnn(torch.cat((c_t[:, None, :], y_in_emb[:, None, :]), dim=2), s_tm1)
+
+        fin = torch.tanh(self.y_to_fin(y_in_emb) + self.c_to_fin(c_t) + self.s_to_fin(out.view(batch_size, self.d_model)))
+        return self.fin_to_voc(fin), s_t
+
+    def attend_local(self, h_in: torch.Tensor, ctx_h: torch.Tensor, xmask: torch.Tensor,
+                     ctx_s_t_: torch.Tensor, ctx_ys: torch.Tensor) -> torch.Tensor:
+        # Decoder.attend_local with one hypothesis per sentence
+        batch_size, x_seq_len = h_in.size(0), h_in.size(1)
+        n_win = 2 * self.attn_window + 1
+        h_in_len = (~xmask).long().sum(1)
+
+        p_t = torch.sigmoid(self.pos_to_p(torch.tanh(self.s_to_pos(ctx_s_t_)))).view(batch_size)
+        p_t = p_t * h_in_len.to(p_t.dtype)
+        center = torch.min(p_t.detach().floor().long(), h_in_len - 1)
+        pos = center[:, None] + torch.arange(-self.attn_window, self.attn_window + 1, device=h_in.device)
+        wmask = pos.lt(0) | pos.ge(h_in_len[:, None])
+        pos = pos.clamp(0, x_seq_len - 1)
+
+        idx = pos[:, :, None].expand(batch_size, n_win, self.d_ctx)
+        h_win = h_in.gather(1, idx)
+        ctx_win = ctx_h.gather(1, idx)
+
+        if self.attn_type == 'additive':
+            score = self.ctx_to_score(torch.tanh(ctx_ys[:, None, :] + ctx_win)).view(batch_size, n_win)
+        else:
+            score = torch.bmm(ctx_win, ctx_ys[:, :, None]).view(batch_size, n_win)
+        score = F.softmax(score.masked_fill(wmask, -float('inf')), dim=1)
+        dist = pos.to(p_t.dtype) - p_t[:, None]
+        score = score * torch.exp(-2.0 * dist * dist / float(self.attn_window ** 2))
+
+        return torch.bmm(score[:, None, :], h_win).view(batch_size, self.d_ctx)
+
+    def forward(self, src_seq: torch.Tensor, src_len: torch.Tensor, max_len: int) \
+            -> Tuple[torch.Tensor, torch.Tensor]:
+        # Greedy decoding, returns the word indices (batch_size, max_len), padded
+        # after <EOS>, and the hypothesis lengths (batch_size), without <EOS>.
+        if max_len <= 0:
+            max_len = self.n_max_seq
+        h_in = self.encode(src_seq, src_len)
+        ctx_h, xmask, s_tm1 = self.init_state(h_in, src_len)
+        batch_size = src_seq.size(0)
+
+        y_t = torch.full([batch_size], Constants.BOS, dtype=torch.long, device=src_seq.device)
+        gen_idx = torch.full([batch_size, max_len], Constants.PAD, dtype=torch.long, device=src_seq.device)
+        gen_len = torch.full([batch_size], max_len, dtype=torch.long, device=src_seq.device)
+        done = torch.zeros([batch_size], dtype=torch.bool, device=src_seq.device)
+
+        for idx in range(max_len):
+            logit, s_tm1 = self.step(h_in, ctx_h, xmask, s_tm1, y_t)
+            y_t = logit.argmax(1)
+            eos = y_t.eq(Constants.EOS) & ~done
+            gen_len = torch.where(eos, torch.full_like(gen_len, idx), gen_len)
+            done = done | eos
+            gen_idx[:, idx] = y_t.masked_fill(done, Constants.PAD)
+            if bool(done.all()):
+                break
+
+        return gen_idx, gen_len
+
+def script_model(model):
+    ''' torch.jit.script a NMTmodelRNN (in eval mode) '''
+    model.eval()
+    return torch.jit.script(ScriptableNMT(model))
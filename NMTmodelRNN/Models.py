@@ -1,4 +1,5 @@
 ''' Define the NMTmodelRNN model '''
+import copy
 import torch
 import torch.nn as nn
 import numpy as np
@@ -12,6 +13,8 @@ from torch.nn.utils.rnn import pad_packed_sequence as unpack
 
 __author__ = "Yu-Hsiang Huang"
 
+ATTN_TYPES = ['additive', 'general', 'dot']
+
 def position_encoding_init(n_position, d_pos_vec):
     ''' Init the sinusoid position encoding table '''
 
@@ -71,8 +74,8 @@ class Encoder(nn.Module):
         x_in_emb = self.emb(x_in) # (batch_size, x_seq_len, D_emb)
         x_in_emb = self.drop(x_in_emb)
 
-        # Lengths data is wrapped inside a Variable.
-        x_in_lens = x_in_lens.data.view(-1).tolist()
+        # pack_padded_sequence wants the lengths on the CPU
+        x_in_lens = x_in_lens.data.view(-1).cpu()
         pack = torch.nn.utils.rnn.pack_padded_sequence(x_in_emb, x_in_lens, batch_first=True)
 
         # input (batch_size, x_seq_len, D_emb)
@@ -87,20 +90,90 @@ class Encoder(nn.Module):
 
 
 def xlen_to_mask_rnn(x_len, tt):
-    batch_size = len(x_len)
-    maxlen = max(x_len)
-    ans = tt.ByteTensor(batch_size, maxlen).fill_(1)
-    for idx in range(batch_size):
-        ans[idx][:x_len[idx]] = 0
+    x_len = tt.LongTensor(x_len)
+    steps = tt.LongTensor(range(int(x_len.max())))
+    ans = steps[None, :] >= x_len[:, None]
     return ans
-    # (batch_size, x_seq_len)
+    # (batch_size, x_seq_len), True on padding positions
+
+class DecoderState(object):
+    ''' Decoder state of a batch of sentences, each with n_beam hypotheses.
+
+    The source side (h_in, its h_to_ctx projection and the mask) is kept once per
+    sentence, the recurrent state once per hypothesis. A state is never modified
+    in place, so it can be cached and resumed from.
+
+    With a shortlist, the output layer is restricted to the target words
+    shortlist, whose fin_to_voc rows are voc_weight.
+    '''
+
+    def __init__(self, h_in, h_in_len, ctx_h, xmask, s_tm1, n_beam=1,
+                 shortlist=None, voc_weight=None):
+        self.h_in = h_in # (batch_size, x_seq_len, d_ctx)
+        self.h_in_len = h_in_len # (batch_size)
+        self.ctx_h = ctx_h # (batch_size, x_seq_len, d_ctx)
+        self.xmask = xmask # (batch_size, x_seq_len)
+        self.s_tm1 = s_tm1 # (n_layers, batch_size * n_beam, d_model)
+        self.n_beam = n_beam
+        self.shortlist = shortlist # (n_shortlist)
+        self.voc_weight = voc_weight # (n_shortlist, d_word_vec)
+
+    @property
+    def batch_size(self):
+        return self.h_in.size(0)
+
+    @property
+    def n_hyp(self):
+        return self.s_tm1.size(1)
+
+    def _replace(self, **fields):
+        state = copy.copy(self)
+        state.__dict__.update(fields)
+        return state
+
+    def update(self, s_t):
+        ''' New state after one step '''
+        return self._replace(s_tm1=s_t)
+
+    def expand_beams(self, beam_size):
+        ''' Copy the recurrent state of each sentence into beam_size hypotheses '''
+        assert self.n_beam == 1
+        n_layers, batch_size, d_model = self.s_tm1.size()
+        s_tm1 = self.s_tm1[:,:,None,:].expand(n_layers, batch_size, beam_size, d_model)
+        s_tm1 = s_tm1.contiguous().view(n_layers, batch_size * beam_size, d_model)
+        return self._replace(s_tm1=s_tm1, n_beam=beam_size)
+
+    def reorder_hyps(self, hyp_idx):
+        ''' Select the hypotheses hyp_idx, in (batch_size * n_beam) indexing '''
+        return self.update(self.s_tm1.index_select(1, hyp_idx))
+
+    def index_select(self, sent_idx):
+        ''' Keep only the sentences sent_idx (and all their hypotheses) '''
+        h_in_len = self.h_in_len[sent_idx]
+        # drop the source positions which are padding for all the kept sentences
+        x_seq_len = int(h_in_len.max())
+        hyp_idx = sent_idx
+        if self.n_beam > 1:
+            hyp_idx = (sent_idx[:,None] * self.n_beam + sent_idx.new(range(self.n_beam))[None,:]).view(-1)
+        return self._replace(
+            h_in=self.h_in[sent_idx, :x_seq_len], h_in_len=h_in_len,
+            ctx_h=self.ctx_h[sent_idx, :x_seq_len], xmask=self.xmask[sent_idx, :x_seq_len],
+            s_tm1=self.s_tm1.index_select(1, hyp_idx))
+
+    def to_vocab(self, word_idx):
+        ''' Map output indices (in the shortlist) back to target word indices '''
+        if self.shortlist is None:
+            return word_idx
+        return self.shortlist[word_idx]
 
 class Decoder(nn.Module):
     # Base recurrent attention-based decoder class.
     def __init__(
              self, n_tgt_vocab, n_max_seq, n_layers=2,
-             d_word_vec=512, d_model=512, dropout=0.5, proj_share_weight=True, cuda=False):
+             d_word_vec=512, d_model=512, dropout=0.5, proj_share_weight=True,
+             attn_type='additive', attn_window=0, cuda=False):
         super(Decoder, self).__init__()
+        assert attn_type in ATTN_TYPES
         self.tt = torch.cuda if cuda else torch
         d_ctx = d_model*2
 
@@ -114,8 +187,17 @@ class Decoder(nn.Module):
 
         self.y_to_ctx = nn.Linear(d_word_vec, d_ctx)
         self.s_to_ctx = nn.Linear(d_model * n_layers, d_ctx)
-        self.h_to_ctx = nn.Linear(d_ctx, d_ctx)
-        self.ctx_to_score = nn.Linear(d_ctx, 1)
+        # additive: score = ctx_to_score(tanh(ctx_y + ctx_s + h_to_ctx(h)))
+        # general: score = (ctx_y + ctx_s) . h_to_ctx(h)
+        # dot: score = (ctx_y + ctx_s) . h
+        if attn_type != 'dot':
+            self.h_to_ctx = nn.Linear(d_ctx, d_ctx)
+        if attn_type == 'additive':
+            self.ctx_to_score = nn.Linear(d_ctx, 1)
+        if attn_window:
+            # local attention: p_t = x_len * sigmoid(pos_to_p(tanh(s_to_pos(s_tm1))))
+            self.s_to_pos = nn.Linear(d_model * n_layers, d_model)
+            self.pos_to_p = nn.Linear(d_model, 1, bias=False)
 
         self.y_to_fin = nn.Linear(d_word_vec, d_word_vec)
         self.c_to_fin = nn.Linear(d_ctx, d_word_vec)
@@ -133,157 +215,314 @@ class Decoder(nn.Module):
         self.n_tgt_vocab = n_tgt_vocab
         self.d_word_vec = d_word_vec
         self.n_max_seq = n_max_seq
+        self.attn_type = attn_type
+        self.attn_window = attn_window
 
-    def forward(self, h_in, h_in_len, y_in):
+    def init_state(self, h_in, h_in_len, shortlist=None):
         # h_in : (batch_size, x_seq_len, d_ctx)
         # h_in_len : (batch_size)
-        # y_in : (batch_size, y_seq_len)
-        batch_size, y_seq_len = y_in.size()
-        x_seq_len = h_in.size()[1]
+        # shortlist : (n_shortlist), optional sorted candidate target words
+        batch_size, x_seq_len = h_in.size()[0], h_in.size()[1]
         h_in_len = h_in_len.data.view(-1)
         xmask = xlen_to_mask_rnn(h_in_len.tolist(), self.tt) # (batch_size, x_seq_len)
 
-        #import ipdb; ipdb.set_trace()
-
         s_0 = torch.sum(h_in, 1) # (batch_size, D_hid_enc * num_dir_enc)
         s_0 = torch.div( s_0, Variable(self.tt.FloatTensor(h_in_len.tolist()).view(-1,1)) )
-        s_0 = self.ctx_to_s0(s_0)
-        s_tm1 = s_0 # (batch_size, n_layers * d_model)
-        s_tm1 = s_tm1.view(batch_size, self.n_layers, self.d_model).transpose(0,1).contiguous() \
+        s_0 = self.ctx_to_s0(s_0) # (batch_size, n_layers * d_model)
+        s_0 = s_0.view(batch_size, self.n_layers, self.d_model).transpose(0,1).contiguous() \
                 # (n_layers, batch_size, d_model)
 
+        h_in = h_in.contiguous()
+        if self.attn_type == 'dot':
+            ctx_h = h_in
+        else:
+            h_in_big = h_in.view(batch_size * x_seq_len, self.d_ctx) \
+                    # (batch_size * x_seq_len, d_ctx)
+            ctx_h = self.h_to_ctx( h_in_big ).view(batch_size, x_seq_len, self.d_ctx)
+                    # (batch_size, x_seq_len, d_ctx)
+
+        voc_weight = None
+        if shortlist is not None:
+            voc_weight = self.fin_to_voc.weight
+            if callable(voc_weight): # dynamically quantized Linear
+                voc_weight = voc_weight().dequantize()
+            voc_weight = voc_weight.index_select(0, shortlist) # (n_shortlist, d_word_vec)
+
+        return DecoderState(h_in, h_in_len, ctx_h, xmask, s_0,
+                            shortlist=shortlist, voc_weight=voc_weight)
+
+    def attend(self, state, ctx_y, y_in_emb):
+        # One recurrence step, shared by forward, step and the searches.
+        # ctx_y : (n_hyp, d_ctx), y_to_ctx of the input word
+        # y_in_emb : (n_hyp, d_word_vec)
+        batch_size, n_beam, n_hyp = state.batch_size, state.n_beam, state.n_hyp
+        s_tm1 = state.s_tm1 # (n_layers, n_hyp, d_model)
+
+        ctx_s_t_ = s_tm1.transpose(0,1).contiguous().view(n_hyp, self.n_layers * self.d_model) \
+                # (n_hyp, n_layers * d_model)
+        ctx_ys = ( ctx_y + self.s_to_ctx( ctx_s_t_ ) ).view(batch_size, n_beam, self.d_ctx)
+        if self.attn_window:
+            c_t = self.attend_local(state, ctx_ys, ctx_s_t_)
+        else:
+            c_t = self.attend_global(state, ctx_ys)
+
+        out, s_t = self.rnn( torch.cat((c_t[:,None,:], y_in_emb[:,None,:]), dim=2), s_tm1 )
+        # out (n_hyp, 1, d_model)
+        # s_t (n_layers, n_hyp, d_model)
+
+        return c_t, out.view(n_hyp, self.d_model), state.update(s_t)
+
+    def attend_global(self, state, ctx_ys):
+        # ctx_ys : (batch_size, n_beam, d_ctx), query of every hypothesis
+        batch_size, n_beam = ctx_ys.size()[0], ctx_ys.size()[1]
+        x_seq_len = state.h_in.size(1)
+
+        # the hypotheses of a sentence share its ctx_h
+        if self.attn_type == 'additive':
+            ctx = F.tanh( ctx_ys[:,:,None,:] + state.ctx_h[:,None,:,:] ) # (batch_size, n_beam, x_seq_len, d_ctx)
+            score = self.ctx_to_score(ctx).view(batch_size, n_beam, x_seq_len)
+        else:
+            score = torch.bmm( ctx_ys, state.ctx_h.transpose(1,2) ) # (batch_size, n_beam, x_seq_len)
+        score = score.masked_fill(state.xmask[:,None,:], -float('inf'))
+        score = F.softmax(score, dim=2) # (batch_size, n_beam, x_seq_len)
+
+        return torch.bmm( score, state.h_in ).view(-1, self.d_ctx) # (n_hyp, d_ctx)
+
+    def attend_local(self, state, ctx_ys, ctx_s_t_):
+        # Local attention (Luong et al., 2015, local-p): only the 2 * attn_window + 1
+        # source positions around a predicted alignment point p_t are scored, so the
+        # cost of a step does not depend on the source length.
+        # ctx_ys : (batch_size, n_beam, d_ctx)
+        # ctx_s_t_ : (n_hyp, n_layers * d_model)
+        batch_size, n_beam = ctx_ys.size()[0], ctx_ys.size()[1]
+        x_seq_len = state.h_in.size(1)
+        n_win = 2 * self.attn_window + 1
+
+        x_len = state.h_in_len.float()[:,None] # (batch_size, 1)
+        p_t = F.sigmoid( self.pos_to_p( F.tanh( self.s_to_pos( ctx_s_t_ ) ) ) ).view(batch_size, n_beam)
+        p_t = p_t * x_len # (batch_size, n_beam), in [0, x_len]
+
+        center = torch.min( p_t.data.floor().long(), state.h_in_len[:,None] - 1 )
+        offsets = torch.arange(-self.attn_window, self.attn_window + 1, device=center.device)
+        pos = center[:,:,None] + offsets # (batch_size, n_beam, n_win)
+        wmask = pos.lt(0) | pos.ge(state.h_in_len[:,None,None])
+        pos = pos.clamp(0, x_seq_len - 1).view(batch_size, n_beam * n_win, 1)
+
+        def window(x): # (batch_size, x_seq_len, d_ctx) -> (batch_size, n_beam, n_win, d_ctx)
+            return x.gather(1, pos.expand(batch_size, n_beam * n_win, self.d_ctx)) \
+                    .view(batch_size, n_beam, n_win, self.d_ctx)
+        h_win = window(state.h_in)
+        ctx_win = window(state.ctx_h)
+
+        if self.attn_type == 'additive':
+            ctx = F.tanh( ctx_ys[:,:,None,:] + ctx_win ) # (batch_size, n_beam, n_win, d_ctx)
+            score = self.ctx_to_score(ctx).view(batch_size, n_beam, n_win)
+        else:
+            score = torch.matmul( ctx_win, ctx_ys[:,:,:,None] ).view(batch_size, n_beam, n_win)
+        score = score.masked_fill(wmask, -float('inf'))
+        score = F.softmax(score, dim=2) # (batch_size, n_beam, n_win)
+
+        # favour the positions close to p_t, sigma = attn_window / 2
+        dist = pos.view(batch_size, n_beam, n_win).float() - p_t[:,:,None]
+        score = score * torch.exp( -2.0 * dist * dist / (self.attn_window ** 2) )
+
+        return torch.matmul( score[:,:,None,:], h_win ).view(-1, self.d_ctx) # (n_hyp, d_ctx)
+
+    def step(self, state, y_t):
+        # y_t : (n_hyp), input word of every hypothesis
+        # returns the logits of the next word (n_hyp, vocab_size) and the new state,
+        # with a shortlist the logits are over the shortlist only (n_hyp, n_shortlist)
+        y_in_emb = self.emb( Variable( y_t ) ) # (n_hyp, d_word_vec)
+        c_t, out, state = self.attend(state, self.y_to_ctx( y_in_emb ), y_in_emb)
+
+        fin_y = self.y_to_fin( y_in_emb ) # (n_hyp, d_word_vec)
+        fin_c = self.c_to_fin( c_t ) # (n_hyp, d_word_vec)
+        fin_s = self.s_to_fin( out ) # (n_hyp, d_word_vec)
+        fin = F.tanh( fin_y + fin_c + fin_s )
+
+        if state.voc_weight is not None:
+            logit = F.linear( fin, state.voc_weight ) # (n_hyp, n_shortlist)
+        else:
+            logit = self.fin_to_voc( fin ) # (n_hyp, vocab_size)
+        return logit, state
+
+    def advance(self, state, y_in):
+        # Feed a (batch_size * n_beam, y_seq_len) block of words, e.g. a confirmed prefix.
+        for idx in range(y_in.size(1)):
+            _, state = self.step(state, y_in[:,idx].contiguous())
+        return state
+
+    def forward(self, h_in, h_in_len, y_in, return_hidden=False):
+        # h_in : (batch_size, x_seq_len, d_ctx)
+        # h_in_len : (batch_size)
+        # y_in : (batch_size, y_seq_len)
+        # Teacher forcing: everything which only depends on y_in is computed for all
+        # the timesteps before the loop, and everything which does not feed back into
+        # the recurrence (c_to_fin, s_to_fin, fin_to_voc) after it.
+        # With return_hidden, the input of fin_to_voc is returned instead of the logits,
+        # for losses which do their own output projection.
+        batch_size, y_seq_len = y_in.size()
+        state = self.init_state(h_in, h_in_len)
+
         y_in_emb = self.emb(y_in) # (batch_size, y_seq_len, d_word_vec)
         y_in_emb = self.drop(y_in_emb) # (batch_size, y_seq_len, d_word_vec)
 
-        h_in_big = h_in.view(-1, self.d_ctx) \
-                # (batch_size * x_seq_len, d_ctx) 
+        if callable(self.y_to_ctx.weight): # dynamically quantized Linear, int8 weights
+            ctx_y_all = self.y_to_ctx( y_in_emb ) # (batch_size, y_seq_len, d_ctx)
+            fin_y_all = self.y_to_fin( y_in_emb ) # (batch_size, y_seq_len, d_word_vec)
+        else:
+            # y_to_ctx and y_to_fin in one GEMM over all the timesteps
+            y_proj = F.linear( y_in_emb,
+                               torch.cat((self.y_to_ctx.weight, self.y_to_fin.weight), 0),
+                               torch.cat((self.y_to_ctx.bias, self.y_to_fin.bias), 0) )
+            ctx_y_all = y_proj[:,:,:self.d_ctx] # (batch_size, y_seq_len, d_ctx)
+            fin_y_all = y_proj[:,:,self.d_ctx:] # (batch_size, y_seq_len, d_word_vec)
+
+        c_all = h_in.new(batch_size, y_seq_len, self.d_ctx) # (batch_size, y_seq_len, d_ctx)
+        out_all = h_in.new(batch_size, y_seq_len, self.d_model) # (batch_size, y_seq_len, d_model)
+        for idx in range(y_seq_len):
+            c_t, out, state = self.attend(state, ctx_y_all[:,idx,:], y_in_emb[:,idx,:])
+            c_all[:,idx,:] = c_t
+            out_all[:,idx,:] = out
+
+        fin_c = self.c_to_fin( c_all ) # (batch_size, y_seq_len, d_word_vec)
+        fin_s = self.s_to_fin( out_all ) # (batch_size, y_seq_len, d_word_vec)
+        fin = F.tanh( fin_y_all + fin_c + fin_s )
 
-        ctx_h = self.h_to_ctx( h_in_big ).view(batch_size, x_seq_len, self.d_ctx)
-                # (batch_size, x_seq_len, d_ctx)
+        fin = fin.view(batch_size * y_seq_len, self.d_word_vec)
+        if return_hidden:
+            return fin # (batch_size * y_seq_len, d_word_vec)
 
-        logits = []
-        for idx in range(y_seq_len):
-            ctx_s_t_ = s_tm1.transpose(0,1).contiguous().view(batch_size, -1) \
-                    # (batch_size, d_model * n_layers)
-
-            ctx_y = self.y_to_ctx( y_in_emb[:,idx,:] )[:,None,:] # (batch_size, 1, d_ctx)
-            ctx_s = self.s_to_ctx( ctx_s_t_ )[:,None,:]
-            ctx = F.tanh(ctx_y + ctx_s + ctx_h) # (batch_size, x_seq_len, d_ctx)
-            ctx = ctx.view(-1, self.d_ctx) # (batch_size * x_seq_len, d_ctx)
-
-            score = self.ctx_to_score(ctx).view(batch_size, -1) # (batch_size, x_seq_len)
-            score.data.masked_fill_(xmask, -float('inf'))
-            score = F.softmax(score, dim=1)
-            score = score[:,:,None] # (batch_size, x_seq_len, 1)
-
-            c_t = torch.mul( h_in, score ) # (batch_size, x_seq_len, d_ctx)
-            c_t = torch.sum( c_t, 1) # (batch_size, d_ctx)
-            # in (batch_size, 1, d_ctx)
-            # s_t (n_layers, batch_size, d_model)
-            out, s_t = self.rnn( torch.cat((c_t[:,None,:], y_in_emb[:,idx,:][:,None,:]), dim=2), s_tm1 )
-            ####################################################
-            #s_t = self.rnn( torch.cat((c_t, y_in_emb[:,idx,:]), dim=1), s_tm1[0] )
-            #s_t = self.drop(s_t)
-            #out = s_t[:,None,:]
-            #s_t = s_t[None,:,:]
-            ####################################################
-            # out (batch_size, 1, d_model)
-            # s_t (n_layers, batch_size, d_model)
-
-            fin_y = self.y_to_fin( y_in_emb[:,idx,:] ) # (batch_size, d_word_vec)
-            fin_c = self.c_to_fin( c_t ) # (batch_size, d_word_vec)
-            fin_s = self.s_to_fin( out.view(-1, self.d_model) ) # (batch_size, d_word_vec)
-            fin = F.tanh( fin_y + fin_c + fin_s )
-            s_tm1 = s_t
-
-            logit = self.fin_to_voc( fin ) # (batch_size, vocab_size)
-            logits.append( logit )
-            # logits : list of (batch_size, vocab_size) vectors
-
-        ans = torch.cat(logits, 0) # (y_seq_len * batch_size, vocab_size)
-        ans = ans.view(y_seq_len, batch_size, self.n_tgt_vocab).transpose(0,1).contiguous()
-        return ans.view(batch_size * y_seq_len, -1)
-
-    def greedy_search(self, h_in, h_in_len):
+        ans = self.fin_to_voc( fin )
+        return ans # (batch_size * y_seq_len, vocab_size)
+
+    def greedy_search(self, h_in, h_in_len, max_len_ratio=None, shortlist=None):
         # h_in : (batch_size, x_seq_len, d_ctx)
         # h_in_len : (batch_size)
-        h_in_len = h_in_len.data.view(-1).tolist()
-        #import ipdb; ipdb.set_trace()
-        batch_size, x_seq_len = h_in.size()[0], h_in.size()[1]
-        xmask = xlen_to_mask_rnn(h_in_len, self.tt) # (batch_size, x_seq_len)
-
-        s_tm1 = torch.sum(h_in, 1) # (batch_size, d_ctx)
-        s_tm1 = torch.div( s_tm1, Variable(self.tt.FloatTensor(h_in_len).view(batch_size, 1)) )
-        s_tm1= self.ctx_to_s0(s_tm1)
-        s_tm1 = s_tm1.view(batch_size, self.n_layers, self.d_model).transpose(0,1).contiguous() \
-                # (n_layers, batch_size, d_model)
-
-        start = [2 for ii in range(batch_size)] # NOTE <BOS> is always 2
-        ft = self.tt.LongTensor(start)[:,None] # (batch_size, 1)
-        y_in_emb = self.emb( Variable( ft ) ) # (batch_size, 1, d_word_vec)
-
-        h_in_big = h_in.contiguous().view(batch_size * x_seq_len, self.d_ctx ) \
-                # (batch_size * x_seq_len, D_hid_enc * num_dir_enc) 
-        ctx_h = self.h_to_ctx( h_in_big ).view(batch_size, x_seq_len, self.d_ctx)
-
-        gen_idx = [[] for ii in range(batch_size)]
-        done = np.array( [False for ii in range(batch_size)] )
-
-        for idx in range(self.n_max_seq):
-            # in (batch_size, 1, d_word_vec)
-            # s_t (n_layers, batch_size, d_model)
-            #_, s_t_ = self.rnn1( y_in_emb, s_t )
-
-            ctx_s_t_ = s_tm1.transpose(0,1).contiguous().view(batch_size, self.n_layers * self.d_model) \
-                    # (batch_size, n_layers * d_model)
-
-            ctx_y = self.y_to_ctx( y_in_emb.view(batch_size, self.d_word_vec) )[:,None,:]
-            ctx_s = self.s_to_ctx( ctx_s_t_ )[:,None,:]
-            ctx = F.tanh(ctx_y + ctx_s + ctx_h)
-            ctx = ctx.view(batch_size * x_seq_len, self.d_ctx)
-
-            score = self.ctx_to_score(ctx).view(batch_size, -1) # (batch_size, x_seq_len)
-            score.data.masked_fill_(xmask, -float('inf'))
-            score = F.softmax(score, dim=1)
-            score = score[:,:,None] # (batch_size, x_seq_len, 1)
-
-            c_t = torch.mul( h_in, score ) # (batch_size, x_seq_len, d_ctx)
-            c_t = torch.sum( c_t, 1) # (batch_size, d_ctx)
-            # in (batch_size, 1, d_ctx)
-            # s_t (n_layers, batch_size, d_model)
-            out, s_t = self.rnn( torch.cat((c_t[:,None,:], y_in_emb[:,0,:][:,None,:]), dim=2), s_tm1 )
-            ####################################################
-            #s_t = self.rnn(torch.cat((c_t, y_in_emb[:,0,:]), dim=1), s_tm1[0] )
-            #s_t = self.drop(s_t)
-            #out = s_t[:,None,:]
-            #s_t = s_t[None,:,:]
-            ####################################################
-            # out (batch_size, 1, d_model)
-            # s_t (n_layers, batch_size, d_model)
-
-            fin_y = self.y_to_fin( y_in_emb.view(batch_size, self.d_word_vec) ) # (batch_size, d_word_vec)
-            fin_c = self.c_to_fin( c_t ) # (batch_size, d_word_vec)
-            fin_s = self.s_to_fin( out.view(batch_size, self.d_model) ) # (batch_size, d_word_vec)
-            fin = F.tanh( fin_y + fin_c + fin_s )
-
-            logit = self.fin_to_voc( fin ) # (batch_size, vocab_size)
-            topv, topi = logit.data.topk(1)
-            top1 = topi.view(batch_size).cpu().numpy()
-
-            for ii in range(batch_size):
-                if top1[ii] == 3: # NOTE <EOS> is always 3
-                    done[ii] = True
-                if not done[ii]:
-                    gen_idx[ii].append( top1[ii].item() ) # use .item() to convert numpy.int64 to int
-
-            if np.array_equal( done, np.array( [True for x in range(batch_size) ] ) ):
+        state = self.init_state(h_in, h_in_len, shortlist=shortlist)
+        y_t = self.tt.LongTensor(state.batch_size).fill_(Constants.BOS)
+        return self.greedy_continue(state, y_t, max_len_ratio=max_len_ratio)
+
+    def greedy_continue(self, state, y_t, max_len=None, max_len_ratio=None, prefix_len=0):
+        # state : DecoderState with one hypothesis per sentence
+        # y_t : (batch_size), next input word (<BOS>, or the last word of a prefix)
+        # Finished sentences are removed from the active batch, so that each step
+        # only runs on the sentences which did not emit <EOS> yet.
+        # max_len_ratio caps the length of each hypothesis to max_len_ratio * source length;
+        # the prefix_len words already decoded count towards it (at least one step is left).
+        assert state.n_beam == 1
+        batch_size = state.batch_size
+        max_len = max_len or self.n_max_seq
+
+        sent_max_len = self.tt.LongTensor(batch_size).fill_(max_len)
+        if max_len_ratio:
+            ratio_len = (state.h_in_len.float() * max_len_ratio).ceil().long() - prefix_len
+            sent_max_len = torch.min(sent_max_len, ratio_len.clamp(min=1))
+
+        gen_idx = self.tt.LongTensor(batch_size, max_len).fill_(Constants.PAD)
+        gen_len = self.tt.LongTensor(batch_size).zero_()
+        active = self.tt.LongTensor(range(batch_size)) # rows of gen_idx still being decoded
+
+        for idx in range(max_len):
+            logit, state = self.step(state, y_t) # (n_active, vocab_size)
+            y_t = state.to_vocab( logit.data.max(1)[1] ) # (n_active)
+            gen_idx[active, idx] = y_t
+
+            # <EOS> is not part of the hypothesis, the length cap is
+            eos = y_t.eq(Constants.EOS)
+            done = eos | sent_max_len[active].le(idx + 1)
+            gen_len[active] = idx + 1 - eos.long()
+
+            if done.any():
+                keep = (~done).nonzero().view(-1)
+                if keep.numel() == 0:
+                    break
+                active = active[keep]
+                y_t = y_t[keep]
+                state = state.index_select(keep)
+
+        gen_idx = gen_idx.tolist()
+        gen_len = gen_len.tolist()
+        return [gen_idx[ii][:gen_len[ii]] for ii in range(batch_size)]
+
+    def beam_search(self, h_in, h_in_len, beam_size=5, n_best=1, alpha=1.0, max_len=None, shortlist=None):
+        # h_in : (batch_size, x_seq_len, d_ctx)
+        # h_in_len : (batch_size)
+        # All the hypotheses of all the sentences live in one (batch_size * beam_size) batch,
+        # while h_in and ctx_h are kept once per sentence and broadcast over the beams.
+        # Finished hypotheses are scored with a length normalization logp / len**alpha.
+        assert n_best <= beam_size
+        state = self.init_state(h_in, h_in_len, shortlist=shortlist).expand_beams(beam_size)
+        batch_size = state.batch_size
+        n_hyp = batch_size * beam_size
+        max_len = max_len or self.n_max_seq
+
+        y_t = self.tt.LongTensor(n_hyp).fill_(Constants.BOS) # (batch_size * beam_size)
+        beam_offset = self.tt.LongTensor(range(batch_size))[:,None] * beam_size # (batch_size, 1)
+
+        # alive hypotheses: only the first beam of each sentence is live at the start
+        alive_seq = self.tt.LongTensor(batch_size, beam_size, max_len).fill_(Constants.PAD)
+        alive_logp = self.tt.FloatTensor(batch_size, beam_size).fill_(-float('inf'))
+        alive_logp[:,0] = 0
+        # finished hypotheses, sorted by normalized score
+        fin_seq = self.tt.LongTensor(batch_size, beam_size, max_len).fill_(Constants.PAD)
+        fin_score = self.tt.FloatTensor(batch_size, beam_size).fill_(-float('inf'))
+        fin_len = self.tt.LongTensor(batch_size, beam_size).zero_()
+
+        for idx in range(max_len):
+            logit, state = self.step(state, y_t)
+            logp = F.log_softmax( logit, dim=1 ).data # (batch_size * beam_size, vocab_size)
+            n_voc = logp.size(1)
+            cand_logp = alive_logp[:,:,None] + logp.view(batch_size, beam_size, n_voc)
+            cand_logp = cand_logp.view(batch_size, beam_size * n_voc)
+
+            # 2 * beam_size candidates guarantee beam_size of them do not end with <EOS>
+            top_logp, top_idx = cand_logp.topk(2 * beam_size, dim=1) # (batch_size, 2 * beam_size)
+            top_beam = top_idx // n_voc
+            top_word = state.to_vocab( top_idx % n_voc )
+            top_seq = alive_seq.gather(1, top_beam[:,:,None].expand(batch_size, 2 * beam_size, max_len))
+            top_seq[:,:,idx] = top_word
+            top_eos = top_word.eq(Constants.EOS)
+
+            # hypotheses ending with <EOS> compete with the already finished ones
+            new_score = (top_logp / float(idx + 1) ** alpha).masked_fill(~top_eos, -float('inf'))
+            fin_score, fin_sel = torch.cat((fin_score, new_score), 1).topk(beam_size, dim=1)
+            fin_seq = torch.cat((fin_seq, top_seq), 1) \
+                    .gather(1, fin_sel[:,:,None].expand(batch_size, beam_size, max_len))
+            fin_len = torch.cat((fin_len, self.tt.LongTensor(batch_size, 2 * beam_size).fill_(idx)), 1) \
+                    .gather(1, fin_sel)
+
+            # the others stay alive
+            alive_logp, alive_sel = top_logp.masked_fill(top_eos, -float('inf')).topk(beam_size, dim=1)
+            alive_seq = top_seq.gather(1, alive_sel[:,:,None].expand(batch_size, beam_size, max_len))
+            hyp_origin = (top_beam.gather(1, alive_sel) + beam_offset).view(-1) # (batch_size * beam_size)
+            y_t = top_word.gather(1, alive_sel).view(-1)
+            state = state.reorder_hyps(hyp_origin)
+
+            # stop when no alive hypothesis can beat the n_best-th finished one
+            best_alive = alive_logp[:,0] / float(max_len) ** alpha
+            if (fin_score[:,n_best-1] >= best_alive).all():
                 break
 
-            y_in_emb = self.emb( Variable( topi ) )
-            s_tm1 = s_t
+        # alive hypotheses (without <EOS>) are kept as candidates for the sentences
+        # which did not finish enough hypotheses before max_len
+        alive_score = alive_logp / float(idx + 1) ** alpha
+        all_score, all_sel = torch.cat((fin_score, alive_score), 1).topk(n_best, dim=1)
+        all_seq = torch.cat((fin_seq, alive_seq), 1) \
+                .gather(1, all_sel[:,:,None].expand(batch_size, n_best, max_len))
+        all_len = torch.cat((fin_len, self.tt.LongTensor(batch_size, beam_size).fill_(idx + 1)), 1) \
+                .gather(1, all_sel)
+
+        all_seq = all_seq.tolist()
+        all_len = all_len.tolist()
+        all_hyp = [[all_seq[ii][kk][:all_len[ii][kk]] for kk in range(n_best)] for ii in range(batch_size)]
+        return all_hyp, all_score.tolist()
 
-        return gen_idx
 
+def quantize_dynamic(model):
+    ''' Dynamic int8 quantization of the Linear and GRU layers, for CPU inference '''
+    # in place: the modules hold a reference to the torch module (tt), which cannot be deep-copied
+    return torch.quantization.quantize_dynamic(model, {nn.Linear, nn.GRU}, dtype=torch.qint8, inplace=True)
 
 #class NMTmodel(nn.Module):
 class NMTmodelRNN(nn.Module):
@@ -292,7 +531,8 @@ class NMTmodelRNN(nn.Module):
     def __init__(
             self, n_src_vocab, n_tgt_vocab, n_max_seq, n_layers=2,
             d_word_vec=512, d_model=512,
-            dropout=0.1, proj_share_weight=True, embs_share_weight=True, cuda=False):
+            dropout=0.1, proj_share_weight=True, embs_share_weight=True,
+            attn_type='additive', attn_window=0, cuda=False):
 
         self.n_layers = n_layers
 
@@ -306,7 +546,8 @@ class NMTmodelRNN(nn.Module):
         self.decoder = Decoder(
             n_tgt_vocab, n_max_seq, n_layers=n_layers,
             d_word_vec=d_word_vec, d_model=d_model,
-            dropout=dropout, proj_share_weight = proj_share_weight, cuda=cuda)
+            dropout=dropout, proj_share_weight = proj_share_weight,
+            attn_type=attn_type, attn_window=attn_window, cuda=cuda)
 
 
         if embs_share_weight:
@@ -327,20 +568,17 @@ class NMTmodelRNN(nn.Module):
     #         freezed_param_ids = enc_freezed_param_ids | dec_freezed_param_ids
     #     return (p for p in self.parameters() if id(p) not in freezed_param_ids)
 
-    def forward(self, src, tgt):
-        # src_seq and src_pos: sent_len * batch_size
-        src_seq, src_pos = src
-        tgt_seq, tgt_pos = tgt
+    def forward(self, src, tgt, return_hidden=False):
+        # src_seq : (batch_size, x_seq_len), sorted by decreasing length
+        # src_len : (batch_size)
+        src_seq, lengths_seq_src = src
+        tgt_seq, _ = tgt
 
         tgt_seq = tgt_seq[:, :-1]
-        tgt_pos = tgt_pos[:, :-1]
-        
-        lengths_seq_src, idx_src = src_pos.max(1)
-        #lengths_seq_tgt, idx_tgt = tgt_pos.max(1)
 
         enc_output = self.encoder(src_seq, lengths_seq_src)
         
-        dec_output = self.decoder(enc_output, lengths_seq_src, tgt_seq)
+        dec_output = self.decoder(enc_output, lengths_seq_src, tgt_seq, return_hidden=return_hidden)
 
         #import ipdb; ipdb.set_trace()
 
@@ -37,6 +37,10 @@ class ScheduledOptim(object):
         "Zero out the gradients by the inner optimizer"
         self.optimizer.zero_grad()
 
+    def get_learning_rate(self):
+        ''' Current learning rate (of the first parameter group) '''
+        return self.optimizer.param_groups[0]['lr']
+
     def update_learning_rate(self):
         ''' Learning rate scheduling per step '''
 
@@ -0,0 +1,28 @@
+''' Candidate target vocabulary for faster decoding '''
+import torch
+import NMTmodelRNN.Constants as Constants
+
+class Shortlist(object):
+    ''' Per-batch candidate target vocabulary: the n_frequent most frequent target
+    words plus the n_translations best translations of each source word of the
+    batch, from the lexical table built by preprocess.py -lex_size. '''
+
+    def __init__(self, lex, n_frequent=1000, n_translations=20, cuda=False):
+        self.tt = torch.cuda if cuda else torch
+
+        src_to_tgt = torch.from_numpy(lex['src_to_tgt'][:, :n_translations]).long()
+        # PAD stays a candidate: the full projection normalizes over it as well, so a
+        # shortlist covering the vocabulary decodes exactly like the full output layer
+        specials = torch.LongTensor([Constants.PAD, Constants.UNK, Constants.BOS, Constants.EOS])
+        frequent = torch.cat((specials, torch.from_numpy(lex['tgt_by_freq'][:n_frequent]).long()))
+
+        if cuda:
+            src_to_tgt = src_to_tgt.cuda()
+            frequent = frequent.cuda()
+        self.src_to_tgt = src_to_tgt # (src_vocab_size, n_translations)
+        self.frequent = frequent
+
+    def build(self, src_seq):
+        ''' Sorted target word indices for the source batch src_seq '''
+        candidates = self.src_to_tgt.index_select(0, src_seq.data.view(-1)).view(-1)
+        return torch.unique(torch.cat((self.frequent, candidates)), sorted=True)
@@ -0,0 +1,181 @@
+''' This module will handle the text generation with beam search. '''
+
+from collections import OrderedDict
+
+import torch
+
+import NMTmodelRNN.Constants as Constants
+from NMTmodelRNN.Models import NMTmodelRNN, quantize_dynamic
+
+def load_model(path, cuda=False):
+    ''' NMTmodelRNN of a checkpoint, in eval mode, and the checkpoint '''
+
+    if cuda:
+        checkpoint = torch.load(path, weights_only=False)
+    else:
+        checkpoint = torch.load(path, map_location=lambda storage, loc: storage, weights_only=False)
+    model = model_from_checkpoint(checkpoint, cuda)
+    print('[Info] Trained model state loaded.')
+
+    return model, checkpoint
+
+def model_from_checkpoint(checkpoint, cuda=False):
+    ''' NMTmodelRNN of a loaded checkpoint, in eval mode '''
+    model_opt = checkpoint['settings']
+
+    model = NMTmodelRNN(
+        model_opt.src_vocab_size,
+        model_opt.tgt_vocab_size,
+        model_opt.max_token_seq_len,
+        proj_share_weight=model_opt.proj_share_weight,
+        embs_share_weight=model_opt.embs_share_weight,
+        attn_type=getattr(model_opt, 'attn_type', 'additive'),
+        attn_window=getattr(model_opt, 'attn_window', 0),
+        d_model=model_opt.d_model,
+        d_word_vec=model_opt.d_word_vec,
+        n_layers=model_opt.n_layers,
+        dropout=model_opt.dropout,
+        cuda=cuda)
+
+    if checkpoint.get('quantized'):
+        # written by quantize.py, the quantized layers only run on CPU
+        assert not cuda, 'Quantized models only run on CPU (-no_cuda)'
+        model = quantize_dynamic(model)
+
+    model.load_state_dict(checkpoint['model'])
+
+    if cuda:
+        model = model.cuda()
+    model.eval()
+
+    return model
+
+class Translator(object):
+    ''' Load with trained model and handle the beam search '''
+
+    def __init__(self, opt, cache=None, shortlist=None):
+        self.opt = opt
+        self.tt = torch.cuda if opt.cuda else torch
+        self.cache = cache # optional TranslationCache
+        self.shortlist = shortlist # optional Shortlist
+
+        self.model, checkpoint = load_model(opt.model, opt.cuda)
+        self.model_opt = checkpoint['settings']
+
+    def translate_batch(self, src_batch):
+        ''' Translation work in one batch '''
+
+        # Batch size is in different location depending on data.
+        src_seq, lengths_seq_src = src_batch
+
+        # with a shortlist, the translation of a sentence depends on the other sentences
+        # of its batch, whose source words make the candidate vocabulary: not cached
+        if self.cache is None or self.shortlist is not None:
+            return self._translate(src_seq, lengths_seq_src)
+
+        settings = (self.opt.beam_size, self.opt.n_best, self.opt.alpha)
+        lengths = lengths_seq_src.data.view(-1).tolist()
+        keys = [self.cache.key(seq[:length], settings)
+                for seq, length in zip(src_seq.data.tolist(), lengths)]
+
+        # identical sentences of the batch are translated once
+        results = {}
+        miss_idx = []
+        for idx, key in enumerate(keys):
+            if key in results:
+                self.cache.hits += 1
+                continue
+            results[key] = self.cache.get(key)
+            if results[key] is None:
+                miss_idx.append(idx)
+
+        if miss_idx:
+            miss_len = max(lengths[idx] for idx in miss_idx)
+            miss_idx_tensor = self.tt.LongTensor(miss_idx)
+            all_hyp, all_scores = self._translate(
+                src_seq[miss_idx_tensor, :miss_len], lengths_seq_src[miss_idx_tensor])
+            for idx, hyps, scores in zip(miss_idx, all_hyp, all_scores):
+                results[keys[idx]] = (hyps, scores)
+                self.cache.put(keys[idx], (hyps, scores))
+
+        all_hyp = [results[key][0] for key in keys]
+        all_scores = [results[key][1] for key in keys]
+        return all_hyp, all_scores
+
+    def _translate(self, src_seq, lengths_seq_src):
+        # pack_padded_sequence needs the sentences sorted by decreasing length
+        _, sent_sort_idx = lengths_seq_src.sort(descending=True)
+
+        shortlist = None
+        if self.shortlist is not None:
+            shortlist = self.shortlist.build(src_seq)
+
+        with torch.no_grad():
+            enc_output = self.model.encoder(src_seq[sent_sort_idx], lengths_seq_src[sent_sort_idx])
+            all_hyp, all_scores = self.model.decoder.beam_search(
+                enc_output, lengths_seq_src[sent_sort_idx],
+                beam_size=self.opt.beam_size, n_best=self.opt.n_best, alpha=self.opt.alpha,
+                shortlist=shortlist)
+
+        _, sent_revert_idx = sent_sort_idx.sort()
+        sent_revert_idx = sent_revert_idx.data.view(-1).tolist()
+        all_hyp = [all_hyp[idx] for idx in sent_revert_idx]
+        all_scores = [all_scores[idx] for idx in sent_revert_idx]
+
+        return all_hyp, all_scores
+
+class PrefixCompleter(object):
+    ''' Greedy completion of a confirmed target prefix, for interactive translation.
+
+    The decoder state reached for each (source, prefix) is kept in a LRU cache, so
+    that when the prefix grows only the new words are fed to the decoder, and the
+    encoder runs once per source sentence.
+    '''
+
+    def __init__(self, model, cache_size=64, max_len_ratio=None):
+        self.model = model
+        self.tt = model.decoder.tt
+        self.cache_size = cache_size
+        self.max_len_ratio = max_len_ratio
+        self._states = OrderedDict()
+
+    def _lookup(self, src, prefix):
+        ''' Longest cached prefix of prefix for this source '''
+        for k in range(len(prefix), -1, -1):
+            key = (src, prefix[:k])
+            if key in self._states:
+                self._states.move_to_end(key)
+                return k, self._states[key]
+        return 0, None
+
+    def _store(self, key, state):
+        self._states[key] = state
+        if len(self._states) > self.cache_size:
+            self._states.popitem(last=False)
+
+    def complete(self, src_idx, prefix_idx):
+        ''' Word indices completing prefix_idx, the translation of src_idx '''
+        src, prefix = tuple(src_idx), tuple(prefix_idx)
+        decoder = self.model.decoder
+
+        # the state cached for a prefix P has been fed ([<BOS>] + P)[:-1]
+        y_in = [Constants.BOS] + list(prefix)
+
+        with torch.no_grad():
+            k, state = self._lookup(src, prefix)
+            if state is None:
+                src_seq = self.tt.LongTensor([src_idx])
+                src_len = self.tt.LongTensor([len(src_idx)])
+                enc_output = self.model.encoder(src_seq, src_len)
+                state = decoder.init_state(enc_output, src_len)
+                self._store((src, ()), state)
+
+            if k < len(prefix):
+                state = decoder.advance(state, self.tt.LongTensor([y_in[k:len(prefix)]]))
+                self._store((src, prefix), state)
+
+            max_len = max(1, decoder.n_max_seq - len(prefix))
+            hyp = decoder.greedy_continue(state, self.tt.LongTensor(y_in[-1:]),
+                                          max_len=max_len, max_len_ratio=self.max_len_ratio,
+                                          prefix_len=len(prefix))
+        return hyp[0]
@@ -1,7 +1,12 @@
+import NMTmodelRNN.Bleu
+import NMTmodelRNN.Cache
 import NMTmodelRNN.Constants
+import NMTmodelRNN.Export
 import NMTmodelRNN.Models
 import NMTmodelRNN.Optim
+import NMTmodelRNN.Shortlist
+import NMTmodelRNN.Translator
 
 __all__ = [
-    NMTmodelRNN.Constants, NMTmodelRNN.Models,
-    NMTmodelRNN.Optim]
+    NMTmodelRNN.Bleu, NMTmodelRNN.Cache, NMTmodelRNN.Constants, NMTmodelRNN.Export,
+    NMTmodelRNN.Models, NMTmodelRNN.Optim, NMTmodelRNN.Shortlist, NMTmodelRNN.Translator]
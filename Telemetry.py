@@ -0,0 +1,119 @@
+''' Step-level training telemetry, written as JSON lines '''
+import json
+import time
+import resource
+import torch
+from NMTmodelRNN.Optim import ScheduledOptim
+
+PHASES = ['data', 'forward', 'backward', 'step', 'save', 'log']
+
+def peak_rss_mb():
+    ''' Peak resident set size of this process, in MB (ru_maxrss is in KB on Linux) '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def learning_rate(optimizer):
+    if isinstance(optimizer, ScheduledOptim):
+        return optimizer.get_learning_rate()
+    return optimizer.param_groups[0]['lr']
+
+class StepTelemetry(object):
+    ''' Time the phases of the training steps and write one JSON record every `every` steps.
+
+    phase(name) charges the time since the previous call to the phase name: call it
+    after each phase of the step, then end_step() with the batch, which charges the
+    bookkeeping since the last phase (loss and accuracy sums, logging) to 'log'. The
+    time spent in DataLoader.next (or waiting for a PrefetchLoader) is the time from
+    end_step() to the 'data' call of the next step. With cuda, the phases synchronize
+    the device so that the kernels are charged to the phase which launched them.
+
+    Every record has the rates over its interval of steps (source and target tokens
+    without padding, sentences), the seconds and the fraction of the interval spent in
+    every phase, the padding ratio of the batches (total and worst batch), the loss
+    per word, the learning rate and the peak RSS.
+    '''
+
+    def __init__(self, path, every=100, cuda=False, info=None):
+        self.every = every
+        self.cuda = cuda
+        self.n_steps = 0
+        self._file = open(path, 'a')
+        record = {'type': 'start', 'time': time.time()}
+        record.update(info or {})
+        self._write(record)
+        self.reset()
+
+    def reset(self):
+        ''' Start a new interval from now, e.g. at the start of an epoch '''
+        self._interval_start = self._last = time.perf_counter()
+        self._n_interval = 0
+        self._phase_time = dict.fromkeys(PHASES, 0.0)
+        self._src_tokens = self._tgt_tokens = 0
+        self._src_slots = self._tgt_slots = 0
+        self._sents = 0
+        self._max_pad_ratio = 0.0
+        self._loss = 0.0
+        self._words = 0
+
+    def _write(self, record):
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+    def phase(self, name):
+        if self.cuda:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self._phase_time[name] += now - self._last
+        self._last = now
+
+    def end_step(self, src, tgt, loss, n_words, optimizer, epoch_i):
+        ''' Account the batch (src, tgt) of the step, its summed loss and its number of target words.
+        epoch_i is the (fractional) number of epochs done. '''
+        self.n_steps += 1
+        self._n_interval += 1
+
+        src_tokens = src[1].sum().item()
+        tgt_tokens = tgt[1].sum().item()
+        src_slots, tgt_slots = src[0].numel(), tgt[0].numel()
+        self._src_tokens += src_tokens
+        self._tgt_tokens += tgt_tokens
+        self._src_slots += src_slots
+        self._tgt_slots += tgt_slots
+        self._sents += src[0].size(0)
+        pad_ratio = 1.0 - (src_tokens + tgt_tokens) / max(src_slots + tgt_slots, 1)
+        self._max_pad_ratio = max(self._max_pad_ratio, pad_ratio)
+        self._loss += loss
+        self._words += n_words
+        self.phase('log')
+
+        if self._n_interval >= self.every:
+            self.flush(optimizer, epoch_i)
+
+    def flush(self, optimizer, epoch_i):
+        ''' Write the record of the steps since the last one '''
+        if self._n_interval == 0:
+            self.reset()
+            return
+        elapsed = max(time.perf_counter() - self._interval_start, 1e-9)
+        record = {
+            'type': 'step',
+            'time': time.time(),
+            'step': self.n_steps,
+            'steps': self._n_interval,
+            'epoch': epoch_i,
+            'elapsed_s': elapsed,
+            'src_tok_per_s': self._src_tokens / elapsed,
+            'tgt_tok_per_s': self._tgt_tokens / elapsed,
+            'sent_per_s': self._sents / elapsed,
+            'pad_ratio': 1.0 - (self._src_tokens + self._tgt_tokens) / max(self._src_slots + self._tgt_slots, 1),
+            'pad_ratio_max': self._max_pad_ratio,
+            'loss_per_word': self._loss / max(self._words, 1),
+            'lr': learning_rate(optimizer),
+            'peak_rss_mb': peak_rss_mb()}
+        for name in PHASES:
+            record[name + '_s'] = self._phase_time[name]
+            record[name + '_frac'] = self._phase_time[name] / elapsed
+        self._write(record)
+        self.reset()
+
+    def close(self):
+        self._file.close()
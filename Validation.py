@@ -0,0 +1,152 @@
+''' BLEU validation of the checkpoints, in the training process or in a worker process '''
+import os
+import queue
+import torch
+import torch.multiprocessing as mp
+from tqdm import tqdm
+import NMTmodelRNN.Constants as Constants
+from NMTmodelRNN.Bleu import BleuScorer, load_reference
+from NMTmodelRNN.Translator import model_from_checkpoint
+from DataLoader import DataLoader
+
+def translate_dev(model_translate, validation_data_translate, opt, model_name, epoch_i, disable_tqdm=False):
+    ''' Greedy translation of the dev set into model_name.output.dev and its BLEU, appended to
+    bleu_scores.txt. Return the printed line and the BleuScore (None without a reference) '''
+
+    model_translate.eval()
+
+    # the BLEU statistics are accumulated as the sentences are translated,
+    # against reference n-gram counts loaded once for the whole training
+    try:
+        scorer = BleuScorer(load_reference(opt.valid_bleu_ref), merge_bpe=opt.valid_merge_bpe)
+    except IOError as e:
+        scorer = None
+        out = 'BLEU error: {}\n'.format(e)
+
+    output_name = model_name + '.output.dev'
+    with torch.no_grad(), open(output_name, 'w') as f:
+        for batch in tqdm(validation_data_translate, mininterval=2, desc='  - (Translate and BLEU)', leave=False,
+                          disable=disable_tqdm):
+            #import ipdb; ipdb.set_trace()
+            src_seq, lengths_seq_src = batch
+
+            _, sent_sort_idx = lengths_seq_src.sort(descending=True)
+
+            enc_output = model_translate.encoder(src_seq[sent_sort_idx], lengths_seq_src[sent_sort_idx])
+            all_hyp = model_translate.decoder.greedy_search(enc_output, lengths_seq_src[sent_sort_idx],
+                                                            max_len_ratio=opt.max_len_ratio)
+
+            _, sent_revert_idx = sent_sort_idx.sort()
+            sent_revert_idx = sent_revert_idx.data.view(-1).tolist()
+            all_hyp = [all_hyp[idx] for idx in sent_revert_idx]
+
+            #import ipdb; ipdb.set_trace()
+            for idx_seq in all_hyp:
+                if idx_seq and idx_seq[-1] == Constants.EOS: # if last word is EOS
+                    idx_seq = idx_seq[:-1]
+                pred_line = ' '.join([validation_data_translate.tgt_idx2word[idx] for idx in idx_seq])
+                f.write(pred_line + '\n')
+                if scorer is not None:
+                    scorer.add(pred_line)
+
+    score = None
+    if scorer is not None:
+        score = scorer.score()
+        out = str(score) + '\n' # as printed by multi-bleu.perl
+
+    bleu_file = os.path.dirname(model_name) + '/bleu_scores.txt'
+    with open(bleu_file, 'a') as f:
+        f.write("Epoch "+str(epoch_i)+": "+out)
+
+    return out, score
+
+def validation_worker(jobs, results, opt, src_insts, src_word2idx, tgt_word2idx, n_threads):
+    ''' Process of a ValidationWorker: translate and score the model snapshots of jobs '''
+    torch.set_num_threads(n_threads)
+
+    validation_data_translate = DataLoader(
+        src_word2idx,
+        tgt_word2idx,
+        src_insts=src_insts,
+        tgt_insts=None,
+        ctx_insts=None,
+        batch_size=opt.batch_size,
+        shuffle=False,
+        cuda=False,
+        is_train=False,
+        sort_by_length=False)
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        model_state_dict, model_name, epoch_i = job
+        model = model_from_checkpoint({'model': model_state_dict, 'settings': opt}, cuda=False)
+        out, score = translate_dev(model, validation_data_translate, opt, model_name, epoch_i, disable_tqdm=True)
+        results.put((model_name, epoch_i, out, score))
+
+class ValidationWorker(object):
+    ''' Translate and score the dev set in a separate process with n_threads threads,
+    on CPU, while the training goes on.
+
+    submit() hands over a CPU snapshot of the weights; at most one snapshot waits
+    while another is translated, beyond that submit() blocks. The finished validations
+    are collected with poll() (without waiting) and close() (waiting for all of them),
+    as (model_name, epoch_i, printed line, BleuScore) tuples. If the worker process
+    dies, submit() raises RuntimeError instead of waiting for it. '''
+
+    def __init__(self, opt, src_insts, src_word2idx, tgt_word2idx, n_threads=1):
+        # fork is unsafe once the training threads are running
+        ctx = mp.get_context('spawn')
+        self._jobs = ctx.Queue(maxsize=1)
+        self._results = ctx.Queue()
+        self._n_pending = 0
+        self._process = ctx.Process(
+            target=validation_worker,
+            args=(self._jobs, self._results, opt, list(src_insts), src_word2idx, tgt_word2idx, n_threads))
+        self._process.daemon = True
+        self._process.start()
+
+    def _put(self, job):
+        # a dead worker never frees the slot of the queue
+        while True:
+            if not self._process.is_alive():
+                raise RuntimeError('The validation worker died with exit code {}'.format(self._process.exitcode))
+            try:
+                self._jobs.put(job, timeout=1.0)
+                return
+            except queue.Full:
+                continue
+
+    def submit(self, model_state_dict, model_name, epoch_i):
+        self._put((model_state_dict, model_name, epoch_i))
+        self._n_pending += 1
+
+    def poll(self):
+        finished = []
+        while self._n_pending > 0:
+            try:
+                finished.append(self._results.get_nowait())
+            except queue.Empty:
+                break
+            self._n_pending -= 1
+        return finished
+
+    def close(self):
+        finished = []
+        while self._n_pending > 0:
+            try:
+                finished.append(self._results.get(timeout=1.0))
+            except queue.Empty:
+                if not self._process.is_alive():
+                    print('[Warning] The validation worker died with exit code {}, {} validation(s) lost.'.format(
+                        self._process.exitcode, self._n_pending))
+                    break
+                continue
+            self._n_pending -= 1
+        try:
+            self._put(None)
+        except RuntimeError:
+            pass
+        self._process.join()
+        return finished
@@ -0,0 +1,85 @@
+''' Epoch-boundary cost of DataLoader.shuffle: time and peak RSS of the former
+zip/unzip shuffle of the instance lists, and of the index permutation.
+
+    python benchmarks/bench_shuffle.py -n_sents 2000000
+'''
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import subprocess
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from DataLoader import DataLoader
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def current_rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2.0**20
+
+def synthetic_corpus(n_sents, vocab_size, max_len, seed=0):
+    # sentence by sentence, so that building the corpus does not set the peak RSS
+    rng = np.random.RandomState(seed)
+    return [[rng.randint(4, vocab_size, size=rng.randint(3, max_len)).tolist() for _ in range(n_sents)]
+            for _ in range(2)]
+
+def zip_shuffle(src_insts, tgt_insts):
+    # DataLoader.shuffle before the index permutation
+    paired_insts = list(zip(src_insts, tgt_insts))
+    random.shuffle(paired_insts)
+    return zip(*paired_insts)
+
+def run(mode, opt):
+    ''' Time opt.epochs shuffles in this process '''
+    src_insts, tgt_insts = synthetic_corpus(opt.n_sents, opt.vocab_size, opt.max_len)
+    vocab = {str(i): i for i in range(opt.vocab_size)}
+    loader = DataLoader(vocab, vocab, src_insts=src_insts, tgt_insts=tgt_insts,
+                        cuda=False, batch_size=64, shuffle=False)
+    rss_before = current_rss_mb()
+
+    times = []
+    for _ in range(opt.epochs):
+        start = time.time()
+        if mode == 'zip':
+            src_insts, tgt_insts = zip_shuffle(src_insts, tgt_insts)
+        else:
+            loader.shuffle()
+        times.append(time.time() - start)
+
+    return {'mode': mode, 'n_sents': opt.n_sents,
+            'shuffle_s': float(np.median(times)),
+            'peak_rss_mb': peak_rss_mb(),
+            'peak_rss_increase_mb': peak_rss_mb() - rss_before}
+
+def main():
+    parser = argparse.ArgumentParser(description='bench_shuffle.py')
+    parser.add_argument('-n_sents', type=int, default=1000000)
+    parser.add_argument('-vocab_size', type=int, default=30000)
+    parser.add_argument('-max_len', type=int, default=50)
+    parser.add_argument('-epochs', type=int, default=3)
+    parser.add_argument('-mode', choices=['zip', 'index'], default=None,
+                        help='Run a single mode in this process (default: both, each in its own process)')
+    opt = parser.parse_args()
+
+    if opt.mode:
+        print(json.dumps(run(opt.mode, opt)))
+        return
+
+    # one process per mode, so that the peak RSS of one does not hide the other
+    for mode in ['zip', 'index']:
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '-mode', mode,
+                                       '-n_sents', str(opt.n_sents), '-vocab_size', str(opt.vocab_size),
+                                       '-max_len', str(opt.max_len), '-epochs', str(opt.epochs)])
+        result = json.loads(out.decode().strip().splitlines()[-1])
+        print('{mode:>5}: shuffle {shuffle_s:.3f} s, peak RSS {peak_rss_mb:.0f} MB '
+              '(+{peak_rss_increase_mb:.0f} MB at the epoch boundaries)'.format(**result))
+
+if __name__ == '__main__':
+    main()
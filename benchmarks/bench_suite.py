@@ -0,0 +1,242 @@
+''' CPU benchmarks of the hot paths of NMTmodelRNN/Models.py and DataLoader.py, on synthetic
+vocabularies and corpora, over a grid of batch sizes, sequence lengths, d_model and vocab sizes.
+
+    python benchmarks/bench_suite.py -output base.json
+    # ... change NMTmodelRNN/Models.py ...
+    python benchmarks/bench_suite.py -output new.json -baseline base.json
+
+Every result is the median (and min) time of -repeat runs after -warmup runs. With
+-baseline, the times are compared with those of the same benchmark and settings in
+the baseline file, and the exit status is 1 if one is slower by more than -tolerance.
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import itertools
+import subprocess
+from argparse import Namespace
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import NMTmodelRNN.Constants as Constants
+from NMTmodelRNN.Models import NMTmodelRNN
+from DataLoader import DataLoader
+from train import MainModel
+
+BENCHMARKS = ['encoder', 'decoder', 'greedy', 'train_step', 'dataloader']
+# the settings which identify a result, for the comparison with a baseline
+KEY = ['bench', 'batch_size', 'seq_len', 'd_model', 'vocab_size']
+
+def synthetic_batch(batch_size, seq_len, vocab_size, rng, bos_eos=False):
+    ''' (seq, lengths) of random sentences of seq_len/2 to seq_len words, sorted by decreasing length '''
+    lengths = np.sort(rng.randint(max(seq_len // 2, 1), seq_len + 1, size=batch_size))[::-1]
+    if bos_eos:
+        lengths = lengths + 2
+    seq = np.full((batch_size, lengths[0]), Constants.PAD, dtype=np.int64)
+    for i, length in enumerate(lengths):
+        seq[i, :length] = rng.randint(4, vocab_size, size=length)
+        if bos_eos:
+            seq[i, 0], seq[i, length - 1] = Constants.BOS, Constants.EOS
+    return torch.from_numpy(seq), torch.from_numpy(lengths.copy())
+
+def synthetic_corpus(n_sents, seq_len, vocab_size, rng):
+    return [rng.randint(4, vocab_size, size=rng.randint(max(seq_len // 2, 1), seq_len + 1)).tolist()
+            for _ in range(n_sents)]
+
+def time_it(fn, warmup, repeat):
+    ''' Median and min seconds of fn() '''
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times)), float(np.min(times))
+
+def bench_model(bench, batch_size, seq_len, d_model, vocab_size, opt):
+    ''' Time one model benchmark, return (median s, min s, tokens per run) '''
+    torch.manual_seed(opt.seed)
+    rng = np.random.RandomState(opt.seed)
+    model = NMTmodelRNN(vocab_size, vocab_size, seq_len + 2, n_layers=1,
+                        d_word_vec=d_model, d_model=d_model, dropout=0.1,
+                        proj_share_weight=False, embs_share_weight=False, cuda=False)
+    src = synthetic_batch(batch_size, seq_len, vocab_size, rng)
+    tgt = synthetic_batch(batch_size, seq_len, vocab_size, rng, bos_eos=True)
+    src_tokens, tgt_tokens = int(src[1].sum()), int(tgt[1].sum())
+
+    if bench == 'encoder':
+        model.eval()
+        def run():
+            with torch.no_grad():
+                model.encoder(*src)
+        return time_it(run, opt.warmup, opt.repeat) + (src_tokens,)
+
+    if bench == 'decoder':
+        # teacher forcing
+        model.eval()
+        with torch.no_grad():
+            enc_output = model.encoder(*src)
+        def run():
+            with torch.no_grad():
+                model.decoder(enc_output, src[1], tgt[0][:, :-1])
+        return time_it(run, opt.warmup, opt.repeat) + (tgt_tokens,)
+
+    if bench == 'greedy':
+        model.eval()
+        with torch.no_grad():
+            enc_output = model.encoder(*src)
+        n_generated = []
+        def run():
+            with torch.no_grad():
+                all_hyp = model.decoder.greedy_search(enc_output, src[1], max_len_ratio=1.0)
+            n_generated.append(sum(len(hyp) for hyp in all_hyp))
+        result = time_it(run, opt.warmup, opt.repeat)
+        return result + (n_generated[-1],)
+
+    if bench == 'train_step':
+        weight = torch.ones(vocab_size)
+        weight[Constants.PAD] = 0
+        crit = nn.CrossEntropyLoss(weight, reduction='sum', ignore_index=Constants.PAD)
+        main_model = MainModel(model, crit, Namespace(sampled_softmax=0, loss_chunk_size=0, smoothing=False))
+        main_model.train()
+        optimizer = optim.Adam(main_model.parameters(), lr=1e-4, betas=(0.9, 0.98), eps=1e-09)
+        def run():
+            optimizer.zero_grad()
+            loss, _ = main_model(src, tgt)
+            loss.backward()
+            optimizer.step()
+        return time_it(run, opt.warmup, opt.repeat) + (src_tokens + tgt_tokens,)
+
+    raise ValueError(bench)
+
+def bench_dataloader(batch_size, seq_len, vocab_size, opt):
+    ''' Time DataLoader.next over a shuffled, length-sorted training epoch; per batch '''
+    rng = np.random.RandomState(opt.seed)
+    src_insts = synthetic_corpus(opt.n_sents, seq_len, vocab_size, rng)
+    tgt_insts = [[Constants.BOS] + inst + [Constants.EOS] for inst in synthetic_corpus(opt.n_sents, seq_len, vocab_size, rng)]
+    vocab = {str(i): i for i in range(vocab_size)}
+    loader = DataLoader(vocab, vocab, src_insts=src_insts, tgt_insts=tgt_insts,
+                        cuda=False, batch_size=batch_size, is_train=True, sort_by_length=True,
+                        seed=opt.seed)
+    n_batches = len(loader)
+    n_tokens = sum(len(inst) for inst in src_insts) + sum(len(inst) for inst in tgt_insts)
+
+    def run():
+        for _ in loader:
+            pass
+    median_s, min_s = time_it(run, opt.warmup, opt.repeat)
+    return median_s / n_batches, min_s / n_batches, n_tokens / n_batches
+
+def run_suite(opt):
+    results = []
+    grid = itertools.product(opt.batch_sizes, opt.seq_lens, opt.d_models, opt.vocab_sizes)
+    done = set()
+    for batch_size, seq_len, d_model, vocab_size in grid:
+        for bench in opt.benchmarks:
+            # the dataloader does not depend on d_model
+            key = (bench, batch_size, seq_len, None if bench == 'dataloader' else d_model, vocab_size)
+            if key in done:
+                continue
+            done.add(key)
+
+            if bench == 'dataloader':
+                median_s, min_s, n_tokens = bench_dataloader(batch_size, seq_len, vocab_size, opt)
+            else:
+                median_s, min_s, n_tokens = bench_model(bench, batch_size, seq_len, d_model, vocab_size, opt)
+            result = dict(zip(KEY, key))
+            result.update({'median_s': median_s, 'min_s': min_s, 'tokens': n_tokens,
+                           'tokens_per_s': n_tokens / median_s})
+            results.append(result)
+            print('{bench:>10} batch {batch_size:>4} len {seq_len:>4} d_model {d:>5} vocab {vocab_size:>6}: '
+                  '{ms:9.2f} ms (min {min_ms:9.2f}), {tokens_per_s:10.0f} tok/s'.format(
+                      d=str(result['d_model']), ms=1000 * median_s, min_ms=1000 * min_s, **result), file=sys.stderr)
+    return results
+
+def compare(results, baseline, tolerance, metric='median_s'):
+    ''' Print the time ratios to the baseline, return the regressions '''
+    base = {tuple(result[k] for k in KEY): result for result in baseline['results']}
+    regressions = []
+    print('{:<50}{:>12}{:>12}{:>9}'.format('benchmark', 'base ms', 'new ms', 'ratio'))
+    for result in results:
+        key = tuple(result[k] for k in KEY)
+        name = '{} b={} len={} d={} V={}'.format(*key)
+        if key not in base:
+            print('{:<50}{:>12}{:>12.2f}'.format(name, '-', 1000 * result[metric]))
+            continue
+        ratio = result[metric] / base[key][metric]
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  SLOWER'
+            regressions.append(name)
+        elif ratio < 1 - tolerance:
+            flag = '  faster'
+        print('{:<50}{:>12.2f}{:>12.2f}{:>9.3f}{}'.format(
+            name, 1000 * base[key][metric], 1000 * result[metric], ratio, flag))
+    return regressions
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='bench_suite.py')
+    parser.add_argument('-benchmarks', nargs='+', choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument('-batch_sizes', type=int, nargs='+', default=[16, 64])
+    parser.add_argument('-seq_lens', type=int, nargs='+', default=[20, 50])
+    parser.add_argument('-d_models', type=int, nargs='+', default=[256, 512])
+    parser.add_argument('-vocab_sizes', type=int, nargs='+', default=[8000, 30000])
+    parser.add_argument('-n_sents', type=int, default=20000,
+                        help='Size of the synthetic corpus of the dataloader benchmark')
+    parser.add_argument('-warmup', type=int, default=2)
+    parser.add_argument('-repeat', type=int, default=5)
+    parser.add_argument('-threads', type=int, default=0, help='torch threads (0: default)')
+    parser.add_argument('-seed', type=int, default=1)
+    parser.add_argument('-output', default=None, help='Write the results to this JSON file')
+    parser.add_argument('-baseline', default=None, help='JSON file of a previous run to compare with')
+    parser.add_argument('-tolerance', type=float, default=0.1,
+                        help='Relative slowdown reported as a regression')
+    parser.add_argument('-compare_on', choices=['median_s', 'min_s'], default='median_s',
+                        help='Compare the median or the min times (less sensitive to a busy machine)')
+    opt = parser.parse_args()
+
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+
+    results = run_suite(opt)
+    report = {
+        'meta': {'time': time.time(), 'commit': git_commit(), 'torch': torch.__version__,
+                 'python': platform.python_version(), 'machine': platform.machine(),
+                 'threads': torch.get_num_threads(), 'warmup': opt.warmup, 'repeat': opt.repeat,
+                 'n_sents': opt.n_sents, 'seed': opt.seed},
+        'results': results}
+
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        print(json.dumps(report))
+
+    if opt.baseline:
+        with open(opt.baseline) as f:
+            baseline = json.load(f)
+        print('[Info] Baseline: commit {}, torch {}, {} threads'.format(
+            baseline['meta'].get('commit'), baseline['meta'].get('torch'), baseline['meta'].get('threads')))
+        regressions = compare(results, baseline, opt.tolerance, opt.compare_on)
+        if regressions:
+            print('[Warning] {} benchmark(s) slower than the baseline by more than {:.0f} %'.format(
+                len(regressions), 100 * opt.tolerance))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+''' Corpus BLEU of a translation, a drop-in replacement of multi-bleu.perl:
+python bleu.py [-lc] reference [reference ...] < hypothesis '''
+
+import os
+import sys
+import argparse
+import subprocess
+from NMTmodelRNN.Bleu import BleuReference, BleuScorer, reference_files, chop_lines, merge_bpe
+
+MULTI_BLEU = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'multi-bleu.perl')
+
+def check_perl(opt, hyp_lines, out):
+    ''' Score the same input with multi-bleu.perl, return whether it prints the same line '''
+    hyp = ''.join(line + '\n' for line in hyp_lines).encode('utf-8', 'surrogateescape')
+    args = ['perl', MULTI_BLEU] + (['-lc'] if opt.lc else []) + [opt.reference] + opt.references
+    perl_out = subprocess.run(args, input=hyp, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL).stdout.decode('utf-8', 'surrogateescape')
+    if perl_out.strip() != out:
+        print('[Error] multi-bleu.perl prints: ' + perl_out.strip(), file=sys.stderr)
+        return False
+    print('[Info] Same score as multi-bleu.perl', file=sys.stderr)
+    return True
+
+def main():
+    '''Main Function'''
+
+    parser = argparse.ArgumentParser(description='bleu.py')
+
+    parser.add_argument('-lc', action='store_true',
+                        help='Lowercase the hypothesis and the references')
+    parser.add_argument('-merge_bpe', action='store_true',
+                        help="Undo the BPE segmentation ('@@ ') of the hypothesis before scoring")
+    parser.add_argument('-check_perl', action='store_true',
+                        help='Also run multi-bleu.perl and check that it prints the same score')
+    parser.add_argument('reference',
+                        help='Reference file, or the stem of reference0, reference1, ... like multi-bleu.perl')
+    parser.add_argument('references', nargs='*',
+                        help='Additional reference files')
+
+    opt = parser.parse_args()
+
+    paths = reference_files(opt.reference) + [path for path in opt.references if os.path.exists(path)]
+    reference = BleuReference.from_files(paths, lowercase=opt.lc)
+
+    hyp_lines = chop_lines(sys.stdin.buffer)
+    if opt.merge_bpe:
+        hyp_lines = [merge_bpe(line) for line in hyp_lines]
+
+    scorer = BleuScorer(reference)
+    for line in hyp_lines:
+        scorer.add(line)
+    score = scorer.score()
+    out = str(score)
+    print(out)
+
+    if opt.check_perl and not check_perl(opt, hyp_lines, out):
+        sys.exit(2)
+    if score.ref_len == 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+''' Compare the speed and BLEU of a fp32 model and its quantized version on a dev set. '''
+
+import os
+import time
+import argparse
+import tempfile
+from argparse import Namespace
+
+import torch
+from DataLoader import DataLoader
+from Dataset import load_data
+from NMTmodelRNN.Translator import Translator
+from NMTmodelRNN.Bleu import corpus_bleu, load_reference, merge_bpe
+from preprocess import read_instances_from_file, convert_instance_to_idx_seq
+
+def translate_file(opt, model_path, test_data, output_name):
+    ''' Translate test_data with model_path, return the elapsed seconds and the BleuScore '''
+
+    translator_opt = Namespace(model=model_path, cuda=False, beam_size=opt.beam_size, n_best=1, alpha=opt.alpha)
+    translator = Translator(translator_opt)
+
+    pred_lines = []
+    start = time.time()
+    with open(output_name, 'w') as f:
+        for batch in test_data:
+            all_hyp, _ = translator.translate_batch(batch)
+            for idx_seqs in all_hyp:
+                pred_line = ' '.join([test_data.tgt_idx2word[idx] for idx in idx_seqs[0]])
+                if opt.bpe:
+                    pred_line = merge_bpe(pred_line)
+                f.write(pred_line + '\n')
+                pred_lines.append(pred_line)
+    elapse = time.time() - start
+
+    return elapse, corpus_bleu(pred_lines, load_reference(opt.ref))
+
+def main():
+    '''Main Function'''
+
+    parser = argparse.ArgumentParser(description='compare_quantized.py')
+
+    parser.add_argument('-model', required=True, help='Path to the fp32 .chkpt file')
+    parser.add_argument('-quantized', required=True, help='Path to the model written by quantize.py')
+    parser.add_argument('-vocab', required=True, help='Data that contains the source vocabulary')
+    parser.add_argument('-src', required=True, help='Source side of the dev set')
+    parser.add_argument('-ref', required=True, help='Reference of the dev set')
+    parser.add_argument('-output', default=None,
+                        help='Prefix of the translation files (default: in a new temporary directory)')
+    parser.add_argument('-beam_size', type=int, default=5)
+    parser.add_argument('-alpha', type=float, default=1.0)
+    parser.add_argument('-batch_size', type=int, default=36)
+    parser.add_argument('-n_threads', type=int, default=0, help='torch threads (0: default)')
+    parser.add_argument('-bpe', action='store_true', help='Merge the BPE units (@@) before BLEU')
+    parser.add_argument('-max_token_seq_len', type=int, default=500)
+
+    opt = parser.parse_args()
+    if opt.output is None:
+        opt.output = os.path.join(tempfile.mkdtemp(prefix='compare_quantized.'), 'compare')
+    if opt.n_threads > 0:
+        torch.set_num_threads(opt.n_threads)
+
+    preprocess_data = load_data(opt.vocab)
+    src_word_insts = read_instances_from_file(
+        opt.src, opt.max_token_seq_len, preprocess_data['settings'].keep_case)
+    src_insts = convert_instance_to_idx_seq(src_word_insts, preprocess_data['dict']['src'])
+
+    results = {}
+    for name, model_path in [('fp32', opt.model), ('int8', opt.quantized)]:
+        test_data = DataLoader(
+            preprocess_data['dict']['src'],
+            preprocess_data['dict']['tgt'],
+            src_insts=src_insts,
+            cuda=False,
+            shuffle=False,
+            batch_size=opt.batch_size,
+            is_train=False)
+        results[name] = translate_file(opt, model_path, test_data, opt.output + '.' + name)
+
+    print('[Info] Translations written to {}.fp32 and {}.int8'.format(opt.output, opt.output))
+    for name in ['fp32', 'int8']:
+        elapse, score = results[name]
+        print('{}: {:.2f} s, {:.1f} sent/s, {}'.format(
+            name, elapse, len(src_insts) / elapse, score))
+
+    print('[Info] int8 speedup: x{:.2f}, BLEU delta: {:+.2f}'.format(
+        results['fp32'][0] / results['int8'][0], 100 * (results['int8'][1].bleu - results['fp32'][1].bleu)))
+
+if __name__ == "__main__":
+    main()
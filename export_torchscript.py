@@ -0,0 +1,84 @@
+''' Export a trained model to a self-contained TorchScript file, and check it against the eager model. '''
+
+import json
+import argparse
+import torch
+import NMTmodelRNN.Constants as Constants
+from NMTmodelRNN.Export import script_model
+from NMTmodelRNN.Translator import load_model
+from Dataset import load_data
+
+def check_parity(model, scripted, n_sent=16, max_src_len=30, atol=1e-4):
+    ''' Compare the scripted encoder, decoder step and greedy decoding with the eager model
+    on random source sentences '''
+
+    n_src_vocab = model.encoder.emb.num_embeddings
+    src_len = torch.randint(3, max_src_len, (n_sent,)).sort(descending=True)[0]
+    src_seq = torch.randint(Constants.EOS + 1, n_src_vocab, (n_sent, int(src_len[0])))
+    src_seq = src_seq.masked_fill(torch.arange(int(src_len[0]))[None, :] >= src_len[:, None], Constants.PAD)
+
+    with torch.no_grad():
+        h_in = model.encoder(src_seq, src_len)
+        h_in_script = scripted.encode(src_seq, src_len)
+        assert torch.allclose(h_in, h_in_script, atol=atol), 'encoder mismatch'
+
+        state = model.decoder.init_state(h_in, src_len)
+        ctx_h, xmask, s_tm1 = scripted.init_state(h_in, src_len)
+        y_t = torch.LongTensor(n_sent).fill_(Constants.BOS)
+        for _ in range(5):
+            logit, state = model.decoder.step(state, y_t)
+            logit_script, s_tm1 = scripted.step(h_in, ctx_h, xmask, s_tm1, y_t)
+            assert torch.allclose(logit, logit_script, atol=atol), 'decoder step mismatch'
+            y_t = logit.max(1)[1]
+
+        max_len = model.decoder.n_max_seq
+        all_hyp = model.decoder.greedy_search(h_in, src_len)
+        gen_idx, gen_len = scripted(src_seq, src_len, max_len)
+        gen_idx, gen_len = gen_idx.tolist(), gen_len.tolist()
+        n_diff = sum(hyp != gen_idx[ii][:gen_len[ii]] for ii, hyp in enumerate(all_hyp))
+        assert n_diff == 0, 'greedy decoding mismatch: {}/{} hypotheses differ'.format(n_diff, n_sent)
+
+    print('[Info] Parity with the eager model: encoder, decoder step and greedy decoding match.')
+
+def main():
+    '''Main Function'''
+
+    parser = argparse.ArgumentParser(description='export_torchscript.py')
+
+    parser.add_argument('-model', required=True,
+                        help='Path to the .chkpt file written by train.py or quantize.py')
+    parser.add_argument('-output', required=True,
+                        help='Path of the TorchScript file')
+    parser.add_argument('-vocab', default=None,
+                        help='Data that contains the vocabularies, stored in the TorchScript file')
+    parser.add_argument('-no_check', action='store_true',
+                        help='Do not check the parity with the eager model')
+
+    opt = parser.parse_args()
+
+    model, checkpoint = load_model(opt.model, cuda=False)
+    model_opt = checkpoint['settings']
+    scripted = script_model(model)
+
+    # everything an inference worker needs, next to the code and the weights
+    extra_files = {'settings.json': json.dumps({
+        'src_vocab_size': model_opt.src_vocab_size,
+        'tgt_vocab_size': model_opt.tgt_vocab_size,
+        'max_token_seq_len': model_opt.max_token_seq_len,
+        'n_layers': model_opt.n_layers,
+        'd_model': model_opt.d_model,
+        'd_word_vec': model_opt.d_word_vec,
+        'quantized': bool(checkpoint.get('quantized'))})}
+    if opt.vocab:
+        vocab = load_data(opt.vocab)
+        extra_files['src_word2idx.json'] = json.dumps(vocab['dict']['src'])
+        extra_files['tgt_word2idx.json'] = json.dumps(vocab['dict']['tgt'])
+
+    if not opt.no_check:
+        check_parity(model, scripted)
+
+    torch.jit.save(scripted, opt.output, _extra_files=extra_files)
+    print('[Info] TorchScript model saved to', opt.output)
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,13 @@
 ''' Handling the data io '''
+import os
 import argparse
+import itertools
+import collections
+import multiprocessing
 import torch
-import transformer.Constants as Constants
+import NMTmodelRNN.Constants as Constants
+from Dataset import load_data, save_binary, save_header, split_round_robin, token_array_prefix, \
+    TokenArray, TokenArrayWriter
 import numpy as np
 
 def read_instances_from_file(inst_file, max_sent_len, keep_case):
@@ -77,8 +83,13 @@ def read_all_instances_from_file(inst_file_src, inst_file_tgt, max_sent_len, kee
 def build_vocab_idx(word_insts, min_word_count, voc_size):
     ''' Trim vocab by number of occurence '''
 
-    full_vocab = set(w for sent in word_insts for w in sent)
-    print('[Info] Original Vocabulary size =', len(full_vocab))
+    word_count = collections.Counter(w for sent in word_insts for w in sent)
+    return build_vocab_idx_from_counts(word_count, min_word_count, voc_size)
+
+def build_vocab_idx_from_counts(word_count, min_word_count, voc_size):
+    ''' Trim vocab by number of occurence, from the count of every word '''
+
+    print('[Info] Original Vocabulary size =', len(word_count))
 
     word2idx = {
         Constants.BOS_WORD: Constants.BOS,
@@ -86,11 +97,6 @@ def build_vocab_idx(word_insts, min_word_count, voc_size):
         Constants.PAD_WORD: Constants.PAD,
         Constants.UNK_WORD: Constants.UNK}
     nb_special_words = len(word2idx)
-    word_count = {w: 0 for w in full_vocab}
-
-    for sent in word_insts:
-        for word in sent:
-            word_count[word] += 1
 
 
     if voc_size <= 0:
@@ -137,6 +143,219 @@ def convert_instance_to_idx_seq(word_insts, word2idx):
     '''Word mapping to idx'''
     return [[word2idx[w] if w in word2idx else Constants.UNK for w in s] for s in word_insts]
 
+def build_lexical_table(src_insts, tgt_insts, n_src_vocab, n_tgt_vocab, lex_size, chunk_size=100000):
+    ''' Best lex_size target words of each source word, by Dice coefficient
+    of their sentence-level co-occurrence, and target words by frequency '''
+
+    nb_special_words = 4
+    src_count = np.zeros(n_src_vocab, dtype=np.int64)
+    tgt_count = np.zeros(n_tgt_vocab, dtype=np.int64)
+    tgt_freq = np.zeros(n_tgt_vocab, dtype=np.int64)
+    pair_keys = np.zeros(0, dtype=np.int64)
+    pair_counts = np.zeros(0, dtype=np.int64)
+
+    pairs = zip(src_insts, tgt_insts)
+    while True:
+        chunk = list(itertools.islice(pairs, chunk_size))
+        if not chunk:
+            break
+        chunk_keys = []
+        for src_inst, tgt_inst in chunk:
+            src_words = np.unique(src_inst)
+            tgt_words = np.unique(tgt_inst)
+            src_count[src_words] += 1
+            tgt_count[tgt_words] += 1
+            np.add.at(tgt_freq, tgt_inst, 1)
+            chunk_keys.append((src_words[:, None] * n_tgt_vocab + tgt_words[None, :]).ravel())
+
+        # merge the pair counts of the chunk into the total
+        keys, inverse = np.unique(np.concatenate([pair_keys] + chunk_keys), return_inverse=True)
+        counts = np.bincount(inverse[len(pair_keys):], minlength=len(keys))
+        counts[inverse[:len(pair_keys)]] += pair_counts
+        pair_keys, pair_counts = keys, counts
+
+    pair_src = pair_keys // n_tgt_vocab
+    pair_tgt = pair_keys % n_tgt_vocab
+    dice = 2.0 * pair_counts / (src_count[pair_src] + tgt_count[pair_tgt])
+    dice[pair_tgt < nb_special_words] = -1
+
+    # sort by source word, then by decreasing dice, and keep the first lex_size of each source
+    order = np.lexsort((-dice, pair_src))
+    pair_src, pair_tgt, dice = pair_src[order], pair_tgt[order], dice[order]
+    group_start = np.searchsorted(pair_src, pair_src, side='left')
+    rank = np.arange(len(pair_src)) - group_start
+    keep = (rank < lex_size) & (dice > 0)
+
+    src_to_tgt = np.full((n_src_vocab, lex_size), Constants.PAD, dtype=np.int64)
+    src_to_tgt[pair_src[keep], rank[keep]] = pair_tgt[keep]
+
+    tgt_by_freq = np.argsort(-tgt_freq, kind='stable')
+    tgt_by_freq = tgt_by_freq[tgt_freq[tgt_by_freq] > 0]
+
+    print('[Info] Lexical table with {} target candidates per source word.'.format(lex_size))
+    return {'src_to_tgt': src_to_tgt, 'tgt_by_freq': tgt_by_freq}
+
+def read_line_chunks(inst_file_src, inst_file_tgt, chunk_size):
+    ''' Read the two files by chunks of chunk_size line pairs '''
+    with open(inst_file_src) as f_src, open(inst_file_tgt) as f_tgt:
+        pairs = zip(f_src, f_tgt)
+        while True:
+            chunk = list(itertools.islice(pairs, chunk_size))
+            if not chunk:
+                break
+            yield chunk
+        if f_src.readline() or f_tgt.readline():
+            print('[Warning] The instance count of {} and {} is not equal.'.format(inst_file_src, inst_file_tgt))
+
+def split_chunk(chunk, max_sent_len, keep_case):
+    ''' Word sequences of a chunk of line pairs, without the empty and the long
+    sentences (as read_all_instances_from_file, and the removal of empty instances) '''
+    word_insts, n_ignored = [], 0
+    for sent_src, sent_tgt in chunk:
+        if not keep_case:
+            sent_src = sent_src.lower()
+            sent_tgt = sent_tgt.lower()
+        words_src = sent_src.split()
+        words_tgt = sent_tgt.split()
+        if len(words_src) > max_sent_len or len(words_tgt) > max_sent_len:
+            n_ignored += 1
+        elif words_src and words_tgt:
+            word_insts.append((words_src, words_tgt))
+    return word_insts, n_ignored
+
+def count_chunk(args):
+    ''' Word counts of the source and target side of a chunk '''
+    chunk, max_sent_len, keep_case = args
+    word_insts, _ = split_chunk(chunk, max_sent_len, keep_case)
+    src_count, tgt_count = collections.Counter(), collections.Counter()
+    for words_src, words_tgt in word_insts:
+        src_count.update(words_src)
+        tgt_count.update(words_tgt)
+    return src_count, tgt_count
+
+_worker_word2idx = None
+
+def init_convert_worker(src_word2idx, tgt_word2idx):
+    # the vocabularies are sent once to each worker, not with every chunk
+    global _worker_word2idx
+    _worker_word2idx = (src_word2idx, tgt_word2idx)
+
+def convert_chunk(args):
+    ''' Flat word index arrays and lengths of the source and target side of a chunk '''
+    chunk, max_sent_len, keep_case = args
+    word_insts, n_ignored = split_chunk(chunk, max_sent_len, keep_case)
+    result = []
+    for side, word2idx in enumerate(_worker_word2idx):
+        insts = [[Constants.BOS_WORD] + inst[side] + [Constants.EOS_WORD] for inst in word_insts]
+        lengths = np.array([len(inst) for inst in insts], dtype=np.int64)
+        tokens = np.array([word2idx.get(w, Constants.UNK) for inst in insts for w in inst], dtype=np.int32)
+        result.append((tokens, lengths))
+    return result, n_ignored
+
+def imap_bounded(pool, func, iterable, max_pending):
+    ''' pool.imap, without reading more than max_pending items of iterable ahead '''
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def preprocess_streaming(opt):
+    ''' Two passes over the training files, by chunks of opt.chunk_size lines spread
+    over opt.workers processes: count the words, then convert the chunks to word
+    indices and append them to the binary dataset (sentence i of the training set to
+    shard i % opt.n_shards). The memory only depends on the size and number of the
+    chunks in flight, not on the corpus. '''
+
+    max_pending = 2 * opt.workers
+
+    def chunk_args(inst_file_src, inst_file_tgt, max_sent_len):
+        for chunk in read_line_chunks(inst_file_src, inst_file_tgt, opt.chunk_size):
+            yield chunk, max_sent_len, opt.keep_case
+
+    # Build vocabulary
+    if opt.vocab:
+        predefined_data = load_data(opt.vocab)
+        assert 'dict' in predefined_data
+
+        print('[Info] Pre-defined vocabulary found.')
+        src_word2idx = predefined_data['dict']['src']
+        tgt_word2idx = predefined_data['dict']['tgt']
+    else:
+        print('[Info] Count the words of the training set.')
+        src_count, tgt_count = collections.Counter(), collections.Counter()
+        with multiprocessing.Pool(opt.workers) as pool:
+            for chunk_src_count, chunk_tgt_count in imap_bounded(
+                    pool, count_chunk, chunk_args(opt.train_src, opt.train_tgt, opt.max_word_seq_len), max_pending):
+                src_count.update(chunk_src_count)
+                tgt_count.update(chunk_tgt_count)
+
+        if opt.share_vocab:
+            print('[Info] Build shared vocabulary for source and target.')
+            word2idx = build_vocab_idx_from_counts(src_count + tgt_count, opt.min_word_count, opt.voc_size)
+            src_word2idx = tgt_word2idx = word2idx
+        else:
+            print('[Info] Build vocabulary for source.')
+            src_word2idx = build_vocab_idx_from_counts(src_count, opt.min_word_count, opt.voc_size)
+            print('[Info] Build vocabulary for target.')
+            tgt_word2idx = build_vocab_idx_from_counts(tgt_count, opt.min_word_count, opt.voc_size)
+
+    # word to index
+    if not os.path.isdir(opt.save_data):
+        os.makedirs(opt.save_data)
+
+    with multiprocessing.Pool(opt.workers, initializer=init_convert_worker,
+                              initargs=(src_word2idx, tgt_word2idx)) as pool:
+        for split, inst_file_src, inst_file_tgt, max_sent_len in [
+                ('train', opt.train_src, opt.train_tgt, opt.max_word_seq_len),
+                ('valid', opt.valid_src, opt.valid_tgt, opt.max_word_seq_len_valid)]:
+            print('[Info] Convert the {} set into sequences of word index.'.format(split))
+            if split == 'train' and opt.n_shards > 1:
+                shards = range(opt.n_shards)
+            else:
+                shards = [None]
+            writers = [[TokenArrayWriter(token_array_prefix(opt.save_data, split, side, shard))
+                        for side in ('src', 'tgt')]
+                       for shard in shards]
+            n_ignored = n_converted = 0
+            for result, chunk_ignored in imap_bounded(
+                    pool, convert_chunk, chunk_args(inst_file_src, inst_file_tgt, max_sent_len), max_pending):
+                for side, (tokens, lengths) in enumerate(result):
+                    for shard_writers, (shard_tokens, shard_lengths) in zip(
+                            writers, split_round_robin(tokens, lengths, len(writers), n_converted)):
+                        shard_writers[side].extend_flat(shard_tokens, shard_lengths)
+                n_converted += len(result[0][1])
+                n_ignored += chunk_ignored
+            n_insts = sum(shard_writers[0].close() for shard_writers in writers)
+            for shard_writers in writers:
+                shard_writers[1].close()
+
+            print('[Info] Get {} instances from {}'.format(n_insts, inst_file_src))
+            if n_ignored > 0:
+                print('[Warning] {} instances are ignored because they are longer than max sentence length {}.'
+                      .format(n_ignored, max_sent_len))
+
+    data = {
+        'settings': opt,
+        'dict': {
+            'src': src_word2idx,
+            'tgt': tgt_word2idx}}
+
+    if opt.lex_size > 0:
+        print('[Info] Build the source to target lexical table.')
+        shards = range(opt.n_shards) if opt.n_shards > 1 else [None]
+        data['lex'] = build_lexical_table(
+            itertools.chain.from_iterable(
+                TokenArray.open(token_array_prefix(opt.save_data, 'train', 'src', shard)) for shard in shards),
+            itertools.chain.from_iterable(
+                TokenArray.open(token_array_prefix(opt.save_data, 'train', 'tgt', shard)) for shard in shards),
+            len(src_word2idx), len(tgt_word2idx), opt.lex_size)
+
+    save_header(data, opt.save_data, n_shards=opt.n_shards)
+    print('[Info] Finish.')
+
 def main():
     ''' Main function '''
 
@@ -153,6 +372,21 @@ def main():
     parser.add_argument('-share_vocab', action='store_true')
     parser.add_argument('-vocab', default=None)
     parser.add_argument('-voc_size', type=int, default=-1)
+    parser.add_argument('-binary', action='store_true',
+                        help='Save the data as a directory of memory-mapped token arrays, '
+                             'which train.py and translate.py open without reading the corpus')
+    parser.add_argument('-stream', action='store_true',
+                        help='Preprocess by chunks in -workers processes, with a memory independent of '
+                             'the corpus size (implies -binary)')
+    parser.add_argument('-workers', type=int, default=os.cpu_count(),
+                        help='Number of processes of -stream')
+    parser.add_argument('-chunk_size', type=int, default=100000,
+                        help='Number of line pairs per chunk of -stream')
+    parser.add_argument('-n_shards', type=int, default=1,
+                        help='Split the training set of the binary format into this many shards, '
+                             'which train.py loads one at a time (implies -binary)')
+    parser.add_argument('-lex_size', type=int, default=0,
+                        help='Number of target candidates per source word in the shortlist lexical table (0: no table)')
 
     opt = parser.parse_args()
     opt.max_token_seq_len = opt.max_word_seq_len_valid + 2 # include the <s> and </s>
@@ -162,6 +396,14 @@ def main():
     else:
         opt.keep_case = True
 
+    if opt.n_shards > 1:
+        opt.binary = True
+
+    if opt.stream:
+        opt.binary = True
+        preprocess_streaming(opt)
+        return
+
     # Training set
     # train_src_word_insts = read_instances_from_file(
     #     opt.train_src, opt.max_word_seq_len, opt.keep_case)
@@ -200,7 +442,7 @@ def main():
 
     # Build vocabulary
     if opt.vocab:
-        predefined_data = torch.load(opt.vocab)
+        predefined_data = load_data(opt.vocab)
         assert 'dict' in predefined_data
 
         print('[Info] Pre-defined vocabulary found.')
@@ -239,8 +481,17 @@ def main():
             'src': valid_src_insts,
             'tgt': valid_tgt_insts}}
 
-    print('[Info] Dumping the processed data to pickle file', opt.save_data)
-    torch.save(data, opt.save_data)
+    if opt.lex_size > 0:
+        print('[Info] Build the source to target lexical table.')
+        data['lex'] = build_lexical_table(
+            train_src_insts, train_tgt_insts, len(src_word2idx), len(tgt_word2idx), opt.lex_size)
+
+    if opt.binary:
+        print('[Info] Dumping the processed data to binary directory', opt.save_data)
+        save_binary(data, opt.save_data, n_shards=opt.n_shards)
+    else:
+        print('[Info] Dumping the processed data to pickle file', opt.save_data)
+        torch.save(data, opt.save_data)
     print('[Info] Finish.')
 
 if __name__ == '__main__':
@@ -0,0 +1,40 @@
+''' Convert a trained checkpoint into a dynamically quantized (int8) model for CPU translation. '''
+
+import os
+import argparse
+import torch
+from NMTmodelRNN.Models import quantize_dynamic
+from NMTmodelRNN.Translator import load_model
+
+def main():
+    '''Main Function'''
+
+    parser = argparse.ArgumentParser(description='quantize.py')
+
+    parser.add_argument('-model', required=True,
+                        help='Path to the .chkpt file written by train.py')
+    parser.add_argument('-output', default=None,
+                        help="""Path of the quantized model
+                        (default: the model path with a _int8 suffix)""")
+
+    opt = parser.parse_args()
+    if not opt.output:
+        root, ext = os.path.splitext(opt.model)
+        opt.output = root + '_int8' + ext
+
+    model, checkpoint = load_model(opt.model, cuda=False)
+    model = quantize_dynamic(model)
+
+    # the optimizer state is not needed for translation
+    quantized_checkpoint = {
+        'model': model.state_dict(),
+        'settings': checkpoint['settings'],
+        'epoch': checkpoint['epoch'],
+        'quantized': 'dynamic_int8'}
+    torch.save(quantized_checkpoint, opt.output)
+
+    print('[Info] Quantized model saved to {} ({:.1f} MB, fp32 checkpoint {:.1f} MB).'.format(
+        opt.output, os.path.getsize(opt.output) / 2**20, os.path.getsize(opt.model) / 2**20))
+
+if __name__ == "__main__":
+    main()
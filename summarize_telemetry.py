@@ -0,0 +1,102 @@
+''' Summarize the step telemetry written by train.py -telemetry: throughput, phase
+breakdown, padding and memory, and the intervals stalled on data or slower than usual. '''
+
+import json
+import argparse
+import numpy as np
+from Telemetry import PHASES
+
+def read_records(path):
+    ''' The step records of a telemetry file, and its start records '''
+    steps, starts = [], []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if record.get('type') == 'start':
+                starts.append(record)
+            elif record.get('type') == 'step':
+                steps.append(record)
+    return steps, starts
+
+def summarize(steps):
+    ''' Statistics over the step records: (metric, mean, p5, p50, p95, min, max) rows '''
+    metrics = ['src_tok_per_s', 'tgt_tok_per_s', 'sent_per_s'] + \
+              [name + '_frac' for name in PHASES] + \
+              ['pad_ratio', 'pad_ratio_max', 'loss_per_word', 'lr', 'peak_rss_mb']
+    rows = []
+    for metric in metrics:
+        values = np.array([record[metric] for record in steps if metric in record], dtype=np.float64)
+        if len(values) == 0:
+            continue
+        p5, p50, p95 = np.percentile(values, [5, 50, 95])
+        rows.append((metric, values.mean(), p5, p50, p95, values.min(), values.max()))
+    return rows
+
+def main():
+    '''Main Function'''
+
+    parser = argparse.ArgumentParser(description='summarize_telemetry.py')
+
+    parser.add_argument('-input', required=True, help='JSONL file written by train.py -telemetry')
+    parser.add_argument('-skip', type=int, default=1,
+                        help='Ignore the first records (warm-up)')
+    parser.add_argument('-stall_frac', type=float, default=0.2,
+                        help='Report the intervals which spent more than this fraction of the time waiting for data')
+    parser.add_argument('-slow_ratio', type=float, default=0.7,
+                        help='Report the intervals whose target tokens/s is below this ratio of the median')
+    parser.add_argument('-baseline', default=None,
+                        help='Telemetry file of a reference run, to compare the median throughputs with')
+
+    opt = parser.parse_args()
+
+    steps, starts = read_records(opt.input)
+    if starts:
+        print('[Info] {} run(s), last settings: {}'.format(
+            len(starts), {k: v for k, v in starts[-1].items() if k not in ('type', 'time')}))
+    steps = steps[opt.skip:]
+    if not steps:
+        print('[Info] No step records after the first {}'.format(opt.skip))
+        return
+
+    n_steps = sum(record['steps'] for record in steps)
+    elapsed = sum(record['elapsed_s'] for record in steps)
+    print('[Info] {} records, {} steps, {:.1f} s'.format(len(steps), n_steps, elapsed))
+
+    print('{:<16}{:>12}{:>12}{:>12}{:>12}{:>12}{:>12}'.format('', 'mean', 'p5', 'p50', 'p95', 'min', 'max'))
+    for row in summarize(steps):
+        print('{:<16}'.format(row[0]) + ''.join('{:>12.4g}'.format(value) for value in row[1:]))
+
+    # time-weighted phase breakdown over the whole run
+    print('Time split: ' + ', '.join('{} {:.1f} %'.format(
+        name, 100 * sum(record.get(name + '_s', 0.0) for record in steps) / elapsed) for name in PHASES))
+
+    median_tok = np.median([record['tgt_tok_per_s'] for record in steps])
+    stalls = [record for record in steps if record['data_frac'] > opt.stall_frac]
+    slow = [record for record in steps if record['tgt_tok_per_s'] < opt.slow_ratio * median_tok]
+    print('Data stalls (data > {:.0f} % of the time): {} of {} records'.format(
+        100 * opt.stall_frac, len(stalls), len(steps)))
+    for record in stalls[:20]:
+        print('    step {step:>8} epoch {epoch:6.2f}: data {data_frac:.1%}, {tgt_tok_per_s:.0f} tgt tok/s'.format(**record))
+    print('Slow intervals (< {:.0f} % of the median {:.0f} tgt tok/s): {} of {} records'.format(
+        100 * opt.slow_ratio, median_tok, len(slow), len(steps)))
+    for record in slow[:20]:
+        print('    step {step:>8} epoch {epoch:6.2f}: {tgt_tok_per_s:.0f} tgt tok/s, data {data_frac:.1%}, '
+              'forward {forward_frac:.1%}, backward {backward_frac:.1%}, step {step_frac:.1%}'.format(**record))
+
+    if opt.baseline:
+        base_steps, _ = read_records(opt.baseline)
+        base_steps = base_steps[opt.skip:]
+        if not base_steps:
+            print('[Info] No step records in the baseline')
+            return
+        for metric in ['src_tok_per_s', 'tgt_tok_per_s', 'sent_per_s', 'peak_rss_mb']:
+            base = np.median([record[metric] for record in base_steps])
+            current = np.median([record[metric] for record in steps])
+            print('{:<16} baseline {:12.4g}  current {:12.4g}  ({:+.1f} %)'.format(
+                metric, base, current, 100 * (current - base) / base if base else float('nan')))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import os
+import sys
+
+# the modules of the repository are imported from its root, as the scripts do
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from argparse import Namespace
+
+import numpy as np
+import pytest
+import torch
+import NMTmodelRNN.Constants as Constants
+from NMTmodelRNN.Models import NMTmodelRNN
+
+def make_model(n_src_vocab=30, n_tgt_vocab=40, n_max_seq=25, n_layers=1, d_model=16,
+               attn_type='additive', attn_window=0, seed=1):
+    torch.manual_seed(seed)
+    model = NMTmodelRNN(n_src_vocab, n_tgt_vocab, n_max_seq, n_layers=n_layers,
+                        d_word_vec=d_model, d_model=d_model, dropout=0.0,
+                        proj_share_weight=False, embs_share_weight=False,
+                        attn_type=attn_type, attn_window=attn_window)
+    model.eval()
+    return model
+
+def make_batch(n_vocab=30, batch_size=6, max_len=8, seed=2):
+    ''' (seq, lengths) of random sentences, sorted by decreasing length '''
+    rng = np.random.RandomState(seed)
+    lengths = np.sort(rng.randint(2, max_len + 1, size=batch_size))[::-1]
+    seq = np.full((batch_size, int(lengths[0])), Constants.PAD, dtype=np.int64)
+    for i, length in enumerate(lengths):
+        seq[i, :length] = rng.randint(Constants.EOS + 1, n_vocab, size=length)
+    return torch.from_numpy(seq), torch.from_numpy(lengths.copy())
+
+@pytest.fixture
+def random_model():
+    ''' Factory of small random NMTmodelRNN in eval mode, see make_model '''
+    return make_model
+
+@pytest.fixture
+def random_batch():
+    ''' Factory of random source batches, see make_batch '''
+    return make_batch
+
+@pytest.fixture
+def checkpoint_file(tmp_path):
+    ''' Path of a checkpoint of make_model(), as train.py writes it '''
+    model = make_model()
+    settings = Namespace(src_vocab_size=30, tgt_vocab_size=40, max_token_seq_len=25,
+                         proj_share_weight=False, embs_share_weight=False, d_model=16, d_word_vec=16,
+                         n_layers=1, dropout=0.0)
+    path = str(tmp_path / 'model.chkpt')
+    torch.save({'model': model.state_dict(), 'settings': settings, 'epoch': 1.0}, path)
+    return path
@@ -0,0 +1,69 @@
+import pytest
+from NMTmodelRNN.Bleu import BleuReference, BleuScorer, corpus_bleu, load_reference, merge_bpe
+
+REF0 = ['the cat sat on the mat today',
+        'there is a dog in the garden',
+        'hello world',
+        'it is raining again this morning']
+REF1 = ['the cat is sitting on the mat',
+        'a dog is in the garden',
+        'hello there world',
+        'this morning it rains again']
+
+# the lines printed by multi-bleu.perl for these hypotheses
+CASES = [
+    # one empty hypothesis, brevity penalty
+    (['the cat sat on the mat', 'a dog in the garden', '', 'it is raining this morning'], False, [
+        'BLEU = 58.57, 100.0/92.3/80.0/71.4 (BP=0.687, ratio=0.727, hyp_len=16, ref_len=22)',
+        'BLEU = 66.37, 100.0/92.3/80.0/71.4 (BP=0.779, ratio=0.800, hyp_len=16, ref_len=20)']),
+    # every line shorter than a 4-gram
+    (['the cat', 'a dog', 'hello', 'it rains'], False, [
+        'BLEU = 0.00, 85.7/66.7/0.0/0.0 (BP=0.117, ratio=0.318, hyp_len=7, ref_len=22)',
+        'BLEU = 0.00, 100.0/100.0/0.0/0.0 (BP=0.156, ratio=0.350, hyp_len=7, ref_len=20)']),
+    # some lines shorter than a 4-gram
+    (['the cat sat on the mat today', 'a dog is', 'hello world', 'it is raining'], False, [
+        None,
+        'BLEU = 71.65, 100.0/100.0/100.0/100.0 (BP=0.717, ratio=0.750, hyp_len=15, ref_len=20)']),
+    (REF0, False, [
+        'BLEU = 100.00, 100.0/100.0/100.0/100.0 (BP=1.000, ratio=1.000, hyp_len=22, ref_len=22)',
+        'BLEU = 100.00, 100.0/100.0/100.0/100.0 (BP=1.000, ratio=1.000, hyp_len=22, ref_len=22)']),
+    # longer than the reference, case
+    (['The Cat sat on the MAT today', 'there is a dog in the garden now', 'hello world',
+      'it is raining again this morning'], False, [
+        'BLEU = 69.75, 82.6/73.7/66.7/58.3 (BP=1.000, ratio=1.045, hyp_len=23, ref_len=22)',
+        'BLEU = 69.75, 82.6/73.7/66.7/58.3 (BP=1.000, ratio=1.045, hyp_len=23, ref_len=22)']),
+    (['The Cat sat on the MAT today', 'there is a dog in the garden now', 'hello world',
+      'it is raining again this morning'], True, [
+        None,
+        'BLEU = 93.84, 95.7/94.7/93.3/91.7 (BP=1.000, ratio=1.045, hyp_len=23, ref_len=22)']),
+]
+
+@pytest.mark.parametrize('hyps, lowercase, expected', CASES)
+def test_multi_bleu_parity(hyps, lowercase, expected):
+    for references, line in zip(([REF0], [REF0, REF1]), expected):
+        if line is not None:
+            assert str(corpus_bleu(hyps, BleuReference(references, lowercase))) == line
+
+def test_merge_bpe():
+    hyps = ['the c@@ at sat on the mat today', 'there is a d@@ og in the gar@@ den', 'hello world',
+            'it is raining again this mor@@ ning@@']
+    reference = BleuReference([REF0, REF1])
+    assert merge_bpe(hyps[3]) == REF0[3]
+    assert str(corpus_bleu(hyps, reference, merge_bpe=True)) == \
+        'BLEU = 100.00, 100.0/100.0/100.0/100.0 (BP=1.000, ratio=1.000, hyp_len=22, ref_len=22)'
+    assert str(corpus_bleu(hyps, reference)) == \
+        'BLEU = 44.48, 69.2/54.5/38.9/26.7 (BP=1.000, ratio=1.182, hyp_len=26, ref_len=22)'
+
+def test_reference_files(tmp_path):
+    # stem0, stem1, ... are the references of multi-bleu.perl ref
+    for k, ref in enumerate((REF0, REF1)):
+        (tmp_path / 'ref{}'.format(k)).write_text('\n'.join(ref) + '\n')
+    scorer = BleuScorer(load_reference(str(tmp_path / 'ref')))
+    for hyp in ['the cat', 'a dog', 'hello', 'it rains']:
+        scorer.add(hyp)
+    assert str(scorer.score()) == 'BLEU = 0.00, 100.0/100.0/0.0/0.0 (BP=0.156, ratio=0.350, hyp_len=7, ref_len=20)'
+
+def test_all_hypotheses_empty():
+    # multi-bleu.perl dies with a division by zero here
+    score = corpus_bleu(['', '', '', ''], BleuReference([REF0]))
+    assert score.bleu == 0.0 and score.brevity_penalty == 0.0 and score.hyp_len == 0
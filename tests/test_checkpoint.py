@@ -0,0 +1,79 @@
+import os
+import pytest
+import torch
+from Checkpoint import CheckpointWriter, load_optimizer_state, optimizer_path
+
+def checkpoint(step):
+    return {'model': {'weight': torch.full((3,), float(step))}, 'optimizer': {'step': step}, 'epoch': step}
+
+def save_all(writer, tmp_path, n_saves, scores=None):
+    paths = [str(tmp_path / 'model_{}.chkpt'.format(step)) for step in range(n_saves)]
+    for step, path in enumerate(paths):
+        writer.save(checkpoint(step), path, link_path=str(tmp_path / 'model.chkpt'))
+        if scores is not None:
+            writer.set_score(path, scores[step])
+    writer.close()
+    return paths
+
+def test_keep_last(tmp_path):
+    paths = save_all(CheckpointWriter(keep_last=2), tmp_path, 5)
+    assert sorted(os.listdir(str(tmp_path))) == ['model.chkpt', 'model_3.chkpt', 'model_4.chkpt']
+    latest = torch.load(str(tmp_path / 'model.chkpt'), weights_only=False)
+    assert latest['epoch'] == 4
+    assert latest['model']['weight'].equal(torch.load(paths[-1], weights_only=False)['model']['weight'])
+
+def test_keep_best_and_last(tmp_path):
+    save_all(CheckpointWriter(keep_last=1, keep_best=2), tmp_path, 5, scores=[1.0, 5.0, 3.0, 4.0, 2.0])
+    assert sorted(os.listdir(str(tmp_path))) == \
+            ['model.chkpt', 'model_1.chkpt', 'model_3.chkpt', 'model_4.chkpt']
+
+def test_keep_everything_by_default(tmp_path):
+    save_all(CheckpointWriter(), tmp_path, 3)
+    assert len(os.listdir(str(tmp_path))) == 4
+
+def test_separate_optimizer(tmp_path):
+    paths = save_all(CheckpointWriter(keep_last=1, separate_optimizer=True), tmp_path, 3)
+    assert sorted(os.listdir(str(tmp_path))) == \
+            ['model.chkpt', 'model.optim.chkpt', 'model_2.chkpt', 'model_2.optim.chkpt']
+    assert os.path.basename(optimizer_path(paths[-1])) == 'model_2.optim.chkpt'
+    latest_path = str(tmp_path / 'model.chkpt')
+    latest = torch.load(latest_path, weights_only=False)
+    assert latest['optimizer'] is None
+    assert load_optimizer_state(latest, latest_path) == {'step': 2}
+
+def test_save_writes_a_snapshot(tmp_path):
+    state = checkpoint(1)
+    writer = CheckpointWriter()
+    writer.save(state, str(tmp_path / 'model.chkpt'))
+    # the training goes on updating the parameters while the checkpoint is written
+    state['model']['weight'].add_(1.0)
+    writer.close()
+    assert torch.load(str(tmp_path / 'model.chkpt'), weights_only=False)['model']['weight'].eq(1.0).all()
+
+def test_write_errors_are_raised_by_wait(tmp_path):
+    writer = CheckpointWriter()
+    writer.save(checkpoint(1), str(tmp_path / 'missing' / 'model.chkpt'))
+    with pytest.raises(OSError):
+        writer.wait()
+    # the writer still works, and no temporary file is left
+    writer.save(checkpoint(2), str(tmp_path / 'model.chkpt'))
+    writer.close()
+    assert os.listdir(str(tmp_path)) == ['model.chkpt']
+
+def test_failed_write_keeps_the_previous_checkpoint(tmp_path, monkeypatch):
+    path = str(tmp_path / 'model.chkpt')
+    writer = CheckpointWriter()
+    writer.save(checkpoint(1), path)
+    writer.wait()
+
+    def interrupted_save(obj, f):
+        f.write(b'half a checkpoint')
+        raise IOError('disk full')
+    monkeypatch.setattr(torch, 'save', interrupted_save)
+    writer.save(checkpoint(2), path)
+    with pytest.raises(IOError):
+        writer.wait()
+    writer.close()
+    monkeypatch.undo()
+
+    assert torch.load(path, weights_only=False)['epoch'] == 1
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from DataLoader import DataLoader, PrefetchLoader
+
+def corpus(n_sents, seed=1):
+    ''' Sentences of random lengths, the first token of each is its index '''
+    rng = np.random.RandomState(seed)
+    src = [[idx] + [5] * rng.randint(0, 30) for idx in range(n_sents)]
+    tgt = [[idx] + [5] * rng.randint(0, 30) for idx in range(n_sents)]
+    return src, tgt
+
+def loader(src, tgt, **kwargs):
+    vocab = {'w{}'.format(i): i for i in range(10)}
+    return DataLoader(vocab, vocab, src_insts=src, tgt_insts=tgt, cuda=False, batch_size=8,
+                      is_train=True, seed=1, **kwargs)
+
+@pytest.mark.parametrize('batch_tokens', [40, 200])
+def test_token_batches_respect_the_budget_and_cover_the_data(batch_tokens):
+    src, tgt = corpus(300)
+    training_data = loader(src, tgt, batch_tokens=batch_tokens, maxibatch_size=4)
+
+    for _ in range(2): # the batches are planned again for the second epoch
+        seen = []
+        n_batches = 0
+        n_planned = len(training_data)
+        for (src_seq, src_len), (tgt_seq, tgt_len) in training_data:
+            n_batches += 1
+            assert src_seq.size(0) == 1 or src_seq.numel() + tgt_seq.numel() <= batch_tokens
+            assert src_seq[:, 0].tolist() == tgt_seq[:, 0].tolist()
+            assert src_len.tolist() == [len(src[idx]) for idx in src_seq[:, 0].tolist()]
+            seen += src_seq[:, 0].tolist()
+        assert n_batches == n_planned
+        assert sorted(seen) == list(range(300))
+
+def test_token_batches_of_two_ranks_are_disjoint():
+    src, tgt = corpus(300)
+    seen = []
+    for rank in range(2):
+        training_data = loader(src, tgt, batch_tokens=100, rank=rank, world_size=2)
+        seen += [idx for (src_seq, _), _ in training_data for idx in src_seq[:, 0].tolist()]
+    assert sorted(seen) == list(range(300))
+
+def clone(batch):
+    return tuple((seq.clone(), lengths.clone()) for seq, lengths in batch)
+
+@pytest.mark.parametrize('n_prefetch', [1, 4])
+def test_prefetch_loader_yields_the_batches_of_the_loader(n_prefetch):
+    src, tgt = corpus(100)
+    training_data = loader(src, tgt, sort_by_length=True)
+    expected = [clone(batch) for _ in range(2) for batch in training_data]
+    prefetched = PrefetchLoader(loader(src, tgt, sort_by_length=True), n_prefetch=n_prefetch)
+
+    # the slots are reused: a batch is only valid until the next one is taken
+    batches = [clone(batch) for _ in range(2) for batch in prefetched]
+    assert len(batches) == len(expected) == 2 * len(prefetched)
+    for batch, expected_batch in zip(batches, expected):
+        for (seq, lengths), (expected_seq, expected_lengths) in zip(batch, expected_batch):
+            assert seq.equal(expected_seq)
+            assert lengths.equal(expected_lengths)
+    assert prefetched.stats()['batches'] == len(batches)
+
+def test_prefetch_loader_raises_the_errors_of_the_loader():
+    src, tgt = corpus(100)
+    prefetched = PrefetchLoader(loader(src, tgt, shuffle=False), n_prefetch=2)
+    tgt[50] = None # not a sentence
+    with pytest.raises(TypeError):
+        for batch in prefetched:
+            pass
@@ -0,0 +1,82 @@
+import os
+import sys
+import subprocess
+import numpy as np
+import pytest
+from Dataset import TokenArray, TokenArrayWriter, load_data, split_round_robin
+from DataLoader import ShardedDataLoader
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+def write_corpus(path, n_sents, seed=1):
+    rng = np.random.RandomState(seed)
+    words = ['w{}'.format(i) for i in range(20)]
+    for side in ('src', 'tgt'):
+        with open(os.path.join(path, side), 'w') as f:
+            for _ in range(n_sents):
+                f.write(' '.join(rng.choice(words, size=rng.randint(1, 10))) + '\n')
+
+def preprocess(path, *args):
+    subprocess.check_call(
+        [sys.executable, 'preprocess.py',
+         '-train_src', os.path.join(path, 'src'), '-train_tgt', os.path.join(path, 'tgt'),
+         '-valid_src', os.path.join(path, 'src'), '-valid_tgt', os.path.join(path, 'tgt'),
+         '-min_word_count', '1'] + list(args),
+        cwd=ROOT, stdout=subprocess.DEVNULL)
+
+def all_insts(shards, side):
+    return [inst for shard in shards for inst in shard[side]]
+
+def test_token_array_writer(tmp_path):
+    prefix = str(tmp_path / 'train.src')
+    insts = [[4, 5, 6], [], [7], [8, 9]]
+    writer = TokenArrayWriter(prefix)
+    writer.extend(insts[:2])
+    writer.extend_flat(np.array([7, 8, 9]), [1, 2])
+    writer.extend([])
+    assert writer.close() == len(insts)
+
+    array = TokenArray.open(prefix)
+    assert list(array) == insts
+    assert array.offsets.tolist() == [0, 3, 3, 4, 6]
+
+def test_split_round_robin():
+    tokens = np.arange(10)
+    lengths = [1, 2, 3, 4]
+    shards = split_round_robin(tokens, lengths, 3, first=2)
+    assert [s[1].tolist() for s in shards] == [[2], [3], [1, 4]]
+    assert [s[0].tolist() for s in shards] == [[1, 2], [3, 4, 5], [0, 6, 7, 8, 9]]
+
+@pytest.mark.parametrize('mode', ['-binary', '-stream'])
+def test_shards_of_a_small_corpus(tmp_path, mode):
+    # fewer sentences than n_shards * chunk_size: every shard still gets its share
+    write_corpus(str(tmp_path), 600)
+    preprocess(str(tmp_path), '-save_data', str(tmp_path / 'full'), '-binary')
+    preprocess(str(tmp_path), '-save_data', str(tmp_path / 'sharded'), mode,
+               '-n_shards', '8', '-chunk_size', '100', '-workers', '2')
+
+    full = load_data(str(tmp_path / 'full'))
+    sharded = load_data(str(tmp_path / 'sharded'))
+    assert [len(shard['src']) for shard in sharded['train']] == [75] * 8
+    for side in ('src', 'tgt'):
+        assert sorted(all_insts(sharded['train'], side)) == sorted(full['train'][side])
+
+    vocab = sharded['dict']
+    loader = ShardedDataLoader(vocab['src'], vocab['tgt'], sharded['train'], cuda=False, batch_size=32)
+    n_sents = sum(batch[0][0].size(0) for batch in loader)
+    assert n_sents == 600
+
+def test_undersized_shards_are_merged():
+    rng = np.random.RandomState(2)
+    def shard(n):
+        return {'src': [rng.randint(4, 20, size=rng.randint(1, 5)).tolist() for _ in range(n)],
+                'tgt': [rng.randint(4, 20, size=rng.randint(1, 5)).tolist() for _ in range(n)]}
+    vocab = {str(i): i for i in range(20)}
+
+    shards = [shard(40), shard(0), shard(10), shard(7)]
+    loader = ShardedDataLoader(vocab, vocab, shards, cuda=False, batch_size=16, seed=1)
+    assert sum(batch[0][0].size(0) for batch in loader) == 57
+
+    # too small to be merged into a batch, next to a regular shard
+    loader = ShardedDataLoader(vocab, vocab, [shard(40), shard(5)], cuda=False, batch_size=16, seed=1)
+    assert sum(batch[0][0].size(0) for batch in loader) == 40
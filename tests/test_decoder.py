@@ -0,0 +1,159 @@
+import pytest
+import torch
+import torch.nn.functional as F
+import NMTmodelRNN.Constants as Constants
+from NMTmodelRNN.Translator import PrefixCompleter
+
+def encode(model, seq, lengths):
+    with torch.no_grad():
+        return model.encoder(seq, lengths)
+
+def log_prob(decoder, h_in, h_in_len, hyp):
+    ''' Log probability of hyp, and of the <EOS> after it if it is shorter than n_max_seq,
+    for a single sentence, decoded one step at a time '''
+    state = decoder.init_state(h_in, h_in_len)
+    gold = hyp + [Constants.EOS] if len(hyp) < decoder.n_max_seq else hyp
+    total = 0.0
+    with torch.no_grad():
+        for y_t, y_next in zip([Constants.BOS] + hyp, gold):
+            logit, state = decoder.step(state, torch.LongTensor([y_t]))
+            total += F.log_softmax(logit, dim=1)[0, y_next].item()
+    return total
+
+def sentence(h_in, h_in_len, idx):
+    ''' h_in and h_in_len of the sentence idx alone, without padding '''
+    length = int(h_in_len[idx])
+    return h_in[idx:idx+1, :length], h_in_len[idx:idx+1]
+
+@pytest.mark.parametrize('seed', range(4))
+def test_beam_scores_are_the_log_probabilities(random_model, random_batch, seed):
+    model = random_model(seed=seed)
+    seq, lengths = random_batch(seed=seed)
+    h_in = encode(model, seq, lengths)
+    with torch.no_grad():
+        all_hyp, all_scores = model.decoder.beam_search(h_in, lengths, beam_size=3, n_best=2, alpha=0.0)
+
+    for idx, (hyps, scores) in enumerate(zip(all_hyp, all_scores)):
+        assert scores[0] >= scores[1]
+        for hyp, score in zip(hyps, scores):
+            assert score == pytest.approx(log_prob(model.decoder, *sentence(h_in, lengths, idx), hyp), abs=1e-4)
+
+@pytest.mark.parametrize('seed', range(4))
+def test_beam_of_one_follows_greedy(random_model, random_batch, seed):
+    # with one beam, the alive hypothesis is the greedy one: the result is the greedy
+    # hypothesis, or one of its prefixes which ended with a more likely <EOS>
+    model = random_model(seed=seed)
+    seq, lengths = random_batch(seed=seed)
+    h_in = encode(model, seq, lengths)
+    with torch.no_grad():
+        greedy = model.decoder.greedy_search(h_in, lengths)
+        all_hyp, all_scores = model.decoder.beam_search(h_in, lengths, beam_size=1, alpha=0.0)
+
+    for idx, (hyp, greedy_hyp) in enumerate(zip(all_hyp, greedy)):
+        assert hyp[0] == greedy_hyp[:len(hyp[0])]
+        greedy_score = log_prob(model.decoder, *sentence(h_in, lengths, idx), greedy_hyp)
+        assert all_scores[idx][0] >= greedy_score - 1e-4
+        if all_scores[idx][0] <= greedy_score + 1e-4:
+            assert hyp[0] == greedy_hyp
+
+@pytest.mark.parametrize('attn_window', [0, 3])
+def test_batched_beam_search_matches_one_sentence_at_a_time(random_model, random_batch, attn_window):
+    model = random_model(attn_window=attn_window)
+    seq, lengths = random_batch(batch_size=8)
+    h_in = encode(model, seq, lengths)
+    with torch.no_grad():
+        all_hyp, all_scores = model.decoder.beam_search(h_in, lengths, beam_size=4, n_best=2)
+        for idx in range(seq.size(0)):
+            hyps, scores = model.decoder.beam_search(*sentence(h_in, lengths, idx), beam_size=4, n_best=2)
+            assert hyps[0] == all_hyp[idx]
+            assert scores[0] == pytest.approx(all_scores[idx], abs=1e-5)
+
+def step_by_step_greedy(decoder, h_in, h_in_len, max_len):
+    ''' Greedy decoding of a single sentence, without the active batch '''
+    state = decoder.init_state(h_in, h_in_len)
+    y_t = torch.LongTensor([Constants.BOS])
+    hyp = []
+    with torch.no_grad():
+        for _ in range(max_len):
+            logit, state = decoder.step(state, y_t)
+            y_t = logit.max(1)[1]
+            if y_t.item() == Constants.EOS:
+                break
+            hyp.append(y_t.item())
+    return hyp
+
+@pytest.mark.parametrize('seed', range(4))
+def test_greedy_matches_step_by_step_decoding(random_model, random_batch, seed):
+    model = random_model(seed=seed)
+    seq, lengths = random_batch(batch_size=8, seed=seed)
+    h_in = encode(model, seq, lengths)
+    with torch.no_grad():
+        greedy = model.decoder.greedy_search(h_in, lengths)
+
+    for idx, hyp in enumerate(greedy):
+        assert hyp == step_by_step_greedy(model.decoder, *sentence(h_in, lengths, idx), model.decoder.n_max_seq)
+
+def test_greedy_max_len_ratio(random_model, random_batch):
+    model = random_model(seed=0)
+    seq, lengths = random_batch(batch_size=8, seed=0)
+    h_in = encode(model, seq, lengths)
+    with torch.no_grad():
+        greedy = model.decoder.greedy_search(h_in, lengths)
+        capped = model.decoder.greedy_search(h_in, lengths, max_len_ratio=0.5)
+
+    for hyp, capped_hyp, length in zip(greedy, capped, lengths.tolist()):
+        max_len = -(-length // 2)
+        assert capped_hyp == hyp[:max_len]
+
+@pytest.mark.parametrize('attn_type', ['additive', 'general', 'dot'])
+@pytest.mark.parametrize('attn_window', [0, 3])
+def test_teacher_forced_forward_matches_step(random_model, random_batch, attn_type, attn_window):
+    model = random_model(n_layers=2, attn_type=attn_type, attn_window=attn_window)
+    seq, lengths = random_batch()
+    y_in, _ = random_batch(n_vocab=40, max_len=10, seed=3)
+    h_in = encode(model, seq, lengths)
+    with torch.no_grad():
+        logit = model.decoder(h_in, lengths, y_in)
+        hidden = model.decoder(h_in, lengths, y_in, return_hidden=True)
+
+        state = model.decoder.init_state(h_in, lengths)
+        step_logits = []
+        for idx in range(y_in.size(1)):
+            step_logit, state = model.decoder.step(state, y_in[:, idx].contiguous())
+            step_logits.append(step_logit)
+    step_logit = torch.stack(step_logits, 1).view(-1, step_logit.size(1))
+
+    torch.testing.assert_close(logit, step_logit, rtol=0, atol=1e-6)
+    torch.testing.assert_close(model.decoder.fin_to_voc(hidden), logit, rtol=0, atol=0)
+
+def test_advance_matches_step(random_model, random_batch):
+    model = random_model(n_layers=2)
+    seq, lengths = random_batch()
+    y_in, _ = random_batch(n_vocab=40, max_len=5, seed=3)
+    h_in = encode(model, seq, lengths)
+    with torch.no_grad():
+        advanced = model.decoder.advance(model.decoder.init_state(h_in, lengths), y_in)
+        stepped = model.decoder.init_state(h_in, lengths)
+        for idx in range(y_in.size(1)):
+            _, stepped = model.decoder.step(stepped, y_in[:, idx].contiguous())
+        y_t = torch.LongTensor(seq.size(0)).fill_(Constants.BOS)
+        advanced_logit, _ = model.decoder.step(advanced, y_t)
+        stepped_logit, _ = model.decoder.step(stepped, y_t)
+
+    torch.testing.assert_close(advanced.s_tm1, stepped.s_tm1, rtol=0, atol=0)
+    torch.testing.assert_close(advanced_logit, stepped_logit, rtol=0, atol=0)
+
+@pytest.mark.parametrize('max_len_ratio', [None, 2.0])
+def test_prefix_completion_matches_greedy(random_model, random_batch, max_len_ratio):
+    model = random_model(seed=0)
+    seq, lengths = random_batch(batch_size=8, seed=0)
+    completer = PrefixCompleter(model, cache_size=4, max_len_ratio=max_len_ratio)
+
+    for src, length in zip(seq.tolist(), lengths.tolist()):
+        src = src[:length]
+        h_in = encode(model, torch.LongTensor([src]), torch.LongTensor([length]))
+        with torch.no_grad():
+            full = model.decoder.greedy_search(h_in, torch.LongTensor([length]), max_len_ratio=max_len_ratio)[0]
+        # growing prefixes reuse the cached decoder states, the others start from the source
+        for k in list(range(len(full))) + [0, len(full) // 2]:
+            assert full[:k] + completer.complete(src, full[:k]) == full
@@ -0,0 +1,70 @@
+import os
+from argparse import Namespace
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+import NMTmodelRNN.Constants as Constants
+from NMTmodelRNN.Models import NMTmodelRNN
+from DataLoader import DataLoader
+from train import MainModel, train_epoch
+
+VOCAB = 30
+
+def corpus(n_sents, seed):
+    rng = np.random.RandomState(seed)
+    src = [rng.randint(4, VOCAB, size=rng.randint(2, 8)).tolist() for _ in range(n_sents)]
+    tgt = [[Constants.BOS] + rng.randint(4, VOCAB, size=rng.randint(2, 8)).tolist() + [Constants.EOS]
+           for _ in range(n_sents)]
+    return src, tgt
+
+def train_rank(rank, world_size, init_file, out_dir):
+    dist.init_process_group('gloo', init_method='file://' + init_file, rank=rank, world_size=world_size)
+    torch.set_num_threads(1)
+    opt = Namespace(cuda=False, distributed=True, multi_gpu=False, rank=rank, sch_optim=False, save_model=None,
+                    save_freq_pct=1.0, sampled_softmax=0, loss_chunk_size=0, smoothing=False)
+
+    # different initial weights: DistributedDataParallel broadcasts those of rank 0
+    torch.manual_seed(rank)
+    model = NMTmodelRNN(VOCAB, VOCAB, 12, n_layers=1, d_word_vec=8, d_model=8, dropout=0.0,
+                        proj_share_weight=False, embs_share_weight=False)
+    weight = torch.ones(VOCAB)
+    weight[Constants.PAD] = 0
+    crit = nn.CrossEntropyLoss(weight, reduction='sum', ignore_index=Constants.PAD)
+    model = DistributedDataParallel(MainModel(model, crit, opt), broadcast_buffers=False)
+    optimizer = optim.Adam(model.parameters(), lr=0.01)
+
+    # uneven shards: rank 0 has 5 batches, rank 1 only 3
+    src, tgt = corpus(40 if rank == 0 else 24, seed=rank)
+    vocab = {str(i): i for i in range(VOCAB)}
+    training_data = DataLoader(vocab, vocab, src_insts=src, tgt_insts=tgt, cuda=False, batch_size=8,
+                               is_train=True, sort_by_length=True, seed=rank)
+    train_epoch(model, training_data, None, None, crit, optimizer, opt, 0.0, 0, 1.0)
+
+    torch.save(model.module.model.state_dict(), os.path.join(out_dir, '{}.pt'.format(rank)))
+    dist.destroy_process_group()
+
+def test_two_processes_end_with_the_same_parameters(tmp_path):
+    ctx = mp.get_context('spawn')
+    processes = [ctx.Process(target=train_rank, args=(rank, 2, str(tmp_path / 'init'), str(tmp_path)))
+                 for rank in range(2)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=120)
+    hung = [process for process in processes if process.is_alive()]
+    for process in hung:
+        process.terminate()
+    assert not hung, 'the training processes hang on uneven shards'
+    assert all(process.exitcode == 0 for process in processes)
+
+    params = [torch.load(str(tmp_path / '{}.pt'.format(rank))) for rank in range(2)]
+    torch.manual_seed(0)
+    initial = NMTmodelRNN(VOCAB, VOCAB, 12, n_layers=1, d_word_vec=8, d_model=8, dropout=0.0,
+                          proj_share_weight=False, embs_share_weight=False).state_dict()
+    for name in params[0]:
+        assert torch.equal(params[0][name], params[1][name]), name
+    assert any(not torch.equal(params[0][name], initial[name]) for name in initial)
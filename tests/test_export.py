@@ -0,0 +1,30 @@
+import pytest
+import torch
+from NMTmodelRNN.Models import ATTN_TYPES, quantize_dynamic
+from NMTmodelRNN.Export import script_model
+from export_torchscript import check_parity
+
+@pytest.mark.parametrize('attn_type', ATTN_TYPES)
+@pytest.mark.parametrize('attn_window', [0, 3])
+def test_scripted_matches_eager(random_model, attn_type, attn_window):
+    model = random_model(attn_type=attn_type, attn_window=attn_window)
+    torch.manual_seed(2)
+    check_parity(model, script_model(model), n_sent=8, max_src_len=12)
+
+def test_scripted_matches_eager_two_layers(random_model):
+    model = random_model(n_layers=2)
+    torch.manual_seed(2)
+    check_parity(model, script_model(model), n_sent=8, max_src_len=12)
+
+def test_scripted_matches_eager_quantized(random_model):
+    model = quantize_dynamic(random_model())
+    torch.manual_seed(2)
+    check_parity(model, script_model(model), n_sent=8, max_src_len=12)
+
+def test_check_parity_fails_on_a_different_model(random_model):
+    model = random_model()
+    other = random_model()
+    with torch.no_grad():
+        next(other.decoder.parameters()).add_(1.0)
+    with pytest.raises(AssertionError):
+        check_parity(model, script_model(other), n_sent=8, max_src_len=12)
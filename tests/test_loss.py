@@ -0,0 +1,40 @@
+from argparse import Namespace
+import pytest
+import torch
+import torch.nn as nn
+import NMTmodelRNN.Constants as Constants
+from train import MainModel
+
+def criterion(smoothing, vocab_size=40):
+    weight = torch.ones(vocab_size)
+    weight[Constants.PAD] = 0
+    if smoothing:
+        return nn.NLLLoss(weight, reduction='sum', ignore_index=Constants.PAD)
+    return nn.CrossEntropyLoss(weight, reduction='sum', ignore_index=Constants.PAD)
+
+def loss_and_grads(model, src, tgt, smoothing, loss_chunk_size):
+    opt = Namespace(cuda=False, sampled_softmax=0, loss_chunk_size=loss_chunk_size, smoothing=smoothing)
+    main_model = MainModel(model, criterion(smoothing), opt)
+    main_model.train()
+    model.zero_grad()
+    loss, n_correct = main_model(src, tgt)
+    loss.backward()
+    return loss.item(), n_correct.item(), [p.grad.clone() for p in model.parameters()]
+
+@pytest.mark.parametrize('smoothing', [False, True])
+@pytest.mark.parametrize('loss_chunk_size', [1, 3, 100])
+def test_chunked_loss_matches_the_full_loss(random_model, random_batch, smoothing, loss_chunk_size):
+    model = random_model()
+    src = random_batch()
+    tgt_seq, tgt_len = random_batch(n_vocab=40, max_len=9, seed=3)
+    tgt_seq[:, 0] = Constants.BOS
+    tgt_seq[torch.arange(tgt_seq.size(0)), tgt_len - 1] = Constants.EOS
+    tgt = (tgt_seq, tgt_len)
+
+    loss, n_correct, grads = loss_and_grads(model, src, tgt, smoothing, 0)
+    chunked_loss, chunked_correct, chunked_grads = loss_and_grads(model, src, tgt, smoothing, loss_chunk_size)
+
+    assert chunked_loss == pytest.approx(loss, rel=1e-6)
+    assert chunked_correct == n_correct
+    for grad, chunked_grad in zip(grads, chunked_grads):
+        torch.testing.assert_close(chunked_grad, grad, rtol=1e-5, atol=1e-6)
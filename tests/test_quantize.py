@@ -0,0 +1,33 @@
+import os
+import sys
+import subprocess
+import torch
+from NMTmodelRNN.Models import quantize_dynamic
+from NMTmodelRNN.Translator import load_model
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+def decode(model, seq, lengths):
+    with torch.no_grad():
+        h_in = model.encoder(seq, lengths)
+        return model.decoder(h_in, lengths, seq), model.decoder.greedy_search(h_in, lengths)
+
+def test_quantized_checkpoint(checkpoint_file, random_model, random_batch):
+    subprocess.check_call([sys.executable, 'quantize.py', '-model', checkpoint_file],
+                          cwd=ROOT, stdout=subprocess.DEVNULL)
+    quantized_file = checkpoint_file.replace('.chkpt', '_int8.chkpt')
+    model, checkpoint = load_model(quantized_file)
+    assert checkpoint['quantized'] == 'dynamic_int8'
+    assert 'optimizer' not in checkpoint
+    assert os.path.getsize(quantized_file) < os.path.getsize(checkpoint_file)
+
+    seq, lengths = random_batch(seed=5)
+    logit, hyps = decode(model, seq, lengths)
+    # the checkpoint holds the model quantized in memory
+    expected_logit, expected_hyps = decode(quantize_dynamic(random_model()), seq, lengths)
+    torch.testing.assert_close(logit, expected_logit, rtol=0, atol=0)
+    assert hyps == expected_hyps
+
+    # and int8 weights stay close to the fp32 ones
+    fp32_logit, _ = decode(random_model(), seq, lengths)
+    torch.testing.assert_close(logit, fp32_logit, rtol=0, atol=0.05)
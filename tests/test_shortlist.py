@@ -0,0 +1,37 @@
+import numpy as np
+import torch
+import NMTmodelRNN.Constants as Constants
+from NMTmodelRNN.Shortlist import Shortlist
+
+SRC_VOCAB, TGT_VOCAB = 30, 40
+
+def full_coverage_lex():
+    rng = np.random.RandomState(3)
+    # the lexical table pads its empty slots with PAD
+    src_to_tgt = np.full((SRC_VOCAB, 3), Constants.PAD, dtype=np.int64)
+    src_to_tgt[:, :2] = rng.randint(4, TGT_VOCAB, size=(SRC_VOCAB, 2))
+    return {'src_to_tgt': src_to_tgt, 'tgt_by_freq': rng.permutation(np.arange(4, TGT_VOCAB))}
+
+def test_shortlist_keeps_specials(random_batch):
+    src_seq, _ = random_batch(n_vocab=SRC_VOCAB)
+    shortlist = Shortlist(full_coverage_lex(), n_frequent=5, n_translations=3).build(src_seq)
+    assert shortlist.tolist() == sorted(set(shortlist.tolist()))
+    for idx in (Constants.PAD, Constants.UNK, Constants.BOS, Constants.EOS):
+        assert idx in shortlist.tolist()
+
+def test_full_coverage_matches_full_projection(random_model, random_batch):
+    model = random_model(n_src_vocab=SRC_VOCAB, n_tgt_vocab=TGT_VOCAB)
+    src_seq, src_len = random_batch(n_vocab=SRC_VOCAB)
+    shortlist = Shortlist(full_coverage_lex(), n_frequent=TGT_VOCAB, n_translations=3).build(src_seq)
+    assert shortlist.tolist() == list(range(TGT_VOCAB))
+
+    with torch.no_grad():
+        enc_output = model.encoder(src_seq, src_len)
+        full_greedy = model.decoder.greedy_search(enc_output, src_len)
+        short_greedy = model.decoder.greedy_search(enc_output, src_len, shortlist=shortlist)
+        full_hyp, full_scores = model.decoder.beam_search(enc_output, src_len, beam_size=4, n_best=2)
+        short_hyp, short_scores = model.decoder.beam_search(enc_output, src_len, beam_size=4, n_best=2,
+                                                            shortlist=shortlist)
+    assert full_greedy == short_greedy
+    assert full_hyp == short_hyp
+    np.testing.assert_allclose(full_scores, short_scores, rtol=1e-6)
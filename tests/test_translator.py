@@ -0,0 +1,35 @@
+from argparse import Namespace
+import numpy as np
+import torch
+from NMTmodelRNN.Cache import TranslationCache
+from NMTmodelRNN.Shortlist import Shortlist
+from NMTmodelRNN.Translator import Translator
+
+def translator_opt(checkpoint_file):
+    return Namespace(model=checkpoint_file, cuda=False, beam_size=3, n_best=1, alpha=1.0)
+
+def test_cached_translations_match_fresh_ones(checkpoint_file, random_batch):
+    opt = translator_opt(checkpoint_file)
+    fresh = Translator(opt)
+    cached = Translator(opt, cache=TranslationCache('model', 1 << 20))
+
+    first = random_batch(seed=3)
+    other = random_batch(seed=4)
+    # the second batch has the sentence 1 of the first one, next to other sentences
+    sents = [first[0][1, :first[1][1]]] + [seq[:length] for seq, length in zip(*other)]
+    second = (torch.nn.utils.rnn.pad_sequence(sents, batch_first=True),
+              torch.LongTensor([len(sent) for sent in sents]))
+
+    cached.translate_batch(first)
+    hyps, scores = cached.translate_batch(second)
+    assert cached.cache.hits == 1
+    assert (hyps, scores) == fresh.translate_batch(second)
+
+def test_no_cache_with_a_shortlist(checkpoint_file, random_batch):
+    lex = {'src_to_tgt': np.full((30, 1), 0, dtype=np.int64), 'tgt_by_freq': np.arange(4, 10)}
+    translator = Translator(translator_opt(checkpoint_file), cache=TranslationCache('model', 1 << 20),
+                            shortlist=Shortlist(lex, n_frequent=6, n_translations=1))
+    batch = random_batch()
+    first = translator.translate_batch(batch)
+    assert translator.translate_batch(batch) == first
+    assert len(translator.cache) == 0 and translator.cache.hits == 0
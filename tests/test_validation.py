@@ -0,0 +1,97 @@
+import os
+import threading
+from argparse import Namespace
+import pytest
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from Checkpoint import CheckpointWriter
+from DataLoader import DataLoader
+from Validation import ValidationWorker
+from train import MainModel, save_model_and_validation_BLEU
+
+SRC_VOCAB = {'s{}'.format(i): i for i in range(30)}
+TGT_VOCAB = {'t{}'.format(i): i for i in range(40)}
+
+def settings(tmp_path):
+    ''' train.py options, which are also the model settings of the checkpoints '''
+    ref = str(tmp_path / 'valid.tgt')
+    with open(ref, 'w') as f:
+        f.write('t5 t6 t7\n' * 6)
+    return Namespace(src_vocab_size=30, tgt_vocab_size=40, max_token_seq_len=25,
+                     proj_share_weight=False, embs_share_weight=False, d_model=16, d_word_vec=16,
+                     n_layers=1, dropout=0.0, batch_size=4, valid_bleu_ref=ref, valid_merge_bpe=False,
+                     max_len_ratio=None, multi_gpu=False, distributed=False, save_mode='all',
+                     save_model=str(tmp_path / 'model'), cuda=False)
+
+def src_insts(random_batch):
+    seq, lengths = random_batch()
+    return [s[:length] for s, length in zip(seq.tolist(), lengths.tolist())]
+
+def without_hanging(fn, timeout=60):
+    ''' Result of fn(), failing if it does not return within timeout seconds '''
+    result = []
+    def run():
+        try:
+            result.append((fn(), None))
+        except Exception as e:
+            result.append((None, e))
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), 'hung for {} s'.format(timeout)
+    value, error = result[0]
+    if error is not None:
+        raise error
+    return value
+
+def test_worker_validates_a_snapshot(tmp_path, random_model, random_batch):
+    opt = settings(tmp_path)
+    validator = ValidationWorker(opt, src_insts(random_batch), SRC_VOCAB, TGT_VOCAB)
+    validator.submit(random_model().state_dict(), opt.save_model + '_epoch1.00.chkpt', 1.0)
+    finished = without_hanging(validator.close)
+
+    assert len(finished) == 1
+    model_name, epoch_i, out, score = finished[0]
+    assert epoch_i == 1.0
+    assert out.startswith('BLEU = ')
+    assert os.path.exists(model_name + '.output.dev')
+
+def test_killed_worker_does_not_hang(tmp_path, random_model, random_batch):
+    opt = settings(tmp_path)
+    validator = ValidationWorker(opt, src_insts(random_batch), SRC_VOCAB, TGT_VOCAB)
+    validator._process.kill()
+    validator._process.join()
+
+    with pytest.raises(RuntimeError):
+        without_hanging(lambda: validator.submit(random_model().state_dict(), opt.save_model, 1.0))
+    assert without_hanging(validator.close) == []
+
+def test_killed_worker_loses_its_pending_validations(tmp_path, random_model, random_batch):
+    opt = settings(tmp_path)
+    validator = ValidationWorker(opt, src_insts(random_batch), SRC_VOCAB, TGT_VOCAB)
+    validator.submit(random_model().state_dict(), opt.save_model, 1.0)
+    validator._process.kill()
+    assert without_hanging(validator.close) == []
+
+def test_trainer_validates_itself_when_the_worker_is_dead(tmp_path, random_model, random_batch):
+    opt = settings(tmp_path)
+    validator = ValidationWorker(opt, src_insts(random_batch), SRC_VOCAB, TGT_VOCAB)
+    validator._process.kill()
+    validator._process.join()
+
+    model = MainModel(random_model(), nn.CrossEntropyLoss(), opt)
+    validation_data_translate = DataLoader(SRC_VOCAB, TGT_VOCAB, src_insts=src_insts(random_batch), cuda=False,
+                                           batch_size=opt.batch_size, shuffle=False, is_train=False)
+    writer = CheckpointWriter()
+    without_hanging(lambda: save_model_and_validation_BLEU(
+        opt, model, optim.Adam(model.parameters()), None, validation_data_translate, 1.0,
+        writer=writer, validator=validator))
+    writer.close()
+
+    model_name = opt.save_model + '_epoch1.00.chkpt'
+    assert os.path.exists(model_name)
+    assert os.path.exists(model_name + '.output.dev')
+    with open(str(tmp_path / 'bleu_scores.txt')) as f:
+        assert f.read().startswith('Epoch 1.0: BLEU = ')
@@ -8,6 +8,8 @@ import math
 import time
 import sys, os
 import os.path
+import contextlib
+import datetime
 
 import numpy as np
 from subprocess import Popen
@@ -16,10 +18,18 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.checkpoint import checkpoint
 import NMTmodelRNN.Constants as Constants
-from NMTmodelRNN.Models import NMTmodelRNN
+from NMTmodelRNN.Models import NMTmodelRNN, ATTN_TYPES
 from NMTmodelRNN.Optim import ScheduledOptim
-from DataLoader import DataLoader
+from DataLoader import DataLoader, ShardedDataLoader, PrefetchLoader
+from Dataset import load_data, TokenArray
+from Checkpoint import CheckpointWriter, load_optimizer_state, snapshot
+from Validation import ValidationWorker, translate_dev
+from Telemetry import StepTelemetry
 #from NMTmodelRNN.Translator import Translator
 from torch.autograd import Variable
 import subprocess
@@ -40,6 +50,64 @@ def get_loss(crit, pred, gold, opt, smoothing_eps=0.1):
         loss = (1-smoothing_eps)*loss + smoothing_eps*smooth
     return loss
 
+def get_sampled_loss(hidden, weight, gold, log_q, n_samples):
+    ''' Sampled softmax: the true word against n_samples negatives shared by the batch,
+    drawn from the proposal distribution exp(log_q), with logits corrected by
+    the log of their expected count '''
+
+    gold = gold.contiguous().view(-1)
+    non_pad = gold.ne(Constants.PAD)
+    hidden = hidden[non_pad] # (n_words, d_word_vec)
+    gold = gold[non_pad] # (n_words)
+
+    samples = torch.multinomial(log_q.exp(), n_samples, replacement=True) # (n_samples)
+    log_expected = log_q + math.log(n_samples)
+
+    true_logit = (hidden * weight[gold]).sum(1) - log_expected[gold] # (n_words)
+    sampled_logit = torch.mm(hidden, weight[samples].t()) - log_expected[samples][None, :] \
+            # (n_words, n_samples)
+    # a sample equal to the true word is not a negative
+    sampled_logit = sampled_logit.masked_fill(samples[None, :] == gold[:, None], -float('inf'))
+
+    logits = torch.cat((true_logit[:, None], sampled_logit), 1) # (n_words, 1 + n_samples)
+    target = gold.new(gold.size(0)).zero_()
+    loss = F.cross_entropy(logits, target, reduction='sum')
+
+    # accuracy among the candidates of the batch, not the full vocabulary
+    n_correct = logits.data.max(1)[1].eq(0).sum()
+    return loss, n_correct
+
+def get_chunked_loss(crit, hidden, gold, fin_to_voc, opt):
+    ''' Output projection, loss and accuracy over chunks of opt.loss_chunk_size timesteps.
+
+    The logits of a chunk are recomputed during the backward pass (checkpointing)
+    instead of being kept, so only one chunk of (batch_size, chunk, vocab_size)
+    logits exists at a time.
+    '''
+
+    batch_size, y_seq_len = gold.size()
+    hidden = hidden.view(batch_size, y_seq_len, -1)
+
+    def chunk_loss(hidden_chunk, gold_chunk):
+        pred = fin_to_voc(hidden_chunk.view(-1, hidden_chunk.size(2)))
+        if opt.smoothing:
+            pred = F.log_softmax(pred, dim=1)
+        return get_loss(crit, pred, gold_chunk, opt), get_performance(pred, gold_chunk)
+
+    loss = 0
+    n_correct = 0
+    for start in range(0, y_seq_len, opt.loss_chunk_size):
+        hidden_chunk = hidden[:, start:start+opt.loss_chunk_size].contiguous()
+        gold_chunk = gold[:, start:start+opt.loss_chunk_size].contiguous()
+        if torch.is_grad_enabled():
+            chunk_loss_, chunk_correct = checkpoint(chunk_loss, hidden_chunk, gold_chunk, use_reentrant=False)
+        else:
+            chunk_loss_, chunk_correct = chunk_loss(hidden_chunk, gold_chunk)
+        loss = loss + chunk_loss_
+        n_correct = n_correct + chunk_correct
+
+    return loss, n_correct
+
 def get_performance(pred, gold):
     gold = gold.contiguous().view(-1)
     pred = pred.max(1)[1]
@@ -48,73 +116,124 @@ def get_performance(pred, gold):
 
     return n_correct
 
+def get_sampling_log_prob(tgt_insts, vocab_size, power=0.75):
+    ''' Log of the unigram^power proposal distribution of the sampled softmax.
+    tgt_insts is a list of instances, a TokenArray, or a list of TokenArray shards. '''
+    counts = np.ones(vocab_size, dtype=np.float64)
+    if isinstance(tgt_insts, TokenArray):
+        tgt_insts = [tgt_insts]
+    for inst in tgt_insts:
+        if isinstance(inst, TokenArray):
+            counts += np.bincount(inst.tokens, minlength=vocab_size)
+        else:
+            np.add.at(counts, inst, 1)
+    counts[Constants.PAD] = 0
+    counts[Constants.BOS] = 0
+    q = counts ** power
+    with np.errstate(divide='ignore'):
+        return torch.from_numpy(np.log(q / q.sum())).float()
+
 #g_n_correct = 0
 class MainModel(nn.Module):
-    def __init__(self, model, crit, opt):
+    def __init__(self, model, crit, opt, sampling_log_q=None):
         super(MainModel, self).__init__()
         self.model = model
         self.crit = crit
         self.opt = opt
+        if sampling_log_q is not None:
+            self.register_buffer('sampling_log_q', sampling_log_q)
 
     def forward(self, src, tgt):
         gold = tgt[0][:, 1:]
-        
+
+        if self.training and self.opt.sampled_softmax > 0:
+            hidden = self.model(src, tgt, return_hidden=True)
+            return get_sampled_loss(hidden, self.model.decoder.fin_to_voc.weight, gold,
+                                    self.sampling_log_q, self.opt.sampled_softmax)
+
+        if self.opt.loss_chunk_size > 0:
+            hidden = self.model(src, tgt, return_hidden=True)
+            return get_chunked_loss(self.crit, hidden, gold, self.model.decoder.fin_to_voc, self.opt)
+
         pred = self.model(src, tgt)
         if self.opt.smoothing:
             pred = F.log_softmax(pred, dim=1)
 
         loss = get_loss(self.crit, pred, gold, self.opt)
-        #g_n_correct = n_correct # hack
-        return loss, pred
+        n_correct = get_performance(pred, gold)
+        return loss, n_correct
 
 
-def train_epoch(model, training_data, validation_data, validation_data_translate, crit, optimizer, opt, epoch_i, nb_examples_seen, pct_next_save):
+def train_epoch(model, training_data, validation_data, validation_data_translate, crit, optimizer, opt, epoch_i, nb_examples_seen, pct_next_save,
+                writer=None, validator=None, telemetry=None):
     ''' Epoch operation in training phase'''
 
     model.train()
+    if telemetry is not None:
+        telemetry.reset()
 
     total_loss = 0
     n_total_words = 0
     n_total_correct = 0
 
     nb_examples_save = training_data.nb_examples*pct_next_save
-    for batch in tqdm(
-            training_data, mininterval=2,
-            desc='  - (Training)   ', leave=False):
-
-        # prepare data
-        src, tgt = batch
-
-        # forward
-        optimizer.zero_grad()
-        loss, pred = model(src, tgt)
-
-        if opt.multi_gpu:
-            loss.backward(torch.ones_like(loss.data))
-        else:
-            loss.backward()
-
-        # update parameters
-        optimizer.step()
-        if opt.sch_optim:
-            optimizer.update_learning_rate()
-
-        nb_examples_seen += len(src[0]) # batch size
-        if opt.save_model and nb_examples_seen >= nb_examples_save:
-            pct_next_save += opt.save_freq_pct
-            nb_examples_save = training_data.nb_examples*pct_next_save
-            epoch_i += opt.save_freq_pct
-            save_model_and_validation_BLEU(opt, model, optimizer, validation_data, validation_data_translate, epoch_i)
-            model.train()
-
-        # note keeping
-        gold = tgt[0][:, 1:]
-        n_correct = get_performance(pred, gold)
-        n_words = gold.data.ne(Constants.PAD).sum()
-        n_total_words += n_words
-        n_total_correct += n_correct
-        total_loss += loss.data[0]
-
+    # the processes may have different numbers of batches with -batch_tokens, join()
+    # keeps the gradient all-reduce of those which still have batches going
+    join = model.join() if opt.distributed else contextlib.suppress()
+    with join:
+        for batch in tqdm(
+                training_data, mininterval=2,
+                desc='  - (Training)   ', leave=False, disable=opt.rank != 0):
+
+            # prepare data
+            src, tgt = batch
+            if telemetry is not None:
+                telemetry.phase('data')
+
+            # forward
+            optimizer.zero_grad()
+            loss, n_correct = model(src, tgt)
+            if telemetry is not None:
+                telemetry.phase('forward')
+
+            if opt.multi_gpu:
+                loss.backward(torch.ones_like(loss.data))
+            else:
+                loss.backward()
+            if telemetry is not None:
+                telemetry.phase('backward')
+
+            # update parameters
+            optimizer.step()
+            if opt.sch_optim:
+                optimizer.update_learning_rate()
+            if telemetry is not None:
+                telemetry.phase('step')
+
+            nb_examples_seen += len(src[0]) # batch size
+            if opt.save_model and nb_examples_seen >= nb_examples_save:
+                pct_next_save += opt.save_freq_pct
+                nb_examples_save = training_data.nb_examples*pct_next_save
+                epoch_i += opt.save_freq_pct
+                if opt.rank == 0: # the other processes wait in the next gradient all-reduce
+                    save_model_and_validation_BLEU(opt, model, optimizer, validation_data, validation_data_translate, epoch_i,
+                                                   writer=writer, validator=validator)
+                model.train()
+                if telemetry is not None:
+                    telemetry.phase('save')
+
+            # note keeping
+            gold = tgt[0][:, 1:]
+            n_words = gold.data.ne(Constants.PAD).sum().item()
+            n_total_words += n_words
+            n_total_correct += n_correct.sum().item()
+            total_loss += loss.data.sum().item()
+            if telemetry is not None:
+                telemetry.end_step(src, tgt, loss.data.sum().item(), n_words, optimizer,
+                                   nb_examples_seen / training_data.nb_examples)
+
+    if telemetry is not None:
+        telemetry.flush(optimizer, nb_examples_seen / training_data.nb_examples)
     return total_loss/n_total_words, n_total_correct/n_total_words, epoch_i, nb_examples_seen, pct_next_save
 
 def eval_epoch(model, validation_data, crit, opt):
@@ -135,18 +254,18 @@ def eval_epoch(model, validation_data, crit, opt):
         gold = tgt[0][:, 1:]
 
         # forward
-        loss, pred = model(src, tgt)
+        loss, n_correct = model(src, tgt)
 
         # note keeping
-        n_correct = get_performance(pred, gold)
-        n_words = gold.data.ne(Constants.PAD).sum()
+        n_words = gold.data.ne(Constants.PAD).sum().item()
         n_total_words += n_words
-        n_total_correct += n_correct
-        total_loss += loss.data[0]
+        n_total_correct += n_correct.sum().item()
+        total_loss += loss.data.sum().item()
 
     return total_loss/n_total_words, n_total_correct/n_total_words
 
-def train(model, training_data, validation_data, validation_data_translate, crit, optimizer, opt, epoch_i=0):
+def train(model, training_data, validation_data, validation_data_translate, crit, optimizer, opt, epoch_i=0, writer=None, validator=None,
+          telemetry=None):
     ''' Start training '''
 
     nb_examples_seen = 0
@@ -154,19 +273,31 @@ def train(model, training_data, validation_data, validation_data_translate, crit
     p_validation = None
     valid_accus = []
     for ii in range(opt.epoch):
-        print('[ Epoch', epoch_i+1, ']')
+        if opt.rank == 0:
+            print('[ Epoch', epoch_i+1, ']')
 
         start = time.time()
         train_loss, train_accu, epoch_i, nb_examples_seen, pct_next_save = train_epoch(model, training_data, validation_data,
                                                                                         validation_data_translate, crit, optimizer, opt,
-                                                                                        epoch_i, nb_examples_seen, pct_next_save)
-        print('  - (Training)   ppl: {ppl: 8.5f}, accuracy: {accu:3.3f} %, '\
+                                                                                        epoch_i, nb_examples_seen, pct_next_save, writer, validator,
+                                                                                        telemetry)
+        if opt.rank != 0:
+            # rank 0 validates alone, the others wait for it in the next gradient all-reduce
+            continue
+        # with -sampled_softmax, over the sampled candidates only: not comparable with the validation
+        print('  - (Training)   {sampled}ppl: {ppl: 8.5f}, {sampled}accuracy: {accu:3.3f} %, '\
               'elapse: {elapse:3.3f} min'.format(
+                  sampled='sampled ' if opt.sampled_softmax > 0 else '',
                   ppl=math.exp(min(train_loss, 100)), accu=100*train_accu,
                   elapse=(time.time()-start)/60))
+        if isinstance(training_data, PrefetchLoader):
+            stats = training_data.stats()
+            print('  - (Data)       waited for {stalls} of {batches} batches ({stall_pct:3.1f} %), '\
+                  '{wait_s:3.2f} s in total, mean queue depth {mean_queue_depth:3.2f}'.format(**stats))
+            training_data.reset_stats()
 
         start = time.time()
-        valid_loss, valid_accu = eval_epoch(model, validation_data, crit, opt)
+        valid_loss, valid_accu = eval_epoch(model.module if opt.distributed else model, validation_data, crit, opt)
         print('  - (Validation) ppl: {ppl: 8.5f}, accuracy: {accu:3.3f} %, '\
                 'elapse: {elapse:3.3f} min'.format(
                     ppl=math.exp(min(valid_loss, 100)), accu=100*valid_accu,
@@ -175,11 +306,12 @@ def train(model, training_data, validation_data, validation_data_translate, crit
         valid_accus += [valid_accu]
 
 
-def save_model_and_validation_BLEU(opt, model, optimizer, validation_data, validation_data_translate, epoch_i, valid_accu=None, valid_accus=None):
+def save_model_and_validation_BLEU(opt, model, optimizer, validation_data, validation_data_translate, epoch_i, valid_accu=None, valid_accus=None,
+                                   writer=None, validator=None):
 
     model.eval()
 
-    if opt.multi_gpu:
+    if opt.multi_gpu or opt.distributed:
         model_state_dict = model.module.model.state_dict()
     else:
         model_state_dict = model.model.state_dict()
@@ -190,66 +322,49 @@ def save_model_and_validation_BLEU(opt, model, optimizer, validation_data, valid
         'settings': opt,
         'epoch': epoch_i}
 
+    # the writer snapshots the checkpoint and writes it in the background
     if opt.save_mode == 'all':
         model_name = opt.save_model + '_epoch{epoch:3.2f}.chkpt'.format(epoch=epoch_i)
-        torch.save(checkpoint, model_name)
-        torch.save(checkpoint, opt.save_model + '_tmp.chkpt')
-        _ = subprocess.check_output('mv ' + opt.save_model + '_tmp.chkpt' + ' ' + opt.save_model + '.chkpt', shell=True)
+        writer.save(checkpoint, model_name, link_path=opt.save_model + '.chkpt')
     elif opt.save_mode == 'best':
         model_name = opt.save_model + '.chkpt'
         if valid_accu >= max(valid_accus):
-            torch.save(checkpoint, model_name)
+            writer.save(checkpoint, model_name)
             print('    - [Info] The checkpoint file has been updated.')
 
     ###########################################################################################
+    if validator is not None:
+        # translated and scored by the worker process, from a copy of the weights
+        try:
+            validator.submit(snapshot(model_state_dict), model_name, epoch_i)
+        except RuntimeError as e:
+            print('    - [Warning] {}, validating in the training process.'.format(e))
+        else:
+            report_validations(validator.poll(), writer)
+            return
+
     print('[ Epoch', epoch_i, ']')
-    if opt.multi_gpu:
+    if opt.multi_gpu or opt.distributed:
         model_translate = model.module.model
     else:
         model_translate = model.model
 
-    output_name = model_name + '.output.dev'
-    with open(output_name, 'w') as f:
-        for batch in tqdm(validation_data_translate, mininterval=2, desc='  - (Translate and BLEU)', leave=False):
-            #import ipdb; ipdb.set_trace()
-            src_seq, src_pos = batch
-            lengths_seq_src, idx_src = src_pos.max(1)
-
-            _, sent_sort_idx = lengths_seq_src.sort(descending=True)
-
-            enc_output = model_translate.encoder(src_seq[sent_sort_idx], lengths_seq_src[sent_sort_idx])
-            all_hyp = model_translate.decoder.greedy_search(enc_output, lengths_seq_src[sent_sort_idx])
-
-            _, sent_revert_idx = sent_sort_idx.sort()
-            sent_revert_idx = sent_revert_idx.data.view(-1).tolist()
-            all_hyp = np.array(all_hyp)
-            all_hyp = all_hyp[sent_revert_idx]
-
-            #import ipdb; ipdb.set_trace()
-            for idx_seq in all_hyp:
-                if idx_seq[-1] == Constants.EOS: # if last word is EOS
-                    idx_seq = idx_seq[:-1]
-                pred_line = ' '.join([validation_data.tgt_idx2word[idx] for idx in idx_seq])
-                f.write(pred_line + '\n')
-
-    try:
-        #out = subprocess.check_output("perl multi-bleu.perl data/multi30k/val.de.atok < trained_epoch0_accu31.219.chkpt.output.dev", shell=True)
-        out = subprocess.check_output("perl multi-bleu.perl " + opt.valid_bleu_ref + " < " + output_name, shell=True)
-        out = out.decode() # because out is binary
-    except:
-        out = "multi-bleu.perl error"
-
+    out, score = translate_dev(model_translate, validation_data_translate, opt, model_name, epoch_i)
     print(out)
-    bleu_file = os.path.dirname(model_name) + '/bleu_scores.txt'
-    with open(bleu_file, 'a') as f:
-        f.write("Epoch "+str(epoch_i)+": "+out)
-
-    #return model_name
+    if score is not None:
+        writer.set_score(model_name, score.bleu)
 
+def report_validations(finished, writer):
+    ''' Print the results of the asynchronous validations and score their checkpoints '''
+    for model_name, epoch_i, out, score in finished:
+        print('[ Epoch', epoch_i, '] (validated in the background)')
+        print(out)
+        if score is not None:
+            writer.set_score(model_name, score.bleu)
 
 def load_model(opt):
 
-    checkpoint = torch.load(opt.reload)
+    checkpoint = torch.load(opt.reload, weights_only=False)
     model_opt = checkpoint['settings']
     epoch_i = checkpoint['epoch']
 
@@ -259,6 +374,8 @@ def load_model(opt):
         model_opt.max_token_seq_len,
         proj_share_weight=model_opt.proj_share_weight,
         embs_share_weight=model_opt.embs_share_weight,
+        attn_type=getattr(model_opt, 'attn_type', 'additive'),
+        attn_window=getattr(model_opt, 'attn_window', 0),
         d_model=model_opt.d_model,
         d_word_vec=model_opt.d_word_vec,
         n_layers=model_opt.n_layers,
@@ -280,7 +397,7 @@ def load_model(opt):
         optimizer = ScheduledOptim(optimizer, opt.d_model, opt.n_warmup_steps)
 
     if not opt.no_reload_optimizer:
-        optimizer.load_state_dict(checkpoint['optimizer'])
+        optimizer.load_state_dict(load_optimizer_state(checkpoint, opt.reload))
 
     return modelRNN, optimizer, epoch_i
 
@@ -292,6 +409,11 @@ def main():
 
     parser.add_argument('-epoch', type=int, default=100)
     parser.add_argument('-batch_size', type=int, default=64)
+    parser.add_argument('-prefetch', type=int, default=0,
+                        help='Build this many batches ahead in a background thread (0: no prefetching)')
+    parser.add_argument('-batch_tokens', type=int, default=0,
+                        help='Make batches of at most this many padded source + target tokens, '
+                             'instead of -batch_size sentences (0: fixed number of sentences)')
 
     parser.add_argument('-d_word_vec', type=int, default=620)
     parser.add_argument('-d_model', type=int, default=1000)
@@ -302,17 +424,60 @@ def main():
     parser.add_argument('-dropout', type=float, default=0.5)
     parser.add_argument('-embs_share_weight', action='store_true')
     parser.add_argument('-proj_share_weight', action='store_true')
+    parser.add_argument('-attn_type', type=str, choices=ATTN_TYPES, default='additive',
+                        help='additive (Bahdanau) attention, or general/dot (Luong) attention, which scores '
+                             'all the source positions with one batched matmul')
+    parser.add_argument('-attn_window', type=int, default=0,
+                        help='Local attention: attend to the 2*D+1 source positions around a predicted '
+                             'alignment point (0: attend to the whole source sentence)')
     parser.add_argument('-smoothing', action='store_true')
+    parser.add_argument('-sampled_softmax', type=int, default=0,
+                        help='Train with a sampled softmax over this many shared negatives per batch (0: full softmax). '
+                             'The validation always uses the full softmax; the training ppl and accuracy are '
+                             'over the sampled candidates. Not with -smoothing.')
+    parser.add_argument('-loss_chunk_size', type=int, default=0,
+                        help='Compute the output layer and the loss over chunks of this many timesteps, '
+                             'without keeping the full logits in memory (0: no chunking)')
+    parser.add_argument('-sampling_power', type=float, default=0.75,
+                        help='The sampled softmax draws the negatives from the unigram distribution to this power')
 
 
     parser.add_argument('-save_model', default=None)
     parser.add_argument('-save_mode', type=str, choices=['all', 'best'], default='all')
     parser.add_argument('-save_freq_pct', type=float, default=1.0)
+    parser.add_argument('-keep_last', type=int, default=0,
+                        help='Keep only the last K epoch checkpoints of -save_mode all (0: keep them all)')
+    parser.add_argument('-keep_best', type=int, default=0,
+                        help='Keep only the K epoch checkpoints with the best validation BLEU (0: keep them all); '
+                             'combined with -keep_last, a checkpoint is kept if either keeps it')
+    parser.add_argument('-separate_optimizer', action='store_true',
+                        help='Save the optimizer state in its own .optim.chkpt file next to every checkpoint')
 
     parser.add_argument('-no_cuda', action='store_true')
 
+    parser.add_argument('-telemetry', type=str, default=None, metavar='PATH',
+                        help='Append step-level throughput and timing records to this JSONL file '
+                             '(see summarize_telemetry.py)')
+    parser.add_argument('-telemetry_every', type=int, default=100,
+                        help='Write a -telemetry record every this many training steps')
+
     parser.add_argument('-multi_gpu', action='store_true')
 
+    parser.add_argument('-distributed', action='store_true',
+                        help='Data-parallel training over -nprocs processes, averaging the gradients with '
+                             'torch.distributed (gloo). Launched by torchrun instead if RANK and WORLD_SIZE are set.')
+    parser.add_argument('-nprocs', type=int, default=2,
+                        help='Number of local training processes with -distributed')
+    parser.add_argument('-dist_init', type=str, default='tcp://127.0.0.1:29500',
+                        help='torch.distributed init_method of the local processes')
+    parser.add_argument('-dist_timeout', type=float, default=60,
+                        help='Minutes the processes wait in a collective, e.g. while the first one saves a '
+                             'checkpoint, computes the dev perplexity or waits for the -async_valid process')
+    parser.add_argument('-threads', type=int, default=0,
+                        help='Number of intra-op threads of every process (0: torch default)')
+    parser.add_argument('-seed', type=int, default=None,
+                        help='Seed of the data shuffling, shared by all the processes with -distributed')
+
     parser.add_argument('-optim', type=str, choices=['adam', 'adadelta'], default='adam')
 
     parser.add_argument('-sch_optim', action='store_true')
@@ -326,6 +491,16 @@ def main():
 
     parser.add_argument('-valid_bleu_ref', type=str, default='',
                         help='Path to the reference')
+    parser.add_argument('-async_valid', action='store_true',
+                        help='Translate the dev set and compute the BLEU in a separate CPU process, '
+                             'from a copy of the weights, while the training goes on')
+    parser.add_argument('-valid_threads', type=int, default=1,
+                        help='Number of threads of the -async_valid process')
+    parser.add_argument('-valid_merge_bpe', action='store_true',
+                        help="Undo the BPE segmentation ('@@ ') of the validation translations before the BLEU")
+
+    parser.add_argument('-max_len_ratio', type=float, default=2.0,
+                        help='Maximum length of the validation translations, relative to the source length (0 for no limit)')
 
     parser.add_argument('-external_validation_script', type=str, default=None, metavar='PATH', nargs='*',
                          help="location of validation script (to run your favorite metric for validation) (default: %(default)s)")
@@ -335,22 +510,76 @@ def main():
         raise argparse.ArgumentTypeError("-save_freq_pct: %r not in range [0.0, 1.0]"%(opt.save_freq_pct,))
     opt.cuda = not opt.no_cuda
     #opt.d_word_vec = opt.d_model
+    if opt.smoothing and opt.sampled_softmax > 0:
+        raise argparse.ArgumentTypeError("-smoothing is not supported with -sampled_softmax")
+    if opt.distributed and opt.multi_gpu:
+        raise argparse.ArgumentTypeError("-distributed and -multi_gpu are exclusive")
+    if opt.distributed and opt.save_model and not opt.async_valid:
+        # the other processes would wait for the whole dev set translation in a gradient all-reduce
+        raise argparse.ArgumentTypeError("-distributed needs -async_valid to compute the validation BLEU")
+
+    if opt.distributed and 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
+        # one process per node started by torchrun
+        run(int(os.environ['RANK']), opt)
+    elif opt.distributed:
+        mp.spawn(run, args=(opt,), nprocs=opt.nprocs)
+    else:
+        run(0, opt)
+
+def run(rank, opt):
+    ''' Training process rank '''
+    opt.rank = rank
+    opt.world_size = 1
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+    if opt.distributed:
+        timeout = datetime.timedelta(minutes=opt.dist_timeout)
+        if 'WORLD_SIZE' in os.environ:
+            dist.init_process_group('gloo', init_method='env://', timeout=timeout)
+        else:
+            dist.init_process_group('gloo', init_method=opt.dist_init, rank=rank, world_size=opt.nprocs,
+                                    timeout=timeout)
+        opt.world_size = dist.get_world_size()
+        if opt.seed is None:
+            # the processes must shuffle the data the same way
+            seed = [np.random.randint(2**31)]
+            dist.broadcast_object_list(seed, src=0)
+            opt.seed = seed[0]
 
     #========= Loading Dataset =========#
-    data = torch.load(opt.data)
+    data = load_data(opt.data)
     opt.max_token_seq_len = data['settings'].max_token_seq_len
 
     #========= Preparing DataLoader =========#
-    training_data = DataLoader(
-        data['dict']['src'],
-        data['dict']['tgt'],
-        src_insts=data['train']['src'],
-        tgt_insts=data['train']['tgt'],
-        ctx_insts=None,
-        batch_size=opt.batch_size,
-        cuda=opt.cuda,
-        is_train=True,
-        sort_by_length=True)
+    if isinstance(data['train'], list):
+        # sharded binary data, see preprocess.py -n_shards
+        training_data = ShardedDataLoader(
+            data['dict']['src'],
+            data['dict']['tgt'],
+            data['train'],
+            batch_size=opt.batch_size,
+            cuda=opt.cuda,
+            is_train=True,
+            sort_by_length=True,
+            batch_tokens=opt.batch_tokens,
+            rank=opt.rank,
+            world_size=opt.world_size,
+            seed=opt.seed)
+    else:
+        training_data = DataLoader(
+            data['dict']['src'],
+            data['dict']['tgt'],
+            src_insts=data['train']['src'],
+            tgt_insts=data['train']['tgt'],
+            ctx_insts=None,
+            batch_size=opt.batch_size,
+            cuda=opt.cuda,
+            is_train=True,
+            sort_by_length=True,
+            batch_tokens=opt.batch_tokens,
+            rank=opt.rank,
+            world_size=opt.world_size,
+            seed=opt.seed)
 
     validation_data = DataLoader(
         data['dict']['src'],
@@ -362,7 +591,8 @@ def main():
         shuffle=False,
         cuda=opt.cuda,
         is_train=False,
-        sort_by_length=True)
+        sort_by_length=True,
+        batch_tokens=opt.batch_tokens)
 
     validation_data_translate = DataLoader(
         data['dict']['src'],
@@ -376,6 +606,10 @@ def main():
         is_train=False,
         sort_by_length=False)
 
+    if opt.prefetch > 0:
+        training_data = PrefetchLoader(training_data, n_prefetch=opt.prefetch, cuda=opt.cuda)
+        validation_data = PrefetchLoader(validation_data, n_prefetch=opt.prefetch, cuda=opt.cuda)
+
     opt.src_vocab_size = training_data.src_vocab_size
     opt.tgt_vocab_size = training_data.tgt_vocab_size
 
@@ -385,7 +619,8 @@ def main():
         print('[Warning]',
               'The src/tgt word2idx table are different but asked to share word embedding.')
 
-    print(opt)
+    if opt.rank == 0:
+        print(opt)
 
     if opt.reload and os.path.isfile(opt.reload):
         if not opt.save_model:
@@ -399,6 +634,8 @@ def main():
             opt.max_token_seq_len,
             proj_share_weight=opt.proj_share_weight,
             embs_share_weight=opt.embs_share_weight,
+            attn_type=opt.attn_type,
+            attn_window=opt.attn_window,
             d_model=opt.d_model,
             d_word_vec=opt.d_word_vec,
             n_layers=opt.n_layers,
@@ -437,13 +674,53 @@ def main():
     if opt.cuda:
         modelRNN = modelRNN.cuda()
         crit = crit.cuda()
-        
 
-    model = MainModel(modelRNN, crit, opt)
+    sampling_log_q = None
+    if opt.sampled_softmax > 0:
+        if isinstance(data['train'], list):
+            train_tgt_insts = [shard['tgt'] for shard in data['train']]
+        else:
+            train_tgt_insts = data['train']['tgt']
+        sampling_log_q = get_sampling_log_prob(train_tgt_insts, training_data.tgt_vocab_size, opt.sampling_power)
+        if opt.cuda:
+            sampling_log_q = sampling_log_q.cuda()
+
+    model = MainModel(modelRNN, crit, opt, sampling_log_q)
     if opt.multi_gpu:
         model = nn.DataParallel(model)
-
-    train(model, training_data, validation_data, validation_data_translate, crit, optimizer, opt, epoch_i)
+    elif opt.distributed:
+        # the initial parameters of rank 0 are broadcast to the other processes
+        model = DistributedDataParallel(model, broadcast_buffers=False)
+
+    writer = None
+    if opt.save_model and opt.rank == 0:
+        writer = CheckpointWriter(keep_last=opt.keep_last, keep_best=opt.keep_best,
+                                  separate_optimizer=opt.separate_optimizer)
+
+    validator = None
+    if opt.async_valid and writer is not None:
+        validator = ValidationWorker(opt, data['valid']['src'], data['dict']['src'], data['dict']['tgt'],
+                                     n_threads=opt.valid_threads)
+
+    telemetry = None
+    if opt.telemetry and opt.rank == 0:
+        telemetry = StepTelemetry(opt.telemetry, every=opt.telemetry_every, cuda=opt.cuda, info={
+            'batch_size': opt.batch_size, 'batch_tokens': opt.batch_tokens, 'prefetch': opt.prefetch,
+            'world_size': opt.world_size, 'threads': torch.get_num_threads()})
+
+    train(model, training_data, validation_data, validation_data_translate, crit, optimizer, opt, epoch_i, writer, validator,
+          telemetry)
+
+    if telemetry is not None:
+        telemetry.close()
+
+    if validator is not None:
+        report_validations(validator.close(), writer)
+    if writer is not None:
+        writer.close()
+
+    if opt.distributed:
+        dist.destroy_process_group()
 
 if __name__ == '__main__':
     main()
@@ -3,10 +3,13 @@
 import torch
 import argparse
 from tqdm import tqdm
-from transformer.Translator import Translator
+from NMTmodelRNN.Translator import Translator
+from NMTmodelRNN.Cache import TranslationCache, checkpoint_id
+from NMTmodelRNN.Shortlist import Shortlist
 from DataLoader import DataLoader
+from Dataset import load_data
 from preprocess import read_instances_from_file, convert_instance_to_idx_seq
-import transformer.Constants as Constants
+import NMTmodelRNN.Constants as Constants
 
 def main():
     '''Main Function'''
@@ -29,17 +32,33 @@ def main():
     parser.add_argument('-batch_size', type=int, default=36,
                         help='Batch size')
     parser.add_argument('-n_best', type=int, default=1,
-                        help="""If verbose is set, will output the n_best
-                        decoded sentences""")
+                        help="""Output the n_best decoded sentences
+                        of each source sentence""")
+    parser.add_argument('-alpha', type=float, default=1.0,
+                        help="""Length normalization of the beam scores
+                        (log-probability / length ** alpha)""")
     parser.add_argument('-no_cuda', action='store_true')
     parser.add_argument('-max_token_seq_len', type=int, default=500,
                         help='max word in a sentence')
+    parser.add_argument('-shortlist_frequent', type=int, default=0,
+                        help="""Restrict the output layer to the most frequent target
+                        words plus the lexical candidates of the source words
+                        (needs a -vocab built with preprocess.py -lex_size),
+                        0 to use the full vocabulary""")
+    parser.add_argument('-shortlist_translations', type=int, default=20,
+                        help='Lexical candidates per source word in the shortlist')
+    parser.add_argument('-cache_mb', type=float, default=0,
+                        help="""Memory bound (in MB) of the translation cache,
+                        0 to disable it""")
+    parser.add_argument('-cache_file', default=None,
+                        help="""File where the translation cache is loaded
+                        from and saved to""")
 
     opt = parser.parse_args()
     opt.cuda = not opt.no_cuda
 
     # Prepare DataLoader
-    preprocess_data = torch.load(opt.vocab)
+    preprocess_data = load_data(opt.vocab)
     preprocess_settings = preprocess_data['settings']
 
     test_src_word_insts = read_instances_from_file(
@@ -69,18 +88,40 @@ def main():
         batch_size=opt.batch_size,
         is_train=False)
 
-    translator = Translator(opt)
+    cache = None
+    if opt.cache_mb > 0 and opt.shortlist_frequent > 0:
+        # the shortlist of a batch depends on all its sentences, a cached translation would too
+        print('[Warning] The translation cache is disabled with a shortlist.')
+    elif opt.cache_mb > 0:
+        cache = TranslationCache(
+            checkpoint_id(opt.model), int(opt.cache_mb * 2**20), path=opt.cache_file)
+
+    shortlist = None
+    if opt.shortlist_frequent > 0:
+        assert 'lex' in preprocess_data, 'The -vocab data has no lexical table (preprocess.py -lex_size)'
+        shortlist = Shortlist(preprocess_data['lex'], opt.shortlist_frequent,
+                              opt.shortlist_translations, cuda=opt.cuda)
+
+    translator = Translator(opt, cache=cache, shortlist=shortlist)
     translator.model.eval()
 
     with open(opt.output, 'w') as f:
         for batch in tqdm(test_data, mininterval=2, desc='  - (Test)', leave=False):
-            all_hyp, all_scores = translator.translate_batch(batch, test_data.src_idx2word, test_data.tgt_idx2word)
+            if opt.ctx:
+                batch, _ = batch # the context is not used by the model
+            all_hyp, all_scores = translator.translate_batch(batch)
             for idx_seqs in all_hyp:
                 for idx_seq in idx_seqs:
-                    if idx_seq[-1] == Constants.EOS: # if last word is EOS
+                    if idx_seq and idx_seq[-1] == Constants.EOS: # if last word is EOS
                         idx_seq = idx_seq[:-1]
                     pred_line = ' '.join([test_data.tgt_idx2word[idx] for idx in idx_seq])
                     f.write(pred_line + '\n')
+
+    if cache is not None:
+        print('[Info] Translation cache: {hits} hits, {misses} misses ({hit_rate:.1%}), '
+              '{entries} entries, {bytes} bytes'.format(**cache.stats()))
+        if opt.cache_file:
+            cache.save()
     print('[Info] Finished.')
 
 if __name__ == "__main__":
@@ -42,17 +42,14 @@ else
 fi
 
 
-sed -r 's/(@@ )|(@@ ?$)//g' < ${model_name}.output.dev > ${model_name}.output.dev.tmp
-mv ${model_name}.output.dev.tmp ${model_name}.output.dev
-
-
 #name_bleu="$(cut -d"epoch" -f1 <<< $model_name)"
 name_bleu=$(echo $model_name | awk 'BEGIN {FS="epoch"} {print $1}')
 
-## get BLEU
+## get BLEU (same output as multi-bleu.perl, the BPE segmentation is undone in bleu.py)
 #BEST=`cat ${model_name}_best_bleu || echo 0`
-./multi-bleu.perl $ref < ${model_name}.output.dev >> ${name_bleu}bleu_scores
-BLEU=`./multi-bleu.perl $ref < ${model_name}.output.dev | cut -f 3 -d ' ' | cut -f 1 -d ','`
+OUT=`python3 bleu.py -merge_bpe $ref < ${model_name}.output.dev`
+echo "$OUT" >> ${name_bleu}bleu_scores
+BLEU=`echo "$OUT" | cut -f 3 -d ' ' | cut -f 1 -d ','`
 #BETTER=`echo "$BLEU > $BEST" | bc`
 
 echo "BLEU = $BLEU"